@@ -6,9 +6,10 @@ setup(
         packages=['xideco', 'xideco.data_files', 'xideco.data_files.port_map', 'xideco.data_files.configuration',
                   'xideco.data_files.scratch_files', 'xideco.data_files.scratch_files.projects',
                   'xideco.data_files.scratch_files.extensions', 'xideco.http_bridge', 'xideco.xideco_router',
-                  'xideco.arduino_bridge', 'xideco.raspberrypi_bridge','xideco.beaglebone_bridge',
-                  'experiments', 'experiments.xideco_tweeter','xideco.i2c.i2c_devices.adxl345',
-                  'xideco.xidekit'],
+                  'xideco.arduino_bridge', 'xideco.historian', 'xideco.raspberrypi_bridge','xideco.beaglebone_bridge',
+                  'experiments', 'experiments.xideco_tweeter', 'xideco.i2c', 'xideco.i2c.i2c_devices',
+                  'xideco.i2c.i2c_devices.adxl345',
+                  'xideco.xidekit', 'xideco.common'],
         install_requires=['pymata-aio>=2.8',
                           'aiohttp>=0.19.0',
                           'pyzmq>=15.1.0',
@@ -21,6 +22,9 @@ setup(
                 'xiab = xideco.arduino_bridge.xiab:arduino_bridge',
                 'xihb = xideco.http_bridge.xihb:http_bridge',
                 'xirt = xideco.xideco_router.xirt:xideco_router',
+                'xirec = xideco.xideco_router.xirec:xirec',
+                'xils = xideco.xideco_router.xils:xils',
+                'xihs = xideco.historian.xihs:xihs',
                 'xirb = xideco.raspberrypi_bridge.xirb:raspberrypi_bridge',
                 'xibb = xideco.beaglebone_bridge.xibb:beaglebone_bridge',
                 'xibbi2c = xideco.beaglebone_bridge.xibbi2c:beaglebone_bridge'
@@ -0,0 +1,52 @@
+"""
+Copyright (c) 2016 Alan Yorinks All right reserved.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public
+License as published by the Free Software Foundation; either
+version 3 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+from Adafruit_BBIO import calls
+
+IN = 0
+OUT = 1
+LOW = 0
+HIGH = 1
+RISING = 1
+FALLING = 2
+BOTH = 3
+
+
+def setup(*args, **kwargs):
+    calls.append(('GPIO', 'setup', args))
+
+
+def output(*args):
+    calls.append(('GPIO', 'output', args))
+
+
+def input(*args):
+    calls.append(('GPIO', 'input', args))
+    return LOW
+
+
+def add_event_detect(*args, **kwargs):
+    calls.append(('GPIO', 'add_event_detect', args))
+
+
+def remove_event_detect(*args):
+    calls.append(('GPIO', 'remove_event_detect', args))
+
+
+def cleanup():
+    calls.append(('GPIO', 'cleanup', ()))
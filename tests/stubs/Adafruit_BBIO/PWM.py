@@ -0,0 +1,39 @@
+"""
+Copyright (c) 2016 Alan Yorinks All right reserved.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public
+License as published by the Free Software Foundation; either
+version 3 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+from Adafruit_BBIO import calls
+
+
+def start(*args):
+    calls.append(('PWM', 'start', args))
+
+
+def set_duty_cycle(*args):
+    calls.append(('PWM', 'set_duty_cycle', args))
+
+
+def set_frequency(*args):
+    calls.append(('PWM', 'set_frequency', args))
+
+
+def stop(*args):
+    calls.append(('PWM', 'stop', args))
+
+
+def cleanup():
+    calls.append(('PWM', 'cleanup', ()))
@@ -0,0 +1,156 @@
+"""
+Copyright (c) 2016 Alan Yorinks All right reserved.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public
+License as published by the Free Software Foundation; either
+version 3 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+"""
+Reads IIO buffered ADC scans from a regular file, with the Adafruit_BBIO stub in tests/stubs in place
+of the hardware library, and checks the analog_block reports made from them.
+"""
+
+import os
+import struct
+import sys
+import tempfile
+import unittest
+
+import umsgpack
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stubs'))
+
+from xideco.beaglebone_bridge.adc_sampler import IIOBufferedADC
+from xideco.beaglebone_bridge.xibb import AnalogReader
+
+
+def pack_scans(scans):
+    """
+    :param scans: A list of scans, each a list of counts in channel order
+    :return: The scans as they are read from the IIO device
+    """
+    return b''.join(struct.pack('<' + str(len(scan)) + 'H', *scan) for scan in scans)
+
+
+class FakePublisher:
+    """
+    Collects the messages a HubPublisher would send
+    """
+
+    def __init__(self):
+        self.messages = []
+
+    def send_multipart(self, frames):
+        self.messages.append((frames[0], umsgpack.unpackb(frames[1])))
+
+
+class FakeClock:
+    """
+    A SyncedClock that is 1000 seconds ahead of time.monotonic()
+    """
+
+    def from_monotonic(self, monotonic):
+        return monotonic + 1000
+
+
+class IIOFileTest(unittest.TestCase):
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp()
+        os.close(handle)
+        self.iio = IIOBufferedADC(self.path, None)
+
+    def tearDown(self):
+        self.iio.close()
+        os.remove(self.path)
+
+    def append(self, data):
+        with open(self.path, 'ab') as f:
+            f.write(data)
+
+
+class TestIIOBufferedADC(IIOFileTest):
+    def test_scans_are_deinterleaved(self):
+        self.append(pack_scans([[10, 20], [11, 21], [12, 22]]))
+        self.iio.configure({2, 0}, 100)
+
+        self.assertEqual(self.iio.channels, [0, 2])
+        self.assertEqual(self.iio.scan_rate, 100)
+        samples = self.iio.read()
+        self.assertEqual(list(samples[0]), [10, 11, 12])
+        self.assertEqual(list(samples[2]), [20, 21, 22])
+
+    def test_partial_scan_is_kept(self):
+        data = pack_scans([[1, 101], [2, 102], [3, 103]])
+        self.append(data[:9])
+        self.iio.configure({0, 1})
+
+        samples = self.iio.read()
+        self.assertEqual(list(samples[0]), [1, 2])
+        self.assertEqual(list(samples[1]), [101, 102])
+        self.assertEqual(self.iio.leftover, data[8:9])
+
+        # the rest of the scan arrives with the next read
+        self.append(data[9:])
+        samples = self.iio.read()
+        self.assertEqual(list(samples[0]), [3])
+        self.assertEqual(list(samples[1]), [103])
+        self.assertEqual(self.iio.leftover, b'')
+
+    def test_no_channels(self):
+        self.iio.configure(set())
+        self.assertEqual(self.iio.read(), {})
+
+
+class TestAnalogReaderIIO(IIOFileTest):
+    def test_analog_block_in_millivolts(self):
+        # two oversampled samples: full scale and half scale
+        self.append(pack_scans([[4095], [4095], [4095], [0]]))
+        publisher = FakePublisher()
+        pin_states = [{'pin': 'P9_39', 'enabled': True, 'rate': 100, 'oversample': 2, 'block_size': 2,
+                       'mode': 'analog'}]
+        reader = AnalogReader('1', pin_states, publisher, FakeClock(), self.iio)
+
+        reader.sample_bursts(5.0)
+
+        self.assertEqual(self.iio.channels, [IIOBufferedADC.CHANNELS['P9_39']])
+        self.assertEqual(self.iio.scan_rate, 200)
+        self.assertEqual(len(publisher.messages), 1)
+        envelope, msg = publisher.messages[0]
+        self.assertEqual(envelope, b'B1')
+        self.assertEqual(msg['command'], 'analog_block')
+        self.assertEqual(msg['pin'], 'P9_39')
+        self.assertEqual(msg['oversample'], 2)
+        self.assertEqual(msg['time'], 1005.0)
+        self.assertEqual(struct.unpack('<2H', msg['samples']), (1800, 900))
+
+    def test_partial_oversample_group_is_kept(self):
+        self.append(pack_scans([[4095], [4095], [4095]]))
+        publisher = FakePublisher()
+        pin_states = [{'pin': 'P9_40', 'enabled': True, 'rate': 50, 'oversample': 2, 'block_size': 2,
+                       'mode': 'analog'}]
+        reader = AnalogReader('1', pin_states, publisher, FakeClock(), self.iio)
+
+        reader.sample_bursts(5.0)
+        self.assertEqual(publisher.messages, [])
+        self.assertEqual(list(reader.bursts['P9_40']['samples']), [1800])
+        self.assertEqual(list(reader.bursts['P9_40']['pending']), [4095])
+
+        self.append(pack_scans([[4095]]))
+        reader.sample_bursts(5.1)
+        self.assertEqual(len(publisher.messages), 1)
+        self.assertEqual(struct.unpack('<2H', publisher.messages[0][1]['samples']), (1800, 1800))
+
+
+if __name__ == '__main__':
+    unittest.main()
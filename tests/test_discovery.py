@@ -0,0 +1,103 @@
+"""
+Copyright (c) 2016 Alan Yorinks All right reserved.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public
+License as published by the Free Software Foundation; either
+version 3 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+"""
+Runs router discovery over the loopback interface, on a free UDP port, with the address cache in a
+temporary home directory.
+"""
+
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+from xideco.common import discovery
+from xideco.data_files.port_map import port_map
+
+
+def free_udp_port():
+    """
+    :return: A UDP port that nothing is bound to
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class TestDiscovery(unittest.TestCase):
+    def setUp(self):
+        self.port = free_udp_port()
+        self.saved_port = port_map.port_map['discovery_port']
+        port_map.port_map['discovery_port'] = str(self.port)
+
+        # the cache file name is taken from the home directory when discovery is imported
+        self.saved_home = os.environ.get('HOME')
+        self.saved_cache_file = discovery.CACHE_FILE
+        self.home = tempfile.mkdtemp()
+        os.environ['HOME'] = self.home
+        discovery.CACHE_FILE = os.path.join(os.path.expanduser('~'), '.xideco_router')
+
+        self.responder = None
+
+    def tearDown(self):
+        if self.responder:
+            self.responder.sock.close()
+        port_map.port_map['discovery_port'] = self.saved_port
+        discovery.CACHE_FILE = self.saved_cache_file
+        if self.saved_home is None:
+            del os.environ['HOME']
+        else:
+            os.environ['HOME'] = self.saved_home
+        shutil.rmtree(self.home)
+
+    def start_responder(self, answering=None):
+        self.responder = discovery.DiscoveryResponder(self.port, answering)
+        self.responder.start()
+
+    def test_probe_is_answered(self):
+        self.start_responder()
+        self.assertIn(discovery.discover_router(1.0, self.port), ('127.0.0.1', discovery.local_ip_address()))
+
+    def test_address_is_cached(self):
+        self.start_responder()
+        address = discovery.resolve_router_ip_address(None, 1.0)
+        self.assertIn(address, ('127.0.0.1', discovery.local_ip_address()))
+
+        self.assertEqual(discovery.CACHE_FILE, os.path.join(self.home, '.xideco_router'))
+        self.assertEqual(discovery.read_cached_address(), address)
+
+        # with no router answering, the cached address is used
+        self.responder.sock.close()
+        self.responder = None
+        self.assertEqual(discovery.resolve_router_ip_address('None', .2), address)
+
+    def test_standby_is_silent(self):
+        self.start_responder(answering=lambda: False)
+        self.assertIsNone(discovery.discover_router(.3, self.port))
+        self.assertIsNone(discovery.read_cached_address())
+
+    def test_given_address_is_used(self):
+        self.assertEqual(discovery.resolve_router_ip_address('10.0.0.5'), '10.0.0.5')
+        self.assertFalse(os.path.exists(discovery.CACHE_FILE))
+
+
+if __name__ == '__main__':
+    unittest.main()
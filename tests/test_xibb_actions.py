@@ -0,0 +1,141 @@
+"""
+Copyright (c) 2016 Alan Yorinks All right reserved.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public
+License as published by the Free Software Foundation; either
+version 3 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+"""
+Runs BeagleBone bridge servo sweeps and tones through the ActionScheduler, with the Adafruit_BBIO
+stub in tests/stubs in place of the hardware library.
+"""
+
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stubs'))
+
+import Adafruit_BBIO
+from xideco.beaglebone_bridge.xibb import BeagleBoneBridge
+from xideco.common.action_scheduler import ActionScheduler
+
+
+def make_bridge():
+    """
+    Create a bridge with only the state used by the PWM commands - no sockets or threads are started
+    :return: BeagleBoneBridge
+    """
+    bridge = BeagleBoneBridge.__new__(BeagleBoneBridge)
+    bridge.pwm_pins = ["P9_14", "P9_16"]
+    bridge.pwm_pin_states = [{'pin': pin, 'mode': 'pwm', 'enabled': True} for pin in bridge.pwm_pins]
+    bridge.scheduler = ActionScheduler()
+    bridge.servo_positions = {}
+    bridge.servo_step_time = .005
+    bridge.last_problem = ''
+    return bridge
+
+
+def run_scheduler(scheduler, timeout=2.0):
+    """
+    Run scheduled actions, as the bridge's main loop does, until none are left
+    :param scheduler: ActionScheduler
+    :param timeout: Maximum time to run in seconds
+    :return:
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        delay = scheduler.next_due()
+        if delay is None:
+            return
+        time.sleep(delay)
+        scheduler.run_pending()
+    raise AssertionError('scheduled actions did not finish')
+
+
+def duty_cycles(pin):
+    """
+    :param pin: PWM pin
+    :return: The duty cycles written to the pin
+    """
+    return [args[1] for module, function, args in Adafruit_BBIO.calls
+            if function == 'set_duty_cycle' and args[0] == pin]
+
+
+class TestServoSweep(unittest.TestCase):
+    def setUp(self):
+        del Adafruit_BBIO.calls[:]
+        self.bridge = make_bridge()
+
+    def test_sweep(self):
+        self.bridge.payload = {'pin': 'P9_14', 'position': '0'}
+        self.bridge.set_servo_position()
+        self.bridge.payload = {'pin': 'P9_14', 'position': '90', 'sweep_time': '50'}
+        self.bridge.set_servo_position()
+
+        # the first step is taken at once, and the rest by the scheduler
+        self.assertEqual(len(duty_cycles('P9_14')), 2)
+        run_scheduler(self.bridge.scheduler)
+
+        duties = duty_cycles('P9_14')
+        self.assertEqual(len(duties), 1 + 10)
+        self.assertEqual(duties, sorted(duties, reverse=True))
+        self.assertEqual(self.bridge.servo_positions['P9_14'], 90)
+        self.assertEqual(self.bridge.last_problem, '7-0\n')
+
+    def test_new_position_replaces_sweep(self):
+        self.bridge.payload = {'pin': 'P9_14', 'position': '0'}
+        self.bridge.set_servo_position()
+        self.bridge.payload = {'pin': 'P9_14', 'position': '180', 'sweep_time': '50'}
+        self.bridge.set_servo_position()
+        self.bridge.payload = {'pin': 'P9_14', 'position': '45'}
+        self.bridge.set_servo_position()
+
+        run_scheduler(self.bridge.scheduler)
+        self.assertEqual(self.bridge.servo_positions['P9_14'], 45)
+        self.assertEqual(len(duty_cycles('P9_14')), 3)
+
+
+class TestTone(unittest.TestCase):
+    def setUp(self):
+        del Adafruit_BBIO.calls[:]
+        self.bridge = make_bridge()
+
+    def test_tone_ends(self):
+        self.bridge.payload = {'pin': 'P9_16', 'frequency': '440', 'duration': '20'}
+        self.bridge.play_tone()
+        self.assertEqual(duty_cycles('P9_16'), [50])
+
+        run_scheduler(self.bridge.scheduler)
+        self.assertEqual(duty_cycles('P9_16'), [50, 0.0])
+
+    def test_tone_off(self):
+        self.bridge.payload = {'pin': 'P9_16', 'frequency': '440', 'duration': '1000'}
+        self.bridge.play_tone()
+        self.assertTrue(self.bridge.scheduler.pending(('tone', 'P9_16')))
+
+        self.bridge.payload = {'pin': 'P9_16'}
+        self.bridge.tone_off()
+        self.assertFalse(self.bridge.scheduler.pending(('tone', 'P9_16')))
+        self.assertEqual(duty_cycles('P9_16'), [50, 0.0])
+        self.assertEqual(self.bridge.last_problem, '6-0\n')
+
+        # the cancelled "tone off" does not run
+        run_scheduler(self.bridge.scheduler)
+        self.assertEqual(duty_cycles('P9_16'), [50, 0.0])
+
+
+if __name__ == '__main__':
+    unittest.main()
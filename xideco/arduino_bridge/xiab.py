@@ -23,6 +23,7 @@ Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 import argparse
 import signal
 import sys
+import threading
 
 import umsgpack
 # noinspection PyPackageRequirements
@@ -30,6 +31,15 @@ import zmq
 from pymata_aio.constants import Constants
 from pymata_aio.pymata3 import PyMata3
 
+from xideco.common.clock_sync import ClockSync, SyncedClock
+from xideco.common.command_coalescer import CommandCoalescer
+from xideco.common.compression import MessageCompressor, unpack_message
+from xideco.common.failover import HEARTBEAT_TOPIC, RouterFailover
+from xideco.common.instrumentation import Instrumentation
+from xideco.common.liveness import Heartbeat
+from xideco.common.publisher_hub import PublisherHub
+from xideco.common import discovery
+from xideco.common import rpc
 from xideco.data_files.port_map import port_map
 
 
@@ -39,10 +49,15 @@ class ArduinoBridge:
     The Arduino Bridge provides the protocol bridge between Xideco and Firmata
     """
 
-    def __init__(self, pymata_board, board_num, router_ip_address):
+    def __init__(self, pymata_board, board_num, router_ip_address, max_actuation_rate=50,
+                 compression_threshold=0, standby_router_ip_address=None, instrumentation_interval=0):
         """
         :param pymata_board: Pymata-aio instance
         :param board_num: Arduino Board Number (1-10)
+        :param max_actuation_rate: Maximum servo/PWM updates per second for each pin
+        :param compression_threshold: Reports of at least this many bytes are compressed - 0 = no compression
+        :param standby_router_ip_address: Router to use if the router stops responding
+        :param instrumentation_interval: Seconds between instrumentation stats reports - 0 = off
         :return:
         """
 
@@ -74,10 +89,8 @@ class ArduinoBridge:
         self.get_pin_capabilities()
 
         # establish the zeriomq sub and pub sockets
-        if self.router_ip_address == 'None':
-            self.router_ip_address = port_map.port_map['router_ip_address']
-        else:
-            self.router_ip_address = router_ip_address
+        # if not specified, the router is discovered
+        self.router_ip_address = discovery.resolve_router_ip_address(router_ip_address)
 
         print('\n**************************************')
         print('Arduino Bridge - xiab')
@@ -99,10 +112,21 @@ class ArduinoBridge:
         # subscribe to broadcast i2c message - i2c messages can also be board specific with A + board number
         self.subscriber.setsockopt(zmq.SUBSCRIBE, 'Q'.encode())
 
-        self.publisher = self.context.socket(zmq.PUB)
-        connect_string = "tcp://" + self.router_ip_address + ':' + port_map.port_map['publish_to_router_port']
+        # large reports may be compressed
+        if compression_threshold:
+            compressor = MessageCompressor(['B' + self.board_num], compression_threshold)
+        else:
+            compressor = None
+
+        # all threads of the bridge publish through a single connection to the router
+        self.publisher_hub = PublisherHub(self.context, self.router_ip_address, compressor=compressor)
+        self.publisher_hub.start()
+        self.publisher = self.publisher_hub.create_publisher()
 
-        self.publisher.connect(connect_string)
+        # reports are stamped with a clock synchronised to the router
+        self.clock = SyncedClock()
+        self.clock_sync = ClockSync(self.context, self.router_ip_address, self.clock, self.publisher, self.board_num)
+        self.clock_sync.start()
 
         # The Xideco protocol message received
         self.payload = None
@@ -117,6 +141,30 @@ class ArduinoBridge:
 
         self.i2c_report_pending = False
 
+        # request id of the pending i2c read, echoed in its reply
+        self.i2c_request_id = None
+
+        # servo and PWM commands are coalesced so that only the latest value for a pin is actuated
+        self.coalescer = CommandCoalescer(max_actuation_rate)
+
+        # commands that need a reply are received through the RPC channel
+        self.rpc_server = rpc.RpcServer(self.context, self.router_ip_address, 'A' + self.board_num, self.rpc_request)
+
+        # if the router stops responding, the bridge moves to the standby router
+        self.failover = RouterFailover(self.router_ip_address, standby_router_ip_address)
+        self.failover.watch(self.subscriber)
+        self.failover.add_callback(self.publisher_hub.reconnect)
+        self.failover.add_callback(self.clock_sync.reconnect)
+        self.failover.add_callback(self.rpc_server.reconnect)
+
+        # heartbeats tell the router that the bridge is running, and how busy it is - see liveness.py
+        self.heartbeat = Heartbeat(self.publisher, 'xiab', self.board_num, queue_depth=self.queue_depth,
+                                   clock=self.clock)
+
+        # command, report and main loop timings - see instrumentation.py
+        self.instrumentation = Instrumentation(self.publisher, 'xiab', self.board_num, self.clock,
+                                               instrumentation_interval)
+
     def setup_analog_pin(self):
         """
         This method validates and configures a pin for analog input
@@ -414,10 +462,13 @@ class ArduinoBridge:
         pin = str(data[0])
         value = str(data[1])
 
-        digital_reply_msg = umsgpack.packb({u"command": "digital_read", u"pin": pin, u"value": value})
+        report_time = self.clock.now()
+        digital_reply_msg = self.instrumentation.pack({u"command": "digital_read", u"pin": pin, u"value": value,
+                                                       u"time": report_time})
 
         envelope = ("B" + self.board_num).encode()
         self.publisher.send_multipart([envelope, digital_reply_msg])
+        self.instrumentation.published(report_time)
         # print(digital_reply_msg)
         # print(envelope)
 
@@ -430,10 +481,13 @@ class ArduinoBridge:
         pin = str(data[0])
         value = str(data[1])
 
-        analog_reply_msg = umsgpack.packb({u"command": "analog_read", u"pin": pin, u"value": value})
+        report_time = self.clock.now()
+        analog_reply_msg = self.instrumentation.pack({u"command": "analog_read", u"pin": pin, u"value": value,
+                                                      u"time": report_time})
 
         envelope = ("B" + self.board_num).encode()
         self.publisher.send_multipart([envelope, analog_reply_msg])
+        self.instrumentation.published(report_time)
 
     def i2c_request(self):
         """
@@ -445,7 +499,17 @@ class ArduinoBridge:
         cmd = self.payload['cmd']
         addr = self.payload['device_address']
 
-        if cmd == 'init':
+        if cmd == 'batch':
+            # perform each request of the batch in order
+            batch = self.payload
+            for item in batch['requests']:
+                self.payload = dict(item)
+                self.payload.setdefault('device_address', addr)
+                if 'request_id' in batch:
+                    self.payload.setdefault('request_id', batch['request_id'])
+                self.i2c_request()
+            self.payload = batch
+        elif cmd == 'init':
             self.board.i2c_config()
         elif cmd == 'write_byte':
             # get handle
@@ -456,6 +520,7 @@ class ArduinoBridge:
             num_bytes = self.payload['num_bytes']
             register = self.payload['register']
             self.i2c_report_pending = True
+            self.i2c_request_id = self.payload.get('request_id')
 
             self.board.i2c_read_request(addr, register, num_bytes, Constants.I2C_READ, self.report_i2c_data)
             self.board.sleep(.001)
@@ -466,7 +531,12 @@ class ArduinoBridge:
         # create a topic specific to the board number of this board
         envelope = ("B" + self.board_num).encode()
 
-        msg = umsgpack.packb({u"command": "i2c_reply", u"board": self.board_num, u"data": data[2:]})
+        reply = {u"command": "i2c_reply", u"board": self.board_num, u"data": bytes(data[2:]),
+                 u"time": self.clock.now()}
+        # echo the request id so the requester can match the reply to its request
+        if self.i2c_request_id is not None:
+            reply[u"request_id"] = self.i2c_request_id
+        msg = umsgpack.packb(reply)
 
         self.publisher.send_multipart([envelope, msg])
         self.i2c_report_pending = False
@@ -485,18 +555,82 @@ class ArduinoBridge:
             try:
                 z = self.subscriber.recv_multipart(zmq.NOBLOCK)
 
-                self.payload = umsgpack.unpackb(z[1])
-                # print("[%s] %s" % (z[0], self.payload))
-                command = self.payload['command']
-                if command in self.command_dict:
-                    self.command_dict[command]()
+                payload = unpack_message(z)
+                self.heartbeat.message()
+                # print("[%s] %s" % (z[0], payload))
+                if z[0] == HEARTBEAT_TOPIC:
+                    self.router_heartbeat(payload)
                 else:
-                    print("can't execute unknown command'")
+                    for payload in self.coalescer.submit(z[0], payload):
+                        self.dispatch_command(payload)
                 self.board.sleep(.001)
             except zmq.error.Again:
                 self.board.sleep(.001)
+            # move to the standby router if the router has stopped responding
+            self.failover.check()
+            # publish a heartbeat when due
+            self.heartbeat.tick(self.coalescer.dropped + self.publisher.dropped)
+            self.instrumentation.loop_pass()
+            # execute commands received through the RPC channel
+            self.rpc_server.process_requests()
+            # actuate any coalesced commands whose rate limit has expired
+            for payload in self.coalescer.due():
+                self.dispatch_command(payload)
             # return
 
+    def dispatch_command(self, payload):
+        """
+        Execute a single Xideco protocol command
+        :param payload: The unpacked command message
+        :return:
+        """
+        self.payload = payload
+        command = self.payload['command']
+        if command in self.command_dict:
+            self.instrumentation.dispatch(command, self.command_dict[command])
+        else:
+            print("can't execute unknown command'")
+
+    def queue_depth(self):
+        """
+        :return: The number of commands waiting to be executed
+        """
+        return len(self.coalescer.pending)
+
+    def router_heartbeat(self, payload):
+        """
+        Process a router heartbeat, and report any gap in the heartbeats
+        :param payload: The heartbeat message
+        :return:
+        """
+        report = self.failover.heartbeat(payload)
+        if report:
+            report[u"board"] = self.board_num
+            print('No router heartbeats for ' + str(round(report['duration'], 1)) +
+                  ' seconds - messages may have been lost')
+            self.publisher.send_multipart([("B" + self.board_num).encode(), umsgpack.packb(report)])
+
+    def rpc_request(self, payload):
+        """
+        Execute a command received through the RPC channel, and reply with its outcome
+        :param payload: The unpacked command message
+        :return: reply
+        """
+        if payload.get('command') == 'instrumentation':
+            return self.instrumentation.rpc_request(payload)
+        if payload.get('command') not in self.command_dict:
+            return rpc.error_reply(rpc.UNKNOWN_COMMAND, str(payload.get('command')))
+
+        # acknowledged commands are not rate limited, but are executed after the commands waiting for their pin
+        commands = self.coalescer.immediate(self.rpc_server.service, payload)
+        for command in commands[:-1]:
+            self.dispatch_command(command)
+        if self.last_problem:
+            self.report_problem()
+
+        self.dispatch_command(payload)
+        return rpc.problem_reply(self.last_problem)
+
     def get_pin_capabilities(self):
         """
         This method retrieves the Arduino pin capability and analog map reports.
@@ -581,8 +715,11 @@ class ArduinoBridge:
         :return:
         """
         self.subscriber.close()
-        self.publisher.close()
-        self.context.term()
+        # the hub thread closes its own sockets
+        self.publisher_hub.stop()
+        # the other threads close their sockets when the context is terminated. term waits for every
+        # socket to be closed, so it is left to a helper thread that does not hold up the exit.
+        threading.Thread(target=self.context.term, daemon=True).start()
 
 
 def arduino_bridge():
@@ -596,7 +733,13 @@ def arduino_bridge():
     parser.add_argument("-b", dest="board_number", default="1", help="Board Number - 1 through 10")
     parser.add_argument("-p", dest="comport", default="None", help="Arduino COM port - e.g. /dev/ttyACMO or COM3")
     parser.add_argument('-r', dest='router_ip_address', default='None', help='Router IP Address')
-
+    parser.add_argument('-s', dest='standby_router_ip_address', default='None', help='Standby Router IP Address')
+    parser.add_argument('-x', dest='instrumentation_interval', default='0',
+                        help='Publish instrumentation stats every this many seconds - 0 = off')
+    parser.add_argument('-m', dest='max_actuation_rate', default='50',
+                        help='Maximum servo/PWM updates per second for each pin - 0 = no limit')
+    parser.add_argument('-z', dest='compression_threshold', default='0',
+                        help='Compress reports of at least this many bytes - 0 = no compression')
 
     args = parser.parse_args()
     if args.comport == "None":
@@ -608,7 +751,12 @@ def arduino_bridge():
 
     router_ip_address = args.router_ip_address
 
-    abridge = ArduinoBridge(pymata_board, board_num, router_ip_address)
+    max_actuation_rate = float(args.max_actuation_rate)
+
+    abridge = ArduinoBridge(pymata_board, board_num, router_ip_address, max_actuation_rate,
+                            int(args.compression_threshold), args.standby_router_ip_address,
+                            float(args.instrumentation_interval))
+    abridge.instrumentation.install_signal_handlers()
     # while True:
     abridge.run_arduino_bridge()
 
@@ -0,0 +1,160 @@
+"""
+Copyright (c) 2016 Alan Yorinks All right reserved.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public
+License as published by the Free Software Foundation; either
+version 3 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+import array
+import os
+import sys
+
+
+class IIOBufferedADC:
+    """
+    This class reads BeagleBone ADC samples through the Linux IIO buffered interface.
+
+    The kernel samples the enabled channels continuously and places the samples in a buffer.
+    Each scan contains one little endian 16 bit sample for each enabled channel, in channel order.
+    Samples are raw 12 bit counts of the 1.8 V reference. Multiply them by MILLIVOLTS_PER_COUNT for
+    the millivolt units of Adafruit_BBIO ADC.read_raw.
+
+    All of the enabled channels are sampled in each scan, so they share one scan rate. It is set
+    through the device's sampling_frequency attribute.
+
+    For testing, sysfs_path may be set to None and device_path to a regular file containing
+    scans. The sysfs configuration is then skipped and the file is read as if it were the device.
+    """
+
+    # BeagleBone header pin to AIN channel number
+    CHANNELS = {"P9_39": 0, "P9_40": 1, "P9_37": 2, "P9_38": 3, "P9_33": 4, "P9_36": 5, "P9_35": 6}
+
+    MILLIVOLTS_PER_COUNT = 1800.0 / 4095
+
+    def __init__(self, device_path='/dev/iio:device0', sysfs_path='/sys/bus/iio/devices/iio:device0',
+                 buffer_length=1024):
+        """
+        :param device_path: IIO character device, or a file of recorded scans
+        :param sysfs_path: IIO sysfs directory for the device, or None to skip configuration
+        :param buffer_length: Number of scans the kernel buffer holds
+        :return:
+        """
+        self.device_path = device_path
+        self.sysfs_path = sysfs_path
+        self.buffer_length = buffer_length
+
+        # enabled channels in scan order
+        self.channels = []
+
+        # scans per second set by configure, or None if the device's rate is used
+        self.scan_rate = None
+
+        self.fd = None
+
+        # bytes of an incomplete scan left over from the last read
+        self.leftover = b''
+
+    def _write_sysfs(self, name, value):
+        """
+        Write a value to an IIO sysfs attribute
+        :param name: Attribute path relative to the device directory
+        :param value: Value to write
+        :return:
+        """
+        if self.sysfs_path:
+            with open(os.path.join(self.sysfs_path, name), 'w') as f:
+                f.write(str(value))
+
+    def supports_scan_rate(self, scan_rate):
+        """
+        Check that the device can be set to a scan rate
+        :param scan_rate: scans per second
+        :return: True if the device has a sampling_frequency attribute and the rate is one of the
+                 rates it lists as available, if it lists them
+        """
+        if not self.sysfs_path:
+            return True
+        if not os.path.exists(os.path.join(self.sysfs_path, 'sampling_frequency')):
+            return False
+        try:
+            with open(os.path.join(self.sysfs_path, 'sampling_frequency_available')) as f:
+                available = [float(rate) for rate in f.read().split()]
+        except (IOError, OSError, ValueError):
+            return True
+        return any(abs(rate - scan_rate) < .5 for rate in available)
+
+    def configure(self, channels, scan_rate=None):
+        """
+        Stop the buffer, enable the specified channels and restart the buffer
+        :param channels: A collection of AIN channel numbers
+        :param scan_rate: scans per second, or None to leave the device's rate unchanged
+        :return:
+        """
+        self.close()
+
+        for channel in range(len(self.CHANNELS)):
+            self._write_sysfs('scan_elements/in_voltage' + str(channel) + '_en', int(channel in channels))
+
+        self.channels = sorted(channels)
+        if not self.channels:
+            return
+
+        if scan_rate:
+            self._write_sysfs('sampling_frequency', int(round(scan_rate)))
+        self.scan_rate = scan_rate
+
+        self._write_sysfs('buffer/length', self.buffer_length)
+        self._write_sysfs('buffer/enable', 1)
+
+        self.fd = os.open(self.device_path, os.O_RDONLY | os.O_NONBLOCK)
+
+    def read(self):
+        """
+        Read all of the complete scans that are available
+        :return: A dictionary of channel number to an array of unsigned 16 bit samples, in counts
+        """
+        samples = {channel: array.array('H') for channel in self.channels}
+        if self.fd is None:
+            return samples
+
+        try:
+            data = os.read(self.fd, self.buffer_length * 2 * len(self.channels))
+        except BlockingIOError:
+            return samples
+
+        data = self.leftover + data
+        scan_size = 2 * len(self.channels)
+        usable = len(data) - len(data) % scan_size
+        self.leftover = data[usable:]
+
+        scans = array.array('H')
+        scans.frombytes(data[:usable])
+        if sys.byteorder != 'little':
+            scans.byteswap()
+
+        # samples are interleaved by channel - slice them apart
+        for position, channel in enumerate(self.channels):
+            samples[channel] = scans[position::len(self.channels)]
+        return samples
+
+    def close(self):
+        """
+        Stop the kernel buffer and close the device
+        :return:
+        """
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+            self._write_sysfs('buffer/enable', 0)
+        self.leftover = b''
@@ -0,0 +1,117 @@
+"""
+Copyright (c) 2016 Alan Yorinks All right reserved.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public
+License as published by the Free Software Foundation; either
+version 3 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+import bisect
+import configparser
+import os
+
+# numpy is optional - it is only used to convert blocks of readings
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class DistanceCalibration:
+    """
+    This class converts raw ADC readings from an analog distance sensor into centimeters.
+
+    The calibration curve is loaded from a section of calibration.cfg. Single readings are
+    converted with a binary search of the curve and blocks of readings with numpy.searchsorted.
+    Readings that fall between two points of the curve are linearly interpolated.
+    """
+
+    # the calibration file supplied with xideco
+    DEFAULT_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'data_files', 'configuration', 'calibration.cfg')
+
+    DEFAULT_SENSOR = 'gp2y0a21yk'
+
+    def __init__(self, sensor=DEFAULT_SENSOR, calibration_file=DEFAULT_FILE):
+        """
+        :param sensor: Name of the section in the calibration file
+        :param calibration_file: Path to the calibration file
+        :return:
+        """
+        config = configparser.ConfigParser()
+        if not config.read(calibration_file, encoding="utf8"):
+            raise ValueError('Cannot read calibration file', calibration_file)
+
+        if not config.has_section(sensor):
+            raise ValueError('Unknown distance sensor', sensor)
+
+        self.sensor = sensor
+        self.scale = config.getfloat(sensor, 'scale')
+        voltages = [float(v) for v in config.get(sensor, 'voltages').split(',')]
+        distances = [float(d) for d in config.get(sensor, 'distances').split(',')]
+
+        if len(voltages) != len(distances) or len(voltages) < 2:
+            raise ValueError('voltages and distances must be lists of the same length', sensor)
+
+        # keep the curve sorted by ascending voltage for the binary search
+        points = sorted(zip(voltages, distances))
+        self.voltages = [p[0] for p in points]
+        self.distances = [p[1] for p in points]
+
+        if numpy:
+            self.voltage_array = numpy.array(self.voltages)
+            self.distance_array = numpy.array(self.distances)
+
+    def convert(self, raw_data):
+        """
+        Convert a single raw reading
+        :param raw_data: Raw ADC reading
+        :return: Distance in centimeters
+        """
+        value = raw_data * self.scale
+
+        index = bisect.bisect_left(self.voltages, value)
+        if index == 0:
+            return self.distances[0]
+        if index == len(self.voltages):
+            return self.distances[-1]
+
+        v0 = self.voltages[index - 1]
+        v1 = self.voltages[index]
+        d0 = self.distances[index - 1]
+        d1 = self.distances[index]
+        return round(d0 + (d1 - d0) * (value - v0) / (v1 - v0), 1)
+
+    def convert_block(self, raw_data):
+        """
+        Convert a block of raw readings
+        :param raw_data: A sequence of raw ADC readings
+        :return: A list of distances in centimeters
+        """
+        if not numpy:
+            return [self.convert(x) for x in raw_data]
+
+        values = numpy.asarray(raw_data, dtype=float) * self.scale
+
+        # index of the upper point of the segment each value falls in, kept inside the table
+        index = numpy.searchsorted(self.voltage_array, values).clip(1, len(self.voltages) - 1)
+
+        v0 = self.voltage_array[index - 1]
+        v1 = self.voltage_array[index]
+        d0 = self.distance_array[index - 1]
+        d1 = self.distance_array[index]
+
+        # values outside of the table are held at the nearest end point
+        values = values.clip(self.voltage_array[0], self.voltage_array[-1])
+        distances = d0 + (d1 - d0) * (values - v0) / (v1 - v0)
+        return numpy.round(distances, 1).tolist()
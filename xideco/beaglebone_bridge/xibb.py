@@ -21,12 +21,25 @@ Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 """
 
 import argparse
+import array
 import threading
 import time
 
 import umsgpack
 # noinspection PyPackageRequirements
 import zmq
+from xideco.common.action_scheduler import ActionScheduler
+from xideco.common.clock_sync import ClockSync, SyncedClock
+from xideco.beaglebone_bridge.adc_sampler import IIOBufferedADC
+from xideco.beaglebone_bridge.distance_calibration import DistanceCalibration
+from xideco.common.command_coalescer import CommandCoalescer
+from xideco.common.compression import MessageCompressor, unpack_message
+from xideco.common.failover import HEARTBEAT_TOPIC, RouterFailover
+from xideco.common.instrumentation import Instrumentation
+from xideco.common.liveness import Heartbeat
+from xideco.common.publisher_hub import PublisherHub
+from xideco.common import discovery
+from xideco.common import rpc
 from xideco.data_files.port_map import port_map
 
 import signal
@@ -45,18 +58,25 @@ class BeagleBoneBridge:
 
     """
 
-    def __init__(self, board_num, board_type, servo_polarity, router_ip_address):
+    def __init__(self, board_num, board_type, servo_polarity, router_ip_address, max_actuation_rate=50,
+                 iio=None, compression_threshold=0, standby_router_ip_address=None, instrumentation_interval=0):
         """
         :param board_num: System Board Number (1-10)
         :param board_type: "black" or "green"
         :param servo_polarity: 1 or 0
         :param: router_ip_address: IP address of xideco router
+        :param max_actuation_rate: Maximum servo/PWM updates per second for each pin
+        :param iio: Optional IIOBufferedADC used for burst sampling of analog pins
+        :param compression_threshold: Reports of at least this many bytes are compressed - 0 = no compression
+        :param standby_router_ip_address: Router to use if the router stops responding
+        :param instrumentation_interval: Seconds between instrumentation stats reports - 0 = off
         :return:
         """
         self.board_num = board_num
         self.board_type = board_type.lower()
         self.servo_polarity = servo_polarity
         self.router_ip_address = router_ip_address
+        self.iio = iio
 
         self.payload = None
         self.black_gpio_pins = ["P9_11", "P9_12", "P9_13", "P9_14", "P9_15", "P9_16", "P9_17", "P9_18",
@@ -100,10 +120,8 @@ class BeagleBoneBridge:
             self.analog_pin_states.append(entry)
 
         # establish the zeriomq sub and pub sockets
-        if self.router_ip_address == 'None':
-            self.router_ip_address = port_map.port_map['router_ip_address']
-        else:
-            self.router_ip_address = router_ip_address
+        # if not specified, the router is discovered
+        self.router_ip_address = discovery.resolve_router_ip_address(router_ip_address)
 
         print('\n**************************************')
         print('BeagleBone Black  Bridge - xibb')
@@ -125,10 +143,21 @@ class BeagleBoneBridge:
         # subscribe to broadcast i2c message - i2c messages can also be board specific with A + board number
         self.subscriber.setsockopt(zmq.SUBSCRIBE, 'Q'.encode())
 
-        self.publisher = self.context.socket(zmq.PUB)
-        connect_string = "tcp://" + self.router_ip_address + ':' + port_map.port_map['publish_to_router_port']
+        # large reports may be compressed
+        if compression_threshold:
+            compressor = MessageCompressor(['B' + self.board_num], compression_threshold)
+        else:
+            compressor = None
+
+        # all threads of the bridge publish through a single connection to the router
+        self.publisher_hub = PublisherHub(self.context, self.router_ip_address, compressor=compressor)
+        self.publisher_hub.start()
+        self.publisher = self.publisher_hub.create_publisher()
 
-        self.publisher.connect(connect_string)
+        # reports are stamped with a clock synchronised to the router
+        self.clock = SyncedClock()
+        self.clock_sync = ClockSync(self.context, self.router_ip_address, self.clock, self.publisher, self.board_num)
+        self.clock_sync.start()
 
         # The Xideco protocol message received
         self.payload = None
@@ -143,6 +172,39 @@ class BeagleBoneBridge:
         self.analog_reader = None
         self.sonar = None
 
+        # distance sensor calibration curves that have been loaded - key = sensor name
+        self.calibrations = {}
+
+        # servo and PWM commands are coalesced so that only the latest value for a pin is actuated
+        self.coalescer = CommandCoalescer(max_actuation_rate)
+
+        # commands that need a reply are received through the RPC channel
+        self.rpc_server = rpc.RpcServer(self.context, self.router_ip_address, 'A' + self.board_num, self.rpc_request)
+
+        # if the router stops responding, the bridge moves to the standby router
+        self.failover = RouterFailover(self.router_ip_address, standby_router_ip_address)
+        self.failover.watch(self.subscriber)
+        self.failover.add_callback(self.publisher_hub.reconnect)
+        self.failover.add_callback(self.clock_sync.reconnect)
+        self.failover.add_callback(self.rpc_server.reconnect)
+
+        # heartbeats tell the router that the bridge is running, and how busy it is - see liveness.py
+        self.heartbeat = Heartbeat(self.publisher, 'xibb', self.board_num, queue_depth=self.queue_depth,
+                                   clock=self.clock)
+
+        # command, report and main loop timings - see instrumentation.py
+        self.instrumentation = Instrumentation(self.publisher, 'xibb', self.board_num, self.clock,
+                                               instrumentation_interval)
+
+        # timed actions, such as turning off a tone or stepping a servo sweep, are run from the command loop
+        self.scheduler = ActionScheduler()
+
+        # last angle written to each servo pin - used as the starting point of a sweep
+        self.servo_positions = {}
+
+        # time between servo sweep steps - one 60 Hz servo frame is about 17 ms
+        self.servo_step_time = .02
+
     def setup_analog_pin(self):
         """
         This method validates and configures a pin for analog input
@@ -160,6 +222,9 @@ class BeagleBoneBridge:
         pin_entry = self.analog_pin_states[index]
 
         if self.payload['enable'] == 'Enable':
+            if not self.set_sampling(pin_entry):
+                self.last_problem = '2-2\n'
+                return
             pin_entry['enabled'] = True
             pin_entry['mode'] = 'analog'
             self.analog_pin_states[index] = pin_entry
@@ -168,11 +233,44 @@ class BeagleBoneBridge:
             self.analog_pin_states[index] = pin_entry
 
         if not self.analog_reader:
-            self.analog_reader = AnalogReader(self.board_num, self.analog_pin_states)
+            self.analog_reader = AnalogReader(self.board_num, self.analog_pin_states, self.publisher, self.clock,
+                                              self.iio)
 
             ADC.setup()
             self.analog_reader.start()
 
+    def set_sampling(self, pin_entry):
+        """
+        Set the burst sampling parameters for an analog pin from the optional payload values:
+            rate: samples per second. If not specified, the pin is read and reported every 50 ms.
+            oversample: number of readings averaged for each sample (default 1)
+            block_size: number of samples published in each analog_block message (default 32)
+
+        With IIO sampling, every burst sampled pin shares the device's scan rate, so rate times oversample
+        must be the same for each pin, and must be a rate the device can be set to.
+        :param pin_entry: analog pin state entry
+        :return: False if the rate cannot be used
+        """
+        rate = self.payload.get('rate')
+        if not rate:
+            pin_entry['rate'] = None
+            return True
+
+        oversample = max(1, int(self.payload.get('oversample', 1)))
+        if self.iio:
+            scan_rate = float(rate) * oversample
+            for entry in self.analog_pin_states:
+                if entry is not pin_entry and entry['enabled'] and entry.get('rate') and \
+                        entry['rate'] * entry['oversample'] != scan_rate:
+                    return False
+            if not self.iio.supports_scan_rate(scan_rate):
+                return False
+
+        pin_entry['oversample'] = oversample
+        pin_entry['block_size'] = max(1, int(self.payload.get('block_size', 32)))
+        pin_entry['rate'] = float(rate)
+        return True
+
     def setup_digital_pin(self):
         """
         This method processes the Scratch "Digital Pin" Block that establishes the mode for the pin
@@ -200,6 +298,18 @@ class BeagleBoneBridge:
             pin_entry = self.analog_pin_states[index]
 
             if self.payload['enable'] == 'Enable':
+                # the payload may name the sensor's calibration curve in calibration.cfg
+                sensor = self.payload.get('sensor', DistanceCalibration.DEFAULT_SENSOR)
+                try:
+                    if sensor not in self.calibrations:
+                        self.calibrations[sensor] = DistanceCalibration(sensor)
+                except ValueError:
+                    self.last_problem = '7-2\n'
+                    return
+                pin_entry['calibration'] = self.calibrations[sensor]
+                if not self.set_sampling(pin_entry):
+                    self.last_problem = '7-3\n'
+                    return
                 pin_entry['enabled'] = True
                 pin_entry['mode'] = 'sonar'
                 self.analog_pin_states[index] = pin_entry
@@ -208,7 +318,8 @@ class BeagleBoneBridge:
                 self.analog_pin_states[index] = pin_entry
 
             if not self.analog_reader:
-                self.analog_reader = AnalogReader(self.board_num, self.analog_pin_states)
+                self.analog_reader = AnalogReader(self.board_num, self.analog_pin_states, self.publisher, self.clock,
+                                              self.iio)
 
                 ADC.setup()
                 self.analog_reader.start()
@@ -370,11 +481,12 @@ class BeagleBoneBridge:
         PWM.set_frequency(pin, frequency)
 
         if duration == 0:
+            # play until a tone_off is received - cancel any pending "tone off" for this pin
+            self.scheduler.cancel_key(('tone', pin))
             return
 
-        time.sleep(duration)
-
-        PWM.set_duty_cycle(pin, 0.0)
+        # the scheduler turns the tone off so that the command loop is not blocked while it plays
+        self.scheduler.schedule(duration, PWM.set_duty_cycle, pin, 0.0, key=('tone', pin))
 
     def tone_off(self):
         """
@@ -396,18 +508,19 @@ class BeagleBoneBridge:
             self.last_problem = '6-2\n'
             return
 
+        self.scheduler.cancel_key(('tone', pin))
         PWM.set_duty_cycle(pin, 0.0)
 
     def set_servo_position(self):
 
         """
-        Set a servo position
+        Set a servo position.
+
+        If the payload contains a 'sweep_time' value (in milliseconds), the servo is moved
+        from its last position to the new position in steps spread over that time.
+        The steps are run by the action scheduler, so the command loop is not blocked.
         :return:
         """
-        duty_min = 3
-        duty_max = 14.5
-        duty_span = duty_max - duty_min
-
         self.last_problem = '7-0\n'
 
         pin = self.validate_pin(self.pwm_pins)
@@ -422,12 +535,51 @@ class BeagleBoneBridge:
             self.last_problem = '7-1\n'
             return
 
-        position = int(self.payload['position'])
+        position = float(int(self.payload['position']))
+
+        sweep_time = float(self.payload.get('sweep_time', 0)) / 1000
+        start = self.servo_positions.get(pin)
 
-        angle_f = float(position)
-        duty = 100 - ((angle_f / 180) * duty_span + duty_min)
+        # a new position replaces any sweep in progress for this pin
+        self.scheduler.cancel_key(('servo', pin))
+
+        if sweep_time <= 0 or start is None or start == position:
+            self.move_servo(pin, position)
+            return
+
+        steps = max(1, int(sweep_time / self.servo_step_time))
+        self.sweep_servo(pin, start, position, 1, steps)
+
+    def sweep_servo(self, pin, start, target, step, steps):
+        """
+        Perform one step of a servo sweep and schedule the next one
+        :param pin: PWM pin
+        :param start: Starting angle
+        :param target: Final angle
+        :param step: Step number, 1 through steps
+        :param steps: Total number of steps
+        :return:
+        """
+        self.move_servo(pin, start + (target - start) * step / steps)
+        if step < steps:
+            self.scheduler.schedule(self.servo_step_time, self.sweep_servo, pin, start, target, step + 1, steps,
+                                    key=('servo', pin))
+
+    def move_servo(self, pin, angle):
+        """
+        Set the PWM duty cycle for a servo angle
+        :param pin: PWM pin
+        :param angle: Angle in degrees (0-180)
+        :return:
+        """
+        duty_min = 3
+        duty_max = 14.5
+        duty_span = duty_max - duty_min
+
+        duty = 100 - ((angle / 180) * duty_span + duty_min)
 
         PWM.set_duty_cycle(pin, duty)
+        self.servo_positions[pin] = angle
 
     def validate_pin(self, pin_list):
         """
@@ -464,10 +616,13 @@ class BeagleBoneBridge:
         # pin_state = self.pins[gpio]
         state = GPIO.input(pin)
 
-        digital_reply_msg = umsgpack.packb({u"command": "digital_read", u"pin": pin, u"value": str(state)})
+        report_time = self.clock.now()
+        digital_reply_msg = self.instrumentation.pack({u"command": "digital_read", u"pin": pin, u"value": str(state),
+                                                       u"time": report_time})
 
         envelope = ("B" + self.board_num).encode()
         self.publisher.send_multipart([envelope, digital_reply_msg])
+        self.instrumentation.published(report_time)
 
     def run_bb_bridge(self):
         """
@@ -482,23 +637,89 @@ class BeagleBoneBridge:
             # noinspection PyBroadException
             try:
                 z = self.subscriber.recv_multipart(zmq.NOBLOCK)
-                self.payload = umsgpack.unpackb(z[1])
-                # print("[%s] %s" % (z[0], self.payload))
-
-                command = self.payload['command']
-                if command == 'i2c_request':
-                    time.sleep(.001)
-                    continue
-                elif command in self.command_dict:
-                    self.command_dict[command]()
+                payload = unpack_message(z)
+                self.heartbeat.message()
+                # print("[%s] %s" % (z[0], payload))
+
+                if z[0] == HEARTBEAT_TOPIC:
+                    self.router_heartbeat(payload)
+                elif payload['command'] == 'i2c_request':
+                    # i2c requests are performed by xibbi2c - the periodic work below must still run
+                    pass
                 else:
-                    print("can't execute unknown command", str(command))
-                    # time.sleep(.001)
+                    for payload in self.coalescer.submit(z[0], payload):
+                        self.dispatch_command(payload)
+                        # time.sleep(.001)
             except KeyboardInterrupt:
                 self.cleanup()
                 sys.exit(0)
             except zmq.error.Again:
                 time.sleep(.001)
+            # move to the standby router if the router has stopped responding
+            self.failover.check()
+            # publish a heartbeat when due
+            self.heartbeat.tick(self.coalescer.dropped + self.publisher.dropped)
+            self.instrumentation.loop_pass()
+            # execute commands received through the RPC channel
+            self.rpc_server.process_requests()
+            # actuate any coalesced commands whose rate limit has expired
+            for payload in self.coalescer.due():
+                self.dispatch_command(payload)
+            # run any timed actions that are due
+            self.scheduler.run_pending()
+
+    def dispatch_command(self, payload):
+        """
+        Execute a single Xideco protocol command
+        :param payload: The unpacked command message
+        :return:
+        """
+        self.payload = payload
+        command = self.payload['command']
+        if command in self.command_dict:
+            self.instrumentation.dispatch(command, self.command_dict[command])
+        else:
+            print("can't execute unknown command", str(command))
+
+    def queue_depth(self):
+        """
+        :return: The number of commands waiting to be executed
+        """
+        return len(self.coalescer.pending)
+
+    def router_heartbeat(self, payload):
+        """
+        Process a router heartbeat, and report any gap in the heartbeats
+        :param payload: The heartbeat message
+        :return:
+        """
+        report = self.failover.heartbeat(payload)
+        if report:
+            report[u"board"] = self.board_num
+            print('No router heartbeats for ' + str(round(report['duration'], 1)) +
+                  ' seconds - messages may have been lost')
+            self.publisher.send_multipart([("B" + self.board_num).encode(), umsgpack.packb(report)])
+
+    def rpc_request(self, payload):
+        """
+        Execute a command received through the RPC channel, and reply with its outcome
+        :param payload: The unpacked command message
+        :return: reply
+        """
+        if payload.get('command') == 'instrumentation':
+            return self.instrumentation.rpc_request(payload)
+        if payload.get('command') not in self.command_dict:
+            return rpc.error_reply(rpc.UNKNOWN_COMMAND, str(payload.get('command')))
+
+        # acknowledged commands are not rate limited, but are executed after the commands waiting for their pin
+        commands = self.coalescer.immediate(self.rpc_server.service, payload)
+        for command in commands[:-1]:
+            self.dispatch_command(command)
+        if self.last_problem:
+            self.report_problem()
+
+        self.dispatch_command(payload)
+        return rpc.problem_reply(self.last_problem)
 
     def cleanup(self):
         GPIO.cleanup()
@@ -507,124 +728,216 @@ class BeagleBoneBridge:
 
 class AnalogReader(threading.Thread):
     """
-    This class handles the pcf8591 YL 40 Module analog to digital conversion module
+    This class handles the BeagleBone analog inputs.
+
+    Pins without a sampling rate are read once every 50 ms and reported with analog_read messages.
+
+    Pins with a sampling rate are burst sampled. Each sample is the average of 'oversample' readings.
+    Samples are collected into blocks of 'block_size' samples and each block is published as one
+    analog_block message. If an IIOBufferedADC is supplied, burst samples are taken from the
+    kernel's IIO buffer instead of being read one at a time.
     """
 
-    def __init__(self, board_num, pin_states):
+    def __init__(self, board_num, pin_states, publisher, clock, iio=None):
         """
 
         :param board_num: board number
         :param pin_states: analog pin state table
+        :param publisher: The bridge's HubPublisher
+        :param clock: The bridge's SyncedClock, used to stamp reports
+        :param iio: Optional IIOBufferedADC used for burst sampling
         :return: nothing is returned
         """
         super().__init__()
 
         self.board_num = board_num
         self.pin_states = pin_states
+        self.iio = iio
+        self.publisher = publisher
+        self.clock = clock
 
-        self.context = zmq.Context()
+        self.envelope = ("B" + self.board_num).encode()
 
-        self.publisher = self.context.socket(zmq.PUB)
-        connect_string = "tcp://" + port_map.port_map['router_ip_address'] + ':' + port_map.port_map[
-            'reporter_publisher_port']
+        # time between single reading reports
+        self.report_interval = 0.05
 
-        self.publisher.connect(connect_string)
+        # burst sampling state for each pin being burst sampled - key = pin
+        self.bursts = {}
 
     # noinspection PyMethodMayBeStatic
-    def convert_to_distance(self, raw_data):
-        distance = None
-        value = raw_data / 1000 * 2
-        if value > 2.45:
-            distance = 10
-        if value < .4:
-            distance = 80
-        elif 2.083 <= value <= 2.45:
-            distance = 12
-        elif 1.811 <= value <= 2.083:
-            distance = 14
-        elif 1.620 <= value <= 1.811:
-            distance = 16
-        elif 1.461 <= value <= 1.620:
-            distance = 18
-        elif 1.310 <= value <= 1.461:
-            distance = 20
-        elif 1.211 <= value <= 1.310:
-            distance = 22
-        elif 1.099 <= value <= 1.211:
-            distance = 24
-        elif 1.022 <= value <= 1.099:
-            distance = 26
-        elif .965 <= value <= 1.022:
-            distance = 28
-        elif .907 <= value <= .965:
-            distance = 30
-        elif .851 <= value <= .907:
-            distance = 32
-        elif .8 <= value <= .851:
-            distance = 34
-        elif .757 <= value <= .8:
-            distance = 36
-        elif .720 <= value <= .757:
-            distance = 38
-        elif .695 <= value <= .720:
-            distance = 40
-        elif .656 <= value <= .695:
-            distance = 42
-        elif .639 <= value <= .656:
-            distance = 44
-        elif .612 <= value <= .639:
-            distance = 46
-        elif .593 <= value <= .612:
-            distance = 48
-        elif .564 <= value <= .593:
-            distance = 50
-        elif .543 <= value <= .564:
-            distance = 52
-        elif .522 <= value <= .543:
-            distance = 54
-        elif .503 <= value <= .522:
-            distance = 56
-        elif .483 <= value <= .503:
-            distance = 58
-        elif .464 <= value <= .483:
-            distance = 60
-        elif .445 <= value <= .464:
-            distance = 62
-        elif .447 <= value <= .445:
-            distance = 64
-        elif .428 <= value <= .447:
-            distance = 66
-        elif .427 <= value <= .428:
-            distance = 68
-        elif .413 <= value <= .427:
-            distance = 70
-
-        return distance
+    def convert_to_distance(self, raw_data, calibration):
+        """
+        Convert a raw reading from a distance sensor to centimeters
+        :param raw_data: Raw ADC reading
+        :param calibration: DistanceCalibration for the sensor
+        :return: distance in centimeters
+        """
+        return calibration.convert(raw_data)
+
+    def report_single_readings(self):
+        """
+        Read and report each enabled pin that is not being burst sampled
+        :return:
+        """
+        value = None
+        for entry in self.pin_states:
+            if entry['enabled'] and not entry.get('rate'):
+                if entry['mode'] == 'analog':
+                    value = ADC.read(entry['pin'])
+                    value = round(value, 4)
+
+                elif entry['mode'] == 'sonar':
+                    value = ADC.read_raw(entry['pin'])
+                    value = self.convert_to_distance(value, entry['calibration'])
+
+                digital_reply_msg = umsgpack.packb({u"command": "analog_read", u"pin": entry['pin'],
+                                                    u"value": str(value), u"time": self.clock.now()})
+
+                self.publisher.send_multipart([self.envelope, digital_reply_msg])
+
+    def sample_bursts(self, now):
+        """
+        Take any burst samples that are due and publish full blocks
+        :param now: Current time.monotonic() value
+        :return: Time of the next polled sample, or None if no pins are polled
+        """
+        next_due = None
+        iio_channels = set()
+        scan_rate = None
+
+        for entry in self.pin_states:
+            pin = entry['pin']
+            if not entry['enabled'] or not entry.get('rate'):
+                self.bursts.pop(pin, None)
+                continue
+
+            burst = self.bursts.get(pin)
+            if not burst:
+                burst = {'samples': array.array('H'), 'start': now, 'next_sample': now, 'pending': []}
+                self.bursts[pin] = burst
+
+            oversample = entry.get('oversample', 1)
+
+            if self.iio:
+                iio_channels.add(IIOBufferedADC.CHANNELS[pin])
+                scan_rate = entry['rate'] * oversample
+                continue
+
+            period = 1.0 / entry['rate']
+
+            # if sampling has fallen behind, skip the missed samples rather than trying to catch up
+            if now - burst['next_sample'] > period:
+                burst['next_sample'] = now
+
+            while burst['next_sample'] <= now:
+                total = 0
+                for x in range(oversample):
+                    total += ADC.read_raw(pin)
+                burst['samples'].append(int(round(total / oversample)))
+                burst['next_sample'] += period
+
+            if len(burst['samples']) >= entry.get('block_size', 32):
+                self.publish_block(entry, burst, now)
+
+            if next_due is None or burst['next_sample'] < next_due:
+                next_due = burst['next_sample']
+
+        if self.iio:
+            if iio_channels != set(self.iio.channels) or (iio_channels and scan_rate != self.iio.scan_rate):
+                self.iio.configure(iio_channels, scan_rate)
+            if iio_channels:
+                self.sample_iio(now)
+
+        return next_due
+
+    def sample_iio(self, now):
+        """
+        Retrieve samples from the IIO buffer, average them and publish full blocks. The IIO counts are
+        converted to the millivolts returned by ADC.read_raw, so blocks are the same whichever way they are sampled.
+        :param now: Current time.monotonic() value
+        :return:
+        """
+        data = self.iio.read()
+        for entry in self.pin_states:
+            burst = self.bursts.get(entry['pin'])
+            if not burst:
+                continue
+
+            oversample = entry.get('oversample', 1)
+            pending = burst['pending']
+            pending.extend(data.get(IIOBufferedADC.CHANNELS[entry['pin']], ()))
+
+            # average complete groups of samples and keep any partial group for the next read
+            usable = len(pending) - len(pending) % oversample
+            for x in range(0, usable, oversample):
+                burst['samples'].append(int(round(sum(pending[x:x + oversample]) *
+                                                  IIOBufferedADC.MILLIVOLTS_PER_COUNT / oversample)))
+            del pending[:usable]
+
+            if len(burst['samples']) >= entry.get('block_size', 32):
+                self.publish_block(entry, burst, now)
+
+    def publish_block(self, entry, burst, now):
+        """
+        Publish a block of samples and start a new block.
+
+        Analog pins are published as raw samples, in the millivolts of ADC.read_raw, packed as little endian
+        unsigned 16 bit integers.
+        Sonar pins are converted to distances and packed as 32 bit floats. The time is that of the start of the block.
+        :param entry: pin state entry
+        :param burst: burst state for the pin
+        :param now: Current time.monotonic() value
+        :return:
+        """
+        samples = burst['samples']
+        elapsed = now - burst['start']
+        if elapsed:
+            rate = round(len(samples) / elapsed, 1)
+        else:
+            rate = entry['rate']
+
+        msg = {u"command": "analog_block", u"pin": entry['pin'], u"mode": entry['mode'], u"rate": rate,
+               u"oversample": entry.get('oversample', 1), u"time": self.clock.from_monotonic(burst['start'])}
+
+        if entry['mode'] == 'sonar':
+            distances = array.array('f', entry['calibration'].convert_block(samples))
+            if sys.byteorder != 'little':
+                distances.byteswap()
+            msg[u"distances"] = distances.tobytes()
+        else:
+            if sys.byteorder != 'little':
+                samples.byteswap()
+            msg[u"samples"] = samples.tobytes()
+
+        self.publisher.send_multipart([self.envelope, umsgpack.packb(msg)])
+
+        burst['samples'] = array.array('H')
+        burst['start'] = now
 
     def run(self):
         """
         Continuously monitor the A/D
         :return:
         """
-        value = None
+        next_report = time.monotonic()
         while True:
             try:
-                for entry in self.pin_states:
-                    if entry['enabled']:
-                        if entry['mode'] == 'analog':
-                            value = ADC.read(entry['pin'])
-                            value = round(value, 4)
-
-                        elif entry['mode'] == 'sonar':
-                            value = ADC.read_raw(entry['pin'])
-                            value = self.convert_to_distance(value)
-
-                        digital_reply_msg = umsgpack.packb({u"command": "analog_read", u"pin": entry['pin'],
-                                                            u"value": str(value)})
-
-                        envelope = ("B" + self.board_num).encode()
-                        self.publisher.send_multipart([envelope, digital_reply_msg])
-                time.sleep(0.05)
+                now = time.monotonic()
+                if now >= next_report:
+                    self.report_single_readings()
+                    next_report = now + self.report_interval
+
+                next_due = self.sample_bursts(now)
+
+                # sleep until the next sample or report is due
+                if next_due is None or next_due > next_report:
+                    next_due = next_report
+                delay = next_due - time.monotonic()
+                if self.iio and self.bursts:
+                    # poll the IIO buffer frequently enough that it does not overflow
+                    delay = min(delay, .005)
+                if delay > 0:
+                    time.sleep(delay)
             except KeyboardInterrupt:
                 sys.exit(0)
 
@@ -636,6 +949,15 @@ def beaglebone_bridge():
     parser.add_argument("-b", dest="board_number", default="1", help="Board Number - 1 through 10")
     parser.add_argument("-p", dest="polarity", default="p", help="Servo polarity: p or n")
     parser.add_argument('-r', dest='router_ip_address', default='None', help='Router IP Address')
+    parser.add_argument('-s', dest='standby_router_ip_address', default='None', help='Standby Router IP Address')
+    parser.add_argument('-x', dest='instrumentation_interval', default='0',
+                        help='Publish instrumentation stats every this many seconds - 0 = off')
+    parser.add_argument('-m', dest='max_actuation_rate', default='50',
+                        help='Maximum servo/PWM updates per second for each pin - 0 = no limit')
+    parser.add_argument('-z', dest='compression_threshold', default='0',
+                        help='Compress reports of at least this many bytes - 0 = no compression')
+    parser.add_argument('-i', dest='iio_device', default='None',
+                        help='IIO device number used for buffered analog sampling - e.g. 0')
 
     # parser.add_argument("-t", dest="board_type", default="black", help="black or green")
 
@@ -651,8 +973,18 @@ def beaglebone_bridge():
         servo_polarity = 0
 
     router_ip_address = args.router_ip_address
+    max_actuation_rate = float(args.max_actuation_rate)
+
+    if args.iio_device == 'None':
+        iio = None
+    else:
+        iio = IIOBufferedADC('/dev/iio:device' + args.iio_device,
+                             '/sys/bus/iio/devices/iio:device' + args.iio_device)
 
-    bb_bridge = BeagleBoneBridge(board_num, board_type, servo_polarity, router_ip_address)
+    bb_bridge = BeagleBoneBridge(board_num, board_type, servo_polarity, router_ip_address, max_actuation_rate,
+                                 iio, int(args.compression_threshold), args.standby_router_ip_address,
+                                 float(args.instrumentation_interval))
+    bb_bridge.instrumentation.install_signal_handlers()
 
     try:
         bb_bridge.run_bb_bridge()
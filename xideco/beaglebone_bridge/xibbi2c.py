@@ -21,6 +21,7 @@ Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 """
 
 import argparse
+import collections
 import time
 # noinspection PyPackageRequirements
 import signal
@@ -30,6 +31,146 @@ import umsgpack
 
 from Adafruit_I2C import Adafruit_I2C
 
+# router discovery, compressed messages and clock synchronisation are supported if the xideco package is
+# installed for this interpreter
+try:
+    from xideco.common import discovery
+    from xideco.common.compression import unpack_message
+    from xideco.common.clock_sync import ClockSync, SyncedClock
+except ImportError:
+    discovery = None
+    unpack_message = None
+    SyncedClock = None
+
+
+class I2CBusScheduler:
+    """
+    This class orders the i2c transactions of the BeagleBone i2c bridge.
+
+    Requests are queued per device address, and the devices take turns: each call to next_request
+    returns a request for the next device in round robin order that has one waiting. A device may
+    be given a maximum transaction rate, and is skipped until its next transaction is allowed.
+
+    A write_pointer request followed by a read_device request for the same device is combined into
+    one write_read request, which is performed as a single repeated start transfer.
+    """
+
+    def __init__(self):
+        # request queues - key = device address
+        self.queues = collections.OrderedDict()
+
+        # minimum time between transactions - key = device address
+        self.min_intervals = {}
+
+        # earliest time of the next transaction - key = device address
+        self.next_allowed = {}
+
+        # address served last, for the round robin
+        self.last_address = None
+
+        # statistics since the last call to stats
+        self.busy_time = 0.0
+        self.transactions = collections.defaultdict(int)
+        self.merged = 0
+        self.stats_start = time.time()
+
+    def add(self, request):
+        """
+        Queue a request
+        :param request: i2c_request payload
+        :return:
+        """
+        address = request['device_address']
+        if address not in self.queues:
+            self.queues[address] = collections.deque()
+        self.queues[address].append(request)
+
+    def set_rate(self, address, rate):
+        """
+        Limit the transaction rate of a device
+        :param address: device address
+        :param rate: maximum transactions per second, or 0 for no limit
+        :return:
+        """
+        if rate:
+            self.min_intervals[address] = 1.0 / rate
+        else:
+            self.min_intervals.pop(address, None)
+
+    def next_request(self, now):
+        """
+        Remove and return the next request to perform
+        :param now: current time.time()
+        :return: A request, or None if no device has a request that may be performed now
+        """
+        addresses = list(self.queues)
+        if self.last_address in self.queues:
+            start = addresses.index(self.last_address) + 1
+            addresses = addresses[start:] + addresses[:start]
+
+        for address in addresses:
+            queue = self.queues[address]
+            if not queue or self.next_allowed.get(address, 0) > now:
+                continue
+
+            request = queue.popleft()
+            if request['cmd'] == 'write_pointer' and queue and queue[0]['cmd'] == 'read_device':
+                read = queue.popleft()
+                request = dict(read, cmd='write_read', register=request['register'])
+                self.merged += 1
+
+            self.last_address = address
+            return request
+        return None
+
+    def next_due(self, now):
+        """
+        :param now: current time.time()
+        :return: Seconds until a rate limited request may be performed, or None if none are waiting
+        """
+        due = None
+        for address, queue in self.queues.items():
+            if queue:
+                wait = max(0.0, self.next_allowed.get(address, 0) - now)
+                if due is None or wait < due:
+                    due = wait
+        return due
+
+    def completed(self, address, start, end):
+        """
+        Record a completed transaction
+        :param address: device address
+        :param start: time the transaction started
+        :param end: time the transaction ended
+        :return:
+        """
+        self.busy_time += end - start
+        self.transactions[address] += 1
+        if address in self.min_intervals:
+            self.next_allowed[address] = start + self.min_intervals[address]
+
+    def stats(self):
+        """
+        Return the bus statistics since the last call and start a new period
+        :return: A dictionary containing the fraction of time the bus was in use, transactions per device
+                 address, the number of merged transfers and the number of queued requests.
+        """
+        now = time.time()
+        elapsed = now - self.stats_start
+        if elapsed > 0:
+            utilisation = round(self.busy_time / elapsed, 4)
+        else:
+            utilisation = 0.0
+
+        stats = {u"utilisation": utilisation, u"transactions": dict(self.transactions), u"merged": self.merged,
+                 u"queued": sum(len(queue) for queue in self.queues.values())}
+
+        self.busy_time = 0.0
+        self.transactions = collections.defaultdict(int)
+        self.merged = 0
+        self.stats_start = now
+        return stats
+
 
 # noinspection PyMethodMayBeStatic,PyUnresolvedReferences,PyUnresolvedReferences,PyUnresolvedReferences
 class BeagleBoneI2CBridge:
@@ -39,19 +180,22 @@ class BeagleBoneI2CBridge:
 
     """
 
-    def __init__(self, board_num, router_ip_address, publisher_socket, subscriber_socket):
+    def __init__(self, board_num, router_ip_address, publisher_socket, subscriber_socket, stats_interval=5.0):
         """
         :param board_num: System Board Number (1-10)
-        :param board_type: "black" or "green"
-        :param servo_polarity: 1 or 0
+        :param router_ip_address: IP address of xideco router
+        :param publisher_socket: router publisher port
+        :param subscriber_socket: router subscriber port
+        :param stats_interval: seconds between i2c_stats reports, or 0 for no reports
         :return:
         """
         self.board_num = board_num
         if router_ip_address == 'None':
-            print('You must use the -r command line option to specify the router IP Address')
-            sys.exit(0)
-        else:
-            self.router_ip_address = router_ip_address
+            if not discovery:
+                print('You must use the -r command line option to specify the router IP Address')
+                sys.exit(0)
+            router_ip_address = discovery.resolve_router_ip_address(router_ip_address)
+        self.router_ip_address = router_ip_address
 
         self.publisher_socket = publisher_socket
         self.subscriber_socket = subscriber_socket
@@ -81,18 +225,48 @@ class BeagleBoneI2CBridge:
 
         self.publisher.connect(connect_string)
 
+        # FIFO reads are stamped with a clock synchronised to the router, as the other bridges' reports are.
+        # The board's clock_stats are reported by xibb, so none are published here.
+        if SyncedClock:
+            self.clock = SyncedClock()
+            self.clock_sync = ClockSync(self.context, self.router_ip_address, self.clock)
+            self.clock_sync.start()
+            self.now = self.clock.now
+        else:
+            self.now = time.time
+
         # The Xideco protocol message received
         self.payload = None
 
         self.i2c_handle_dict = {}
 
+        self.bus_scheduler = I2CBusScheduler()
+        self.stats_interval = stats_interval
+        self.next_stats = time.time() + stats_interval
+
+        self.poller = zmq.Poller()
+        self.poller.register(self.subscriber, zmq.POLLIN)
+
     def i2c_request(self):
         cmd = self.payload['cmd']
         addr = self.payload['device_address']
 
-        if cmd == 'init':
+        if cmd == 'batch':
+            # perform each request of the batch in order
+            batch = self.payload
+            for item in batch['requests']:
+                self.payload = dict(item)
+                self.payload.setdefault('device_address', addr)
+                if 'request_id' in batch:
+                    self.payload.setdefault('request_id', batch['request_id'])
+                self.i2c_request()
+            self.payload = batch
+        elif cmd == 'init':
             handle = Adafruit_I2C(addr)
             self.i2c_handle_dict.update({addr: handle})
+            # optional limit on the device's transactions per second
+            if 'max_rate' in self.payload:
+                self.bus_scheduler.set_rate(addr, self.payload['max_rate'])
         elif cmd == 'write_byte':
             # get handle
             value = self.payload['value']
@@ -104,45 +278,144 @@ class BeagleBoneI2CBridge:
             handle = self.i2c_handle_dict[addr]
             register = self.payload['register']
             data = handle.readList(register, num_bytes)
-            time.sleep(.0001)
             self.report_i2c_data(data)
+        elif cmd == 'write_pointer':
+            # write a register number without data - normally followed by read_device
+            handle = self.i2c_handle_dict[addr]
+            handle.bus.write_byte(addr, self.payload['register'])
+        elif cmd == 'read_device':
+            # read without first writing a register number
+            handle = self.i2c_handle_dict[addr]
+            data = [handle.bus.read_byte(addr) for x in range(self.payload['num_bytes'])]
+            self.report_i2c_data(data)
+        elif cmd == 'write_read':
+            # write a register number and read with a repeated start
+            handle = self.i2c_handle_dict[addr]
+            data = handle.readList(self.payload['register'], self.payload['num_bytes'])
+            self.report_i2c_data(data)
+        elif cmd == 'read_fifo':
+            self.read_fifo(self.i2c_handle_dict[addr])
         else:
             print('unknown cmd')
 
-    def report_i2c_data(self, data):
+    def read_fifo(self, handle):
+        """
+        Read all of the entries waiting in a device's FIFO and publish them as one reply.
+        The number of entries is read from the status register, and each entry is then read
+        with a block read of num_bytes. The reply is stamped with the time at which the status
+        register was read, which is the time of the newest entry.
+
+        Adafruit_I2C returns -1 for a failed transaction. If the status register cannot be read,
+        problem 10-1 is reported instead of a reply. If an entry cannot be read, the problem is
+        reported and the entries already read are published.
+        :param handle: Adafruit_I2C device
+        :return:
+        """
+        num_bytes = self.payload['num_bytes']
+        register = self.payload['register']
+        mask = self.payload.get('mask', 0x3f)
+
+        status = handle.readU8(self.payload['status_register'])
+        # the newest entry is the one that arrived before the status was read
+        read_time = self.now()
+        if status < 0:
+            self.report_problem('10-1\n')
+            return
+        entries = status & mask
+
+        data = []
+        for x in range(entries):
+            entry = handle.readList(register, num_bytes)
+            if entry == -1:
+                self.report_problem('10-1\n')
+                break
+            data.extend(entry)
+
+        self.report_i2c_data(data, {u"frames": len(data) // num_bytes, u"time": read_time})
+
+    def report_i2c_data(self, data, extra=None):
         # create a topic specific to the board number of this board
         envelope = ("B" + self.board_num).encode()
 
-        msg = umsgpack.packb({u"command": "i2c_reply", u"board": self.board_num, u"data": data})
+        # the data is sent as bytes, as it is by the other bridges
+        reply = {u"command": "i2c_reply", u"board": self.board_num, u"data": bytes(bytearray(data))}
+        if extra:
+            reply.update(extra)
+        # echo the request id so the requester can match the reply to its request
+        if 'request_id' in self.payload:
+            reply[u"request_id"] = self.payload['request_id']
+        msg = umsgpack.packb(reply)
 
         self.publisher.send_multipart([envelope, msg])
 
+    def report_problem(self, problem):
+        """
+        Publish a problem report for a failed i2c transaction
+        :param problem: problem code
+        :return:
+        """
+        envelope = ("B" + self.board_num).encode()
+        msg = umsgpack.packb({u"command": "problem", u"board": self.board_num, u"problem": problem})
+        self.publisher.send_multipart([envelope, msg])
+
+    def report_stats(self):
+        """
+        Publish the bus statistics
+        :return:
+        """
+        envelope = ("B" + self.board_num).encode()
+        stats = self.bus_scheduler.stats()
+        stats.update({u"command": "i2c_stats", u"board": self.board_num})
+        self.publisher.send_multipart([envelope, umsgpack.packb(stats)])
+
     def run_bb_i2c_bridge(self):
         """
-        Start up the bridge
+        Start up the bridge.
+
+        Received requests are queued with the bus scheduler, and the scheduler decides which
+        request is performed next. While there is nothing to do, the loop waits on the subscriber.
         :return:
         """
-        # self.pi.set_mode(11, pigpio.INPUT)
-        # cb1 = self.pi.callback(11, pigpio.EITHER_EDGE, self.cbf)
         while True:
-            # noinspection PyBroadException
             try:
-                z = self.subscriber.recv_multipart(zmq.NOBLOCK)
-                self.payload = umsgpack.unpackb(z[1])
-                # print("[%s] %s" % (z[0], self.payload))
-
-                # print(self.payload)
-                command = self.payload['command']
-                if command == 'i2c_request':
-                    self.i2c_request()
-                else:
-                    # print("can't execute unknown command'")
-                    pass
-                time.sleep(.0001)
+                # queue all of the requests that have arrived
+                while True:
+                    try:
+                        z = self.subscriber.recv_multipart(zmq.NOBLOCK)
+                    except zmq.error.Again:
+                        break
+                    if unpack_message:
+                        payload = unpack_message(z)
+                    else:
+                        payload = umsgpack.unpackb(z[1])
+                    if payload['command'] == 'i2c_request':
+                        self.bus_scheduler.add(payload)
+
+                now = time.time()
+                self.payload = self.bus_scheduler.next_request(now)
+                if self.payload:
+                    try:
+                        self.i2c_request()
+                    except (KeyError, IOError) as e:
+                        print('i2c request failed: ' + str(e))
+                    self.bus_scheduler.completed(self.payload['device_address'], now, time.time())
+
+                if self.stats_interval and now >= self.next_stats:
+                    self.report_stats()
+                    self.next_stats = now + self.stats_interval
+
+                if not self.payload:
+                    # wait for a request, a rate limited device or the next statistics report
+                    timeout = self.bus_scheduler.next_due(now)
+                    if self.stats_interval:
+                        if timeout is None or timeout > self.next_stats - now:
+                            timeout = self.next_stats - now
+                    if timeout is None:
+                        self.poller.poll()
+                    else:
+                        self.poller.poll(max(timeout, 0) * 1000)
             except KeyboardInterrupt:
                 sys.exit(0)
-            except zmq.error.Again:
-                time.sleep(.0001)
 
 
 def beaglebone_i2c_bridge():
@@ -153,6 +426,8 @@ def beaglebone_i2c_bridge():
     parser.add_argument("-p", dest="publisher_socket", default="43124", help="Publisher Socket Number")
     parser.add_argument("-s", dest="subscriber_socket", default="43125", help="Publisher Socket Number")
     parser.add_argument("-r", dest="router_ip_address", default="None", help="Router IP Address")
+    parser.add_argument("-u", dest="stats_interval", default="5",
+                        help="Seconds between i2c bus utilisation reports - 0 = no reports")
 
     args = parser.parse_args()
 
@@ -162,7 +437,7 @@ def beaglebone_i2c_bridge():
     subscriber_socket = args.subscriber_socket
 
     bb_bridge = BeagleBoneI2CBridge(board_num, router_ip_address, publisher_socket,
-                                    subscriber_socket)
+                                    subscriber_socket, float(args.stats_interval))
     try:
         bb_bridge.run_bb_i2c_bridge()
     except KeyboardInterrupt:
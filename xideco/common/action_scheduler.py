@@ -0,0 +1,171 @@
+"""
+Copyright (c) 2016 Alan Yorinks All right reserved.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public
+License as published by the Free Software Foundation; either
+version 3 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+import heapq
+import itertools
+import time
+
+
+class ActionScheduler:
+    """
+    This class schedules timed actions (turning a tone off, releasing a servo, etc.) without
+    blocking the bridge's command loop.
+
+    Actions are kept in a heap ordered by their due time. The bridge calls run_pending on every
+    pass of its main loop, so the actions run on the same thread as the command handlers and no
+    locking of the hardware library is required.
+
+    Each action may be given a key, for example ('tone', pin). Scheduling a new action with the same
+    key cancels the previous one, so a new tone on a pin replaces the pending "tone off" for that pin,
+    while actions for other pins are left untouched.
+    """
+
+    def __init__(self):
+        # heap entries are [due time, sequence number, key, callback, args]
+        self.heap = []
+
+        # key to heap entry map for keyed actions
+        self.keyed = {}
+
+        # sequence numbers keep entries with the same due time in scheduling order
+        self.sequence = itertools.count()
+
+    def schedule(self, delay, callback, *args, key=None):
+        """
+        Schedule a callback to be called after delay seconds.
+        :param delay: Delay in seconds
+        :param callback: Function to call
+        :param args: Arguments for the callback
+        :param key: Optional key - a pending action with the same key is cancelled
+        :return: The scheduled entry. It may be passed to cancel.
+        """
+        if key is not None:
+            self.cancel_key(key)
+
+        entry = [time.monotonic() + delay, next(self.sequence), key, callback, args]
+        heapq.heappush(self.heap, entry)
+
+        if key is not None:
+            self.keyed[key] = entry
+        return entry
+
+    def cancel(self, entry):
+        """
+        Cancel a scheduled action. Cancelled entries are discarded when they reach the top of the heap.
+        :param entry: An entry returned by schedule
+        :return:
+        """
+        entry[3] = None
+        if entry[2] is not None and self.keyed.get(entry[2]) is entry:
+            del self.keyed[entry[2]]
+
+    def cancel_key(self, key):
+        """
+        Cancel the pending action with the specified key, if any.
+        :param key: Action key
+        :return: True if an action was cancelled
+        """
+        entry = self.keyed.pop(key, None)
+        if entry:
+            entry[3] = None
+            return True
+        return False
+
+    def pending(self, key):
+        """
+        Check if an action with the specified key is waiting to run
+        :param key: Action key
+        :return: True or False
+        """
+        return key in self.keyed
+
+    def next_due(self):
+        """
+        :return: Number of seconds until the next action is due, or None if nothing is scheduled
+        """
+        while self.heap and self.heap[0][3] is None:
+            heapq.heappop(self.heap)
+        if not self.heap:
+            return None
+        return max(0.0, self.heap[0][0] - time.monotonic())
+
+    def run_pending(self):
+        """
+        Run all actions that are due. Call this from the bridge's main loop.
+        :return: Number of actions that were run
+        """
+        if not self.heap:
+            return 0
+
+        now = time.monotonic()
+        count = 0
+        while self.heap and self.heap[0][0] <= now:
+            due, seq, key, callback, args = heapq.heappop(self.heap)
+            if callback is None:
+                continue
+            if key is not None and self.keyed.get(key) is not None and self.keyed[key][1] == seq:
+                del self.keyed[key]
+            callback(*args)
+            count += 1
+        return count
+
+
+def benchmark(number_of_commands=2000, concurrent_actions=8, action_time=.5):
+    """
+    Compare command latency for a loop that sleeps for timed actions with one that uses the scheduler.
+
+    Each simulated command takes no time to execute. Every 100th command starts a timed action
+    (such as a tone) on one of several pins.
+
+    :param number_of_commands: Number of simulated commands
+    :param concurrent_actions: Number of pins with timed actions
+    :param action_time: Length of each timed action in seconds
+    :return:
+    """
+    interval = .001
+
+    def measure(blocking):
+        scheduler = ActionScheduler()
+        latencies = []
+        start = time.monotonic()
+        for x in range(number_of_commands):
+            # the command was received at its arrival time
+            arrival = start + x * interval
+            now = time.monotonic()
+            if now < arrival:
+                time.sleep(arrival - now)
+            scheduler.run_pending()
+            latencies.append(time.monotonic() - arrival)
+            if x % 100 == 0:
+                pin = (x // 100) % concurrent_actions
+                if blocking:
+                    time.sleep(action_time)
+                else:
+                    scheduler.schedule(action_time, lambda: None, key=('tone', pin))
+        latencies.sort()
+        return latencies[len(latencies) // 2], latencies[int(len(latencies) * .99)], latencies[-1]
+
+    for name, blocking in (('sleeping loop', True), ('scheduler', False)):
+        median, p99, worst = measure(blocking)
+        print('{0:>14}: median {1:.3f} ms, 99th percentile {2:.3f} ms, worst {3:.3f} ms'.format(
+            name, median * 1000, p99 * 1000, worst * 1000))
+
+
+if __name__ == '__main__':
+    # scaled down so that the sleeping loop completes in a reasonable time
+    benchmark(number_of_commands=1000, action_time=.2)
@@ -0,0 +1,285 @@
+"""
+Copyright (c) 2016 Alan Yorinks All right reserved.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public
+License as published by the Free Software Foundation; either
+version 3 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+"""
+This file contains clock synchronisation with the router.
+
+A SyncedClock is the local monotonic clock plus an offset, so it never jumps when the computer's
+wall clock is changed. A ClockSync thread estimates the offset to the router's clock, in the same
+way as NTP: the router is pinged through the RPC channel, and for each ping
+
+    offset = router time - (send time + receive time) / 2
+
+The ping with the shortest round trip gives the best estimate. Once synchronised, corrections are
+slewed in gradually, so the clock keeps running forwards. Bridges stamp their reports with the
+clock, so reports from different boards can be put in order and compared.
+"""
+
+import math
+import threading
+import time
+
+import umsgpack
+
+from xideco.common.rpc import RpcClient, RpcError
+
+# Python 2, used by the BeagleBone i2c bridge, has no monotonic clock, so the wall clock stands in for it there
+_monotonic = getattr(time, 'monotonic', time.time)
+
+
+class SyncedClock:
+    """
+    This class is a monotonic clock corrected to the router's clock. It may be used by any thread.
+
+    Until it is synchronised, it follows the local wall clock.
+    """
+
+    def __init__(self, max_slew=.0005, step_threshold=1.0):
+        """
+        :param max_slew: Maximum rate at which corrections are applied, in seconds per second
+        :param step_threshold: Corrections larger than this, in seconds, are applied at once
+        :return:
+        """
+        self.max_slew = max_slew
+        self.step_threshold = step_threshold
+
+        self.lock = threading.Lock()
+
+        # offset from time.monotonic() to the router's clock
+        self.offset = time.time() - _monotonic()
+        self.target_offset = self.offset
+        self.last_adjustment = _monotonic()
+
+        self.synchronised = False
+
+        # the latest time returned by now
+        self.last_time = 0
+
+    def _current_offset(self, monotonic):
+        """
+        Move the offset towards its target, no faster than max_slew. Called with the lock held.
+        :param monotonic: Current time.monotonic() value
+        :return: The offset
+        """
+        error = self.target_offset - self.offset
+        if error:
+            step = (monotonic - self.last_adjustment) * self.max_slew
+            if abs(error) <= step:
+                self.offset = self.target_offset
+            elif error > 0:
+                self.offset += step
+            else:
+                self.offset -= step
+        self.last_adjustment = monotonic
+        return self.offset
+
+    def now(self):
+        """
+        :return: The current time in seconds
+        """
+        with self.lock:
+            monotonic = _monotonic()
+            now = monotonic + self._current_offset(monotonic)
+            if now < self.last_time:
+                now = self.last_time
+            self.last_time = now
+            return now
+
+    def from_monotonic(self, monotonic):
+        """
+        Convert a time.monotonic() value to the clock's time
+        :param monotonic: time.monotonic() value
+        :return: time in seconds
+        """
+        with self.lock:
+            return monotonic + self._current_offset(_monotonic())
+
+    def adjust(self, offset):
+        """
+        Apply a new estimate of the offset to the router's clock.
+
+        The first estimate, and any that differ from the current offset by more than the step
+        threshold, are applied at once. Others are slewed in.
+        :param offset: offset from time.monotonic() to the router's clock
+        :return: The correction in seconds
+        """
+        with self.lock:
+            correction = offset - self._current_offset(_monotonic())
+            self.target_offset = offset
+            if not self.synchronised or abs(correction) > self.step_threshold:
+                self.offset = offset
+                self.last_time = 0
+            self.synchronised = True
+            return correction
+
+
+class ClockSync(threading.Thread):
+    """
+    This class keeps a SyncedClock synchronised to the router, and publishes clock_stats reports:
+
+        {'command': 'clock_stats', 'board': board number, 'synchronised': True or False,
+         'offset': router clock - local wall clock, 'delay': shortest round trip, 'jitter': spread of
+         the offset estimates, 'correction': latest correction, 'time': clock time}
+
+    All values are in seconds.
+    """
+
+    def __init__(self, context, router_ip_address, clock, publisher=None, board_num=None, interval=10.0,
+                 pings=8):
+        """
+        :param context: ZeroMQ context
+        :param router_ip_address: router IP address
+        :param clock: SyncedClock to synchronise
+        :param publisher: Optional publisher for clock_stats reports
+        :param board_num: Board number used for the report topic
+        :param interval: Seconds between synchronisations
+        :param pings: Number of pings per synchronisation
+        :return:
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.context = context
+        self.router_ip_address = router_ip_address
+        self.clock = clock
+        self.publisher = publisher
+        self.board_num = board_num
+        self.interval = interval
+        self.pings = pings
+
+        self.stats = {u"command": u"clock_stats", u"board": board_num, u"synchronised": False}
+
+    def synchronise(self, client):
+        """
+        Ping the router and adjust the clock
+        :param client: RpcClient
+        :return: True if the router answered
+        """
+        estimates = []
+        for x in range(self.pings):
+            sent = _monotonic()
+            try:
+                reply = client.call('router', {u"command": u"ping"}, .5)
+            except RpcError:
+                continue
+            received = _monotonic()
+            estimates.append((received - sent, reply['time'] - (sent + received) / 2))
+
+        if not estimates:
+            return False
+
+        delay, offset = min(estimates)
+        jitter = math.sqrt(sum((estimate - offset) ** 2 for rtt, estimate in estimates) / len(estimates))
+        correction = self.clock.adjust(offset)
+
+        self.stats.update({u"synchronised": True, u"offset": offset - (time.time() - _monotonic()),
+                           u"delay": delay, u"jitter": jitter, u"correction": correction})
+        return True
+
+    def reconnect(self, router_ip_address):
+        """
+        Synchronise with another router from the next synchronisation on. This may be called
+        from any thread.
+        :param router_ip_address: IP address of the new router
+        :return:
+        """
+        self.router_ip_address = router_ip_address
+
+    def run(self):
+        client = RpcClient(self.context, self.router_ip_address)
+        while True:
+            if client.router_ip_address != self.router_ip_address:
+                client.reconnect(self.router_ip_address)
+            synchronised = self.synchronise(client)
+            if self.publisher:
+                self.stats[u"time"] = self.clock.now()
+                self.publisher.send_multipart([("B" + self.board_num).encode(), umsgpack.packb(self.stats)])
+
+            # retry quickly until the router has answered
+            if synchronised or self.clock.synchronised:
+                time.sleep(self.interval)
+            else:
+                time.sleep(1)
+
+
+class TickMapper:
+    """
+    This class converts 32 bit microsecond tick counts, such as pigpio ticks, to clock times.
+
+    A reference pair of a tick and a clock time is taken every refresh interval, and the tick rate
+    is measured between successive references, so drift of the tick counter is corrected for.
+    """
+
+    def __init__(self, clock, read_tick, refresh_interval=5.0):
+        """
+        :param clock: SyncedClock
+        :param read_tick: Function returning the current tick
+        :param refresh_interval: Seconds between reference pairs
+        :return:
+        """
+        self.clock = clock
+        self.read_tick = read_tick
+        self.refresh_interval = refresh_interval
+
+        # (tick, clock time, clock seconds per tick microsecond)
+        self.reference = None
+        self.next_refresh = 0
+
+    def refresh(self):
+        """
+        Take a new reference pair
+        :return:
+        """
+        before = self.clock.now()
+        tick = self.read_tick()
+        after = self.clock.now()
+        now = (before + after) / 2
+
+        rate = 1e-6
+        previous = self.reference
+        if previous:
+            elapsed_ticks = (tick - previous[0]) & 0xffffffff
+            # only use the measured rate if it is plausible
+            if elapsed_ticks and abs((now - previous[1]) / elapsed_ticks - 1e-6) < 1e-9:
+                rate = (now - previous[1]) / elapsed_ticks
+        self.reference = (tick, now, rate)
+
+    def refresh_if_due(self):
+        """
+        Take a new reference pair if the refresh interval has passed. Call this periodically.
+        :return:
+        """
+        now = _monotonic()
+        if now >= self.next_refresh:
+            self.refresh()
+            self.next_refresh = now + self.refresh_interval
+
+    def time_of(self, tick):
+        """
+        :param tick: tick count
+        :return: The clock time of the tick
+        """
+        if not self.reference:
+            self.refresh()
+        reference_tick, reference_time, rate = self.reference
+
+        ticks = (tick - reference_tick) & 0xffffffff
+        # ticks before the reference
+        if ticks >= 0x80000000:
+            ticks -= 0x100000000
+        return reference_time + ticks * rate
@@ -0,0 +1,134 @@
+"""
+Copyright (c) 2016 Alan Yorinks All right reserved.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public
+License as published by the Free Software Foundation; either
+version 3 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+import collections
+import time
+
+
+class CommandCoalescer:
+    """
+    This class provides a "latest value wins" stage that sits in front of a bridge's command dispatcher.
+
+    Commands that set an output level (servo position, PWM value) are held per (topic, command, pin).
+    If a newer command for the same key arrives before the previous one has been actuated,
+    the older one is simply replaced. Each key is actuated no faster than max_rate times per second.
+
+    All other commands are passed straight through, after any pending command for the same pin
+    has been released, so that the original command ordering for a pin is preserved.
+    """
+
+    # commands where only the most recent value is of interest
+    COALESCED_COMMANDS = ('analog_write', 'set_servo_position')
+
+    def __init__(self, max_rate=50):
+        """
+        :param max_rate: Maximum number of actuations per second for each (topic, command, pin).
+                         A value of 0 disables rate limiting, but still coalesces queued commands.
+        :return:
+        """
+        if max_rate:
+            self.min_interval = 1.0 / max_rate
+        else:
+            self.min_interval = 0
+
+        # pending commands waiting to be actuated - key = (topic, command, pin)
+        self.pending = collections.OrderedDict()
+
+        # time of the last actuation for each key
+        self.last_actuation = {}
+
+        # number of commands that were replaced by a newer value before being actuated
+        self.dropped = 0
+
+    def submit(self, topic, payload):
+        """
+        Hand a newly received command to the coalescer.
+        :param topic: The message topic (identifies the board)
+        :param payload: The unpacked Xideco protocol message
+        :return: A list of payloads that should be dispatched now, in order
+        """
+        command = payload.get('command')
+        pin = payload.get('pin')
+
+        if command not in self.COALESCED_COMMANDS or pin is None:
+            # release anything still waiting for this pin so that it is executed ahead of this command
+            ready = []
+            if self.pending:
+                for key in [k for k in self.pending if k[0] == topic and k[2] == pin]:
+                    ready.append(self.pending.pop(key))
+            ready.append(payload)
+            return ready
+
+        key = (topic, command, pin)
+        now = time.monotonic()
+
+        if key in self.pending:
+            # a newer value replaces the one that is waiting
+            self.dropped += 1
+            self.pending[key] = payload
+            return []
+
+        if now - self.last_actuation.get(key, 0) >= self.min_interval:
+            self.last_actuation[key] = now
+            return [payload]
+
+        self.pending[key] = payload
+        return []
+
+    def immediate(self, topic, payload):
+        """
+        Prepare a command that must be executed now, such as one that is acknowledged.
+        Commands waiting for the same pin are released ahead of it, except a waiting command
+        that it replaces.
+        :param topic: The message topic (identifies the board)
+        :param payload: The unpacked Xideco protocol message
+        :return: A list of payloads that should be dispatched now, in order, ending with payload
+        """
+        command = payload.get('command')
+        pin = payload.get('pin')
+
+        ready = []
+        if self.pending:
+            for key in [k for k in self.pending if k[0] == topic and k[2] == pin]:
+                if key[1] == command:
+                    self.dropped += 1
+                    del self.pending[key]
+                else:
+                    ready.append(self.pending.pop(key))
+
+        if command in self.COALESCED_COMMANDS and pin is not None:
+            self.last_actuation[(topic, command, pin)] = time.monotonic()
+        ready.append(payload)
+        return ready
+
+    def due(self):
+        """
+        Retrieve the pending commands whose rate limit interval has expired.
+        This should be called on every pass of the bridge's main loop.
+        :return: A list of payloads that should be dispatched now
+        """
+        if not self.pending:
+            return []
+
+        now = time.monotonic()
+        ready = []
+        for key in list(self.pending):
+            if now - self.last_actuation.get(key, 0) >= self.min_interval:
+                self.last_actuation[key] = now
+                ready.append(self.pending.pop(key))
+        return ready
@@ -0,0 +1,169 @@
+"""
+Copyright (c) 2016 Alan Yorinks All right reserved.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public
+License as published by the Free Software Foundation; either
+version 3 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+"""
+This file contains optional message compression.
+
+A compressed message has a third frame holding the COMPRESSED flag:
+
+    [topic, zlib compressed umsgpack payload, b'z']
+
+Uncompressed messages are unchanged, so a receiver that uses unpack_message accepts both.
+Publishers compress only the topics they are configured for, and only payloads of at least the
+threshold size - small messages gain little and would cost CPU time on every receiver. A payload
+that does not get smaller is sent uncompressed.
+
+Run this file to see the bytes saved and the CPU time used for typical payloads.
+
+This file is also used by the Python 2 BeagleBone i2c bridge and must remain Python 2 compatible.
+"""
+
+import zlib
+
+import umsgpack
+
+COMPRESSED = b'z'
+
+DEFAULT_THRESHOLD = 256
+DEFAULT_LEVEL = 1
+
+# messages are small, so a small window and little memory are used. Setting up the default 32K
+# window and 256K of state takes several times longer than compressing a typical message.
+WINDOW_BITS = 12
+MEMORY_LEVEL = 4
+
+
+def compress_payload(payload, level=DEFAULT_LEVEL):
+    """
+    :param payload: bytes
+    :param level: zlib compression level
+    :return: The compressed payload
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, WINDOW_BITS, MEMORY_LEVEL)
+    return compressor.compress(payload) + compressor.flush()
+
+
+class MessageCompressor:
+    """
+    This class compresses the messages of selected topics
+    """
+
+    def __init__(self, topics=('',), threshold=DEFAULT_THRESHOLD, level=DEFAULT_LEVEL):
+        """
+        :param topics: Topic prefixes to compress. The default compresses all topics.
+        :param threshold: Minimum payload size in bytes to compress
+        :param level: zlib compression level, 1 (fastest) to 9 (smallest)
+        :return:
+        """
+        self.topics = tuple(topic.encode() if not isinstance(topic, bytes) else topic for topic in topics)
+        self.threshold = threshold
+        self.level = level
+
+        # totals for the compressed messages
+        self.messages = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def compress(self, frames):
+        """
+        Compress a message if it qualifies
+        :param frames: [topic, umsgpack payload]
+        :return: The frames to send
+        """
+        topic, payload = frames[0], frames[1]
+        if len(payload) < self.threshold or not topic.startswith(self.topics):
+            return frames
+
+        compressed = compress_payload(payload, self.level)
+        if len(compressed) >= len(payload):
+            return frames
+
+        self.messages += 1
+        self.bytes_in += len(payload)
+        self.bytes_out += len(compressed)
+        return [topic, compressed, COMPRESSED]
+
+
+def unpack_message(frames):
+    """
+    Unpack the payload of a received message, decompressing it if necessary
+    :param frames: received message frames
+    :return: The payload
+    """
+    if len(frames) > 2 and frames[2] == COMPRESSED:
+        return umsgpack.unpackb(zlib.decompress(frames[1]))
+    return umsgpack.unpackb(frames[1])
+
+
+def benchmark(repeat=2000):
+    """
+    Measure the bytes saved and the time taken to compress and decompress typical payloads
+    :param repeat: number of times each payload is compressed
+    :return:
+    """
+    import array
+    import math
+    import random
+    import time
+
+    random.seed(1)
+
+    samples = array.array('H', [int(2048 + 300 * math.sin(x / 20.0) + random.randint(-4, 4)) for x in range(256)])
+    fifo = bytes(bytearray(random.choice([0, 1, 254, 255]) if x % 2 else random.randint(0, 255)
+                           for x in range(32 * 6)))
+    ticks = array.array('I', [1000000 + x * 1000 + random.randint(0, 20) for x in range(64)])
+
+    payloads = [
+        ('i2c_reply, 6 bytes', {u'command': u'i2c_reply', u'board': u'1', u'data': b'\x01\x00\xfe\xff\x00\x01',
+                                u'request_id': 1, u'time': time.time()}),
+        ('analog_block, 256 samples', {u'command': u'analog_block', u'pin': u'P9_39', u'mode': u'analog',
+                                       u'rate': 1000.0, u'oversample': 4, u'time': time.time(),
+                                       u'samples': samples.tobytes()}),
+        ('ADXL345 FIFO block, 32 frames', {u'board': 1, u'frames': 32, u'rate': 3200, u'time': time.time(),
+                                           u'data': fifo}),
+        ('edge_batch, 64 edges', {u'command': u'edge_batch', u'board': u'1', u'gpios': b'\x11' * 64,
+                                  u'levels': b'\x00\x01' * 32, u'ticks': ticks.tobytes(), u'time': time.time()}),
+        ('batch of 16 servo commands', {u'command': u'batch', u'requests': [
+            {u'command': u'set_servo_position', u'pin': str(x % 4 + 4), u'position': str(x * 10)}
+            for x in range(16)]}),
+    ]
+
+    print('{0:32}{1:>8}{2:>8}{3:>8}{4:>14}{5:>16}'.format('payload', 'bytes', 'zlib 1', 'saved', 'compress us',
+                                                         'decompress us'))
+    for name, payload in payloads:
+        packed = umsgpack.packb(payload)
+
+        start = time.perf_counter()
+        for x in range(repeat):
+            compressed = compress_payload(packed)
+        compress_time = (time.perf_counter() - start) / repeat
+
+        start = time.perf_counter()
+        for x in range(repeat):
+            zlib.decompress(compressed)
+        decompress_time = (time.perf_counter() - start) / repeat
+
+        saved = 100.0 * (len(packed) - len(compressed)) / len(packed)
+        print('{0:32}{1:>8}{2:>8}{3:>7.0f}%{4:>14.1f}{5:>16.1f}'.format(
+            name, len(packed), len(compressed), saved, compress_time * 1e6, decompress_time * 1e6))
+
+    print('\nPayloads smaller than the threshold ({0} bytes) are not compressed.'.format(DEFAULT_THRESHOLD))
+
+
+if __name__ == '__main__':
+    benchmark()
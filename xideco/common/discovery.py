@@ -0,0 +1,181 @@
+"""
+Copyright (c) 2016 Alan Yorinks All right reserved.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public
+License as published by the Free Software Foundation; either
+version 3 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+"""
+This file contains router discovery.
+
+The router runs a DiscoveryResponder. A component looking for the router broadcasts a probe
+on the discovery port, and also sends one to the local computer. The router answers, and the
+address the answer came from is the router's address. The last address found is cached, so it
+can be used if the router cannot be reached when the component starts.
+
+This file is also used by the Python 2 BeagleBone i2c bridge and must remain Python 2 compatible.
+"""
+
+import os
+import select
+import socket
+import threading
+import time
+
+from xideco.data_files.port_map import port_map
+
+PROBE = b'XIDECO_DISCOVER'
+ANSWER = b'XIDECO_ROUTER'
+
+CACHE_FILE = os.path.join(os.path.expanduser('~'), '.xideco_router')
+
+
+def local_ip_address():
+    """
+    Determine the IP address of this computer on the local network, without sending anything.
+    :return: IP address string, or 127.0.0.1 if the computer has no network route
+    """
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        # connecting a UDP socket only selects a route - no packets are sent
+        s.connect(('10.255.255.255', 1))
+        return s.getsockname()[0]
+    except (socket.error, OSError):
+        return '127.0.0.1'
+    finally:
+        s.close()
+
+
+class DiscoveryResponder(threading.Thread):
+    """
+    This class answers discovery probes. It is run by the router.
+    """
+
+    def __init__(self, port=None, answering=None):
+        """
+        :param port: UDP port to listen on. Defaults to the port map discovery_port.
+        :param answering: Optional function returning whether probes should be answered now
+        :return:
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.answering = answering
+
+        if port is None:
+            port = int(port_map.port_map['discovery_port'])
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('', port))
+
+    def run(self):
+        while True:
+            try:
+                data, address = self.sock.recvfrom(64)
+            except (socket.error, OSError):
+                return
+            if data == PROBE and (self.answering is None or self.answering()):
+                try:
+                    self.sock.sendto(ANSWER, address)
+                except (socket.error, OSError):
+                    # an answer that cannot be sent must not stop the responder
+                    pass
+
+
+def read_cached_address():
+    """
+    :return: The cached router address, or None
+    """
+    try:
+        with open(CACHE_FILE) as f:
+            return f.read().strip() or None
+    except (IOError, OSError):
+        return None
+
+
+def write_cached_address(address):
+    """
+    Cache a router address
+    :param address: router IP address
+    :return:
+    """
+    try:
+        with open(CACHE_FILE, 'w') as f:
+            f.write(address)
+    except (IOError, OSError):
+        pass
+
+
+def discover_router(timeout=1.0, port=None):
+    """
+    Look for the router.
+    :param timeout: Maximum time in seconds to wait for an answer
+    :param port: UDP discovery port. Defaults to the port map discovery_port.
+    :return: The address of the router that answered first, or None
+    """
+    if port is None:
+        port = int(port_map.port_map['discovery_port'])
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        for destination in ('<broadcast>', '127.0.0.1'):
+            try:
+                sock.sendto(PROBE, (destination, port))
+            except (socket.error, OSError):
+                # there may be no broadcast route
+                pass
+
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0 or not select.select([sock], [], [], remaining)[0]:
+                return None
+            try:
+                data, address = sock.recvfrom(64)
+            except (socket.error, OSError):
+                return None
+            if data == ANSWER:
+                return address[0]
+    finally:
+        sock.close()
+
+
+def resolve_router_ip_address(router_ip_address=None, timeout=1.0):
+    """
+    Determine the router address for a component.
+
+    An address given by the user is used as is. Otherwise the router is discovered, and the address
+    found is cached. If no router answers, the cached address is used, and failing that, the port
+    map router_ip_address.
+    :param router_ip_address: Address given by the user, or None or 'None' if none was given
+    :param timeout: Maximum time in seconds to wait for the router to answer
+    :return: router IP address
+    """
+    if router_ip_address and router_ip_address != 'None':
+        return router_ip_address
+
+    address = discover_router(timeout)
+    if address:
+        write_cached_address(address)
+        return address
+
+    address = read_cached_address()
+    if address:
+        print('No router answered - using the last known router address')
+        return address
+
+    print('No router answered - using the port map router address')
+    return port_map.port_map['router_ip_address']
@@ -0,0 +1,307 @@
+"""
+Copyright (c) 2016 Alan Yorinks All right reserved.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public
+License as published by the Free Software Foundation; either
+version 3 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+"""
+This file contains router heartbeats and client failover.
+
+Each router publishes a heartbeat on the H topic several times a second. Its RouterHeartbeat
+publishes through the router's own publish port, so a heartbeat that arrives shows that the
+whole routing path is working.
+
+A component watches the heartbeats with a RouterFailover. A second router may be run as a hot
+standby (xirt -p <primary address>). If the heartbeats stop, the component's connections are
+moved to the standby. If no standby is configured, ZeroMQ reconnects to the same router when it
+restarts. Either way, when heartbeats resume the component reports the gap in which its messages
+may have been lost:
+
+    {'command': 'router_gap', 'router': router address, 'start': time of the last heartbeat before
+     the gap, 'end': time the heartbeats resumed, 'duration': seconds, 'missed': heartbeats missed}
+
+Subscriptions are kept by the ZeroMQ SUB socket and are sent again to the new router when it
+connects.
+
+A standby router's heartbeats say whether it can see the primary router. A standby does not answer
+discovery while the primary is running, and a component that finds itself on a standby whose
+primary is running moves back to the primary, so the components are not split between the two.
+"""
+
+import threading
+import time
+
+import umsgpack
+import zmq
+
+from xideco.data_files.port_map import port_map
+
+HEARTBEAT_TOPIC = b'H'
+
+HEARTBEAT_INTERVAL = .25
+HEARTBEAT_TIMEOUT = 1.0
+
+
+class RouterHeartbeat(threading.Thread):
+    """
+    This class publishes the router's heartbeat. It is run by the router.
+    """
+
+    def __init__(self, context, router_ip_address, role='primary', interval=HEARTBEAT_INTERVAL):
+        """
+        :param context: ZeroMQ context
+        :param router_ip_address: Address of this router, included in each heartbeat
+        :param role: 'primary' or 'standby'
+        :param interval: Seconds between heartbeats
+        :return:
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.router_ip_address = router_ip_address
+        self.role = role
+        self.interval = interval
+
+        # set by a standby router - True while the primary router's heartbeats are being received
+        self.peer_alive = None
+
+        self.publisher = context.socket(zmq.PUB)
+        self.publisher.setsockopt(zmq.LINGER, 0)
+        self.publisher.connect('tcp://127.0.0.1:' + port_map.port_map['publish_to_router_port'])
+
+    def run(self):
+        sequence = 0
+        next_beat = time.monotonic()
+        while True:
+            heartbeat = {u"command": u"router_heartbeat", u"router": self.router_ip_address, u"role": self.role,
+                         u"sequence": sequence, u"time": time.time()}
+            if self.peer_alive is not None:
+                heartbeat[u"peer_alive"] = self.peer_alive
+            try:
+                self.publisher.send_multipart([HEARTBEAT_TOPIC, umsgpack.packb(heartbeat)])
+            except zmq.error.ContextTerminated:
+                self.publisher.close()
+                return
+            sequence += 1
+
+            next_beat += self.interval
+            delay = next_beat - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_beat = time.monotonic()
+
+
+class PeerMonitor(threading.Thread):
+    """
+    This class is run by a standby router. It watches the primary router's heartbeats, and if a
+    message handler is given, passes it every message the primary routes for the given topics, so
+    the standby's last value cache is kept up to date.
+    """
+
+    def __init__(self, context, primary_ip_address, heartbeat, topics=(), handler=None,
+                 timeout=HEARTBEAT_TIMEOUT):
+        """
+        :param context: ZeroMQ context
+        :param primary_ip_address: primary router address
+        :param heartbeat: The standby's RouterHeartbeat, which reports whether the primary is alive
+        :param topics: Topic prefixes to pass to the handler
+        :param handler: Function called with the frames of each message
+        :param timeout: Seconds without a heartbeat after which the primary is considered down
+        :return:
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.primary_ip_address = primary_ip_address
+        self.heartbeat = heartbeat
+        self.handler = handler
+        self.timeout = timeout
+
+        self.subscriber = context.socket(zmq.SUB)
+        self.subscriber.setsockopt(zmq.LINGER, 0)
+        self.subscriber.connect('tcp://' + primary_ip_address + ':' + port_map.port_map['subscribe_to_router_port'])
+        self.subscriber.setsockopt(zmq.SUBSCRIBE, HEARTBEAT_TOPIC)
+        for topic in topics:
+            self.subscriber.setsockopt(zmq.SUBSCRIBE, topic)
+
+    def run(self):
+        last_heartbeat = None
+        while True:
+            try:
+                if self.subscriber.poll(self.timeout * 1000):
+                    frames = self.subscriber.recv_multipart()
+                    if frames[0] == HEARTBEAT_TOPIC:
+                        last_heartbeat = time.monotonic()
+                    elif self.handler:
+                        self.handler(frames)
+            except zmq.error.ContextTerminated:
+                self.subscriber.close()
+                return
+
+            alive = last_heartbeat is not None and time.monotonic() - last_heartbeat < self.timeout
+            if alive != self.heartbeat.peer_alive:
+                if alive:
+                    print('Primary router ' + self.primary_ip_address + ' is running')
+                else:
+                    print('Primary router ' + self.primary_ip_address + ' is not responding')
+                self.heartbeat.peer_alive = alive
+
+
+class RouterFailover:
+    """
+    This class watches the router heartbeats for a component and moves the component's
+    connections to the standby router when the heartbeats stop.
+
+    Nothing happens until the first heartbeat has been received, so a component connected to
+    a router that does not send heartbeats is not affected.
+    """
+
+    def __init__(self, router_ip_address, standby_ip_address=None, timeout=HEARTBEAT_TIMEOUT):
+        """
+        :param router_ip_address: Address of the router in use
+        :param standby_ip_address: Optional address of the standby router
+        :param timeout: Seconds without a heartbeat after which the router is considered down
+        :return:
+        """
+        self.routers = [router_ip_address]
+        if standby_ip_address and standby_ip_address not in ('None', router_ip_address):
+            self.routers.append(standby_ip_address)
+        self.current = 0
+        self.timeout = timeout
+
+        # functions called with the new router address on failover
+        self.callbacks = []
+
+        self.last_heartbeat = None
+        self.last_heartbeat_time = None
+        self.last_sequence = None
+
+        # from the heartbeats of a standby router - True while it can see the primary router
+        self.peer_alive = None
+
+        # heartbeats missed while the router was responding
+        self.missed = 0
+
+        # start of the current outage, if the router is not responding
+        self.outage = None
+
+    @property
+    def router_ip_address(self):
+        """
+        :return: Address of the router in use
+        """
+        return self.routers[self.current]
+
+    def watch(self, subscriber):
+        """
+        Subscribe to the heartbeats and move the subscriber on failover
+        :param subscriber: The component's SUB socket
+        :return:
+        """
+        subscriber.setsockopt(zmq.SUBSCRIBE, HEARTBEAT_TOPIC)
+        self.add_socket(subscriber, 'subscribe_to_router_port')
+
+    def add_socket(self, socket, port_name):
+        """
+        Move a socket to the new router on failover
+        :param socket: a socket connected to the router
+        :param port_name: port map name of the port it is connected to
+        :return:
+        """
+        def move(old, new):
+            socket.disconnect('tcp://' + old + ':' + port_map.port_map[port_name])
+            socket.connect('tcp://' + new + ':' + port_map.port_map[port_name])
+        self.callbacks.append(move)
+
+    def add_callback(self, callback):
+        """
+        Add a function that moves a connection on failover
+        :param callback: function called with the new router address
+        :return:
+        """
+        self.callbacks.append(lambda old, new: callback(new))
+
+    def heartbeat(self, payload):
+        """
+        Process a received heartbeat
+        :param payload: heartbeat message
+        :return: A router_gap report if the heartbeats have resumed after a gap, else None
+        """
+        now = time.monotonic()
+        report = None
+
+        sequence = payload.get('sequence')
+        if self.outage is not None:
+            duration = now - self.outage[0]
+            report = {u"command": u"router_gap", u"router": self.router_ip_address, u"start": self.outage[1],
+                      u"end": time.time(), u"duration": duration,
+                      u"missed": int(duration / HEARTBEAT_INTERVAL)}
+            self.outage = None
+        elif self.last_sequence is not None and sequence is not None and sequence > self.last_sequence + 1:
+            self.missed += sequence - self.last_sequence - 1
+
+        self.last_sequence = sequence
+        self.last_heartbeat = now
+        self.last_heartbeat_time = time.time()
+        self.peer_alive = payload.get('peer_alive')
+        return report
+
+    def check(self):
+        """
+        Fail over if the router has stopped responding, or return to the primary router if the standby
+        in use reports that the primary is running. Call this periodically.
+        :return: True if the connections were moved to another router
+        """
+        if self.last_heartbeat is None:
+            return False
+        now = time.monotonic()
+
+        if self.current and self.peer_alive:
+            print('Primary router ' + self.routers[0] + ' is running - switching back to it')
+            self.last_heartbeat = now
+            self.last_sequence = None
+            self.switch(0)
+            return True
+
+        if now - self.last_heartbeat < self.timeout:
+            return False
+
+        if self.outage is None:
+            self.outage = (self.last_heartbeat, self.last_heartbeat_time)
+        # give the next router a full timeout to respond
+        self.last_heartbeat = now
+        # a restarted router starts its sequence again
+        self.last_sequence = None
+
+        if len(self.routers) == 1:
+            return False
+
+        print('Router ' + self.router_ip_address + ' is not responding - switching to ' +
+              self.routers[(self.current + 1) % len(self.routers)])
+        self.switch((self.current + 1) % len(self.routers))
+        return True
+
+    def switch(self, index):
+        """
+        Move the connections to another router
+        :param index: index of the router in routers
+        :return:
+        """
+        old = self.router_ip_address
+        self.current = index
+        self.peer_alive = None
+        for callback in self.callbacks:
+            callback(old, self.router_ip_address)
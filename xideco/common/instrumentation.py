@@ -0,0 +1,321 @@
+"""
+Copyright (c) 2016 Alan Yorinks All right reserved.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public
+License as published by the Free Software Foundation; either
+version 3 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+"""
+This file contains timing instrumentation for the bridges.
+
+When enabled, a bridge measures:
+
+    dispatch  - the time taken to execute each command, per command
+    latency   - the time from an input event to the publishing of its report, from the report's time stamp
+    serialize - the time taken to pack reports
+    loop      - the time between passes of the bridge's main loop, which is how long a newly arrived
+                message may wait before it is read
+
+Every interval, the timings are published on the S topic and started afresh:
+
+    {'command': 'stats', 'component': name/board, 'board': board number, 'interval': seconds, 'time': time stamp,
+     'dispatch': {command: timing, ...}, 'latency': timing, 'serialize': timing, 'loop': timing}
+
+    timing = {'count': n, 'mean': seconds, 'max': seconds, 'p50': seconds, 'p90': seconds, 'p99': seconds}
+
+Percentiles are the upper bound of the power of 2 microsecond bucket the percentile falls in.
+
+Instrumentation is off unless the bridge is started with the -x option. It is switched at runtime with
+SIGUSR1, or with an instrumentation request through the RPC channel:
+
+    {'command': 'instrumentation', 'interval': seconds between stats reports - 0 = off}
+
+SIGUSR2 starts a cProfile profile of the bridge's main thread, and a second SIGUSR2 writes it to a file
+in the temporary directory, for viewing with python -m pstats or snakeviz.
+
+Disabled instrumentation costs one attribute test per measurement.
+"""
+
+import cProfile
+import os
+import signal
+import tempfile
+import threading
+import time
+
+import umsgpack
+
+from xideco.common import rpc
+
+STATS_TOPIC = b'S'
+
+DEFAULT_INTERVAL = 5.0
+
+# bucket n holds times of less than 2 ** n microseconds
+BUCKETS = 32
+
+PERCENTILES = ((u"p50", .5), (u"p90", .9), (u"p99", .99))
+
+
+class Histogram:
+    """
+    This class accumulates times in power of 2 microsecond buckets
+    """
+
+    def __init__(self):
+        self.buckets = [0] * BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        """
+        :param seconds: a time in seconds
+        :return:
+        """
+        bucket = int(seconds * 1e6).bit_length()
+        self.buckets[bucket if bucket < BUCKETS else BUCKETS - 1] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def summary(self):
+        """
+        :return: The count, mean, maximum and percentiles
+        """
+        summary = {u"count": self.count, u"mean": self.total / self.count if self.count else 0.0,
+                   u"max": self.max}
+        for name, fraction in PERCENTILES:
+            target = fraction * self.count
+            seen = 0
+            for bucket, count in enumerate(self.buckets):
+                seen += count
+                if count and seen >= target:
+                    # the maximum is a better bound for the last bucket
+                    summary[name] = min((2 ** bucket) / 1e6, self.max)
+                    break
+            else:
+                summary[name] = 0.0
+        return summary
+
+
+class Instrumentation:
+    """
+    This class collects a bridge's timings and publishes them.
+
+    dispatch, pack and published may be called by any thread. loop_pass is called by the main loop,
+    which publishes the timings.
+    """
+
+    def __init__(self, publisher, name, board_num, clock, interval=0):
+        """
+        :param publisher: The bridge's HubPublisher or PUB socket, used only from the main loop
+        :param name: Program name, e.g. xiab
+        :param board_num: Board number, or None
+        :param clock: Clock that the bridge stamps its reports with, or None
+        :param interval: Seconds between stats reports - 0 = instrumentation off
+        :return:
+        """
+        self.publisher = publisher
+        self.clock = clock
+
+        if board_num is None:
+            self.component = name
+        else:
+            self.component = name + '/' + str(board_num)
+        self.board_num = board_num
+
+        self.lock = threading.Lock()
+        self.enabled = False
+        self.interval = DEFAULT_INTERVAL
+        self.reset()
+        self.enable(interval)
+
+        self.last_pass = None
+
+        self.profile = None
+
+    def reset(self):
+        """
+        Start a new set of timings
+        :return:
+        """
+        with self.lock:
+            self.dispatch_times = {}
+            self.latency = Histogram()
+            self.serialize = Histogram()
+            self.loop = Histogram()
+            self.started = time.monotonic()
+
+    def enable(self, interval=DEFAULT_INTERVAL):
+        """
+        Switch instrumentation on or off
+        :param interval: Seconds between stats reports - 0 = off
+        :return:
+        """
+        if interval:
+            self.interval = interval
+            if not self.enabled:
+                self.reset()
+                self.last_pass = None
+                self.enabled = True
+        else:
+            self.enabled = False
+
+    def toggle(self):
+        """
+        Switch instrumentation on with its last interval, or off
+        :return:
+        """
+        if self.enabled:
+            self.enable(0)
+            print(self.component + ': instrumentation off')
+        else:
+            self.enable(self.interval)
+            print(self.component + ': instrumentation on - stats are published every ' + str(self.interval) +
+                  ' seconds')
+
+    def dispatch(self, command, function):
+        """
+        Execute a command, timing it if instrumentation is enabled
+        :param command: command name
+        :param function: function that executes the command
+        :return:
+        """
+        if not self.enabled:
+            function()
+            return
+        start = time.perf_counter()
+        function()
+        self.dispatched(command, time.perf_counter() - start)
+
+    def dispatched(self, command, seconds):
+        """
+        Record the time taken to execute a command
+        :param command: command name
+        :param seconds: time taken
+        :return:
+        """
+        with self.lock:
+            histogram = self.dispatch_times.get(command)
+            if histogram is None:
+                histogram = self.dispatch_times[command] = Histogram()
+            histogram.add(seconds)
+
+    def pack(self, payload):
+        """
+        Pack a report, timing it if instrumentation is enabled
+        :param payload: report dictionary
+        :return: The packed report
+        """
+        if not self.enabled:
+            return umsgpack.packb(payload)
+        start = time.perf_counter()
+        packed = umsgpack.packb(payload)
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.serialize.add(elapsed)
+        return packed
+
+    def published(self, event_time):
+        """
+        Record the latency of a report that has just been published
+        :param event_time: The report's time stamp
+        :return:
+        """
+        if not self.enabled or not self.clock:
+            return
+        latency = self.clock.now() - event_time
+        with self.lock:
+            self.latency.add(max(latency, 0.0))
+
+    def loop_pass(self):
+        """
+        Time the main loop, and publish the stats when due. Call this on every pass of the main loop.
+        :return:
+        """
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        if self.last_pass is not None:
+            with self.lock:
+                self.loop.add(now - self.last_pass)
+        self.last_pass = now
+
+        if now - self.started >= self.interval:
+            self.publisher.send_multipart([STATS_TOPIC, umsgpack.packb(self.stats())])
+            self.reset()
+
+    def stats(self):
+        """
+        :return: A stats report of the timings since they were last reset
+        """
+        with self.lock:
+            return {u"command": u"stats", u"component": self.component, u"board": self.board_num,
+                    u"interval": time.monotonic() - self.started,
+                    u"time": self.clock.now() if self.clock else time.time(),
+                    u"dispatch": dict((command, histogram.summary())
+                                      for command, histogram in self.dispatch_times.items()),
+                    u"latency": self.latency.summary(), u"serialize": self.serialize.summary(),
+                    u"loop": self.loop.summary()}
+
+    def rpc_request(self, request):
+        """
+        Handle an instrumentation request received through the RPC channel
+        :param request: {'command': 'instrumentation', 'interval': seconds - 0 = off}
+        :return: The stats collected so far, and whether instrumentation is now on
+        """
+        stats = self.stats()
+        self.enable(float(request.get('interval', DEFAULT_INTERVAL)))
+        return rpc.ok_reply(enabled=self.enabled, stats=stats)
+
+    def install_signal_handlers(self):
+        """
+        Switch instrumentation on SIGUSR1, and profile the main thread on SIGUSR2.
+        This must be called from the main thread. The signals are not available on Windows.
+        :return:
+        """
+        if not hasattr(signal, 'SIGUSR1'):
+            return
+
+        # noinspection PyUnusedLocal
+        def toggle(signum, frame):
+            self.toggle()
+
+        # noinspection PyUnusedLocal
+        def profile(signum, frame):
+            self.toggle_profile()
+
+        signal.signal(signal.SIGUSR1, toggle)
+        signal.signal(signal.SIGUSR2, profile)
+
+    def toggle_profile(self):
+        """
+        Start profiling the calling thread, or stop and write the profile to a file
+        :return: The file name, if a profile was written
+        """
+        if self.profile is None:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+            print(self.component + ': profiling started')
+            return None
+
+        self.profile.disable()
+        file_name = os.path.join(tempfile.gettempdir(), '{0}-{1}-{2}.prof'.format(
+            self.component.replace('/', '-'), os.getpid(), time.strftime('%Y%m%d-%H%M%S')))
+        self.profile.dump_stats(file_name)
+        self.profile = None
+        print(self.component + ': profile written to ' + file_name)
+        return file_name
@@ -0,0 +1,288 @@
+"""
+Copyright (c) 2016 Alan Yorinks All right reserved.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public
+License as published by the Free Software Foundation; either
+version 3 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+"""
+This file contains liveness tracking of the Xideco components connected to the router.
+
+Each bridge and XideKit application publishes a heartbeat on the L topic from its main loop, so
+heartbeats stop if the loop stops, even if the process is still running:
+
+    {'command': 'heartbeat', 'component': unique name, 'name': program name, 'board': board number or
+     None, 'interval': seconds between heartbeats, 'sequence': heartbeat count, 'time': time stamp,
+     'queue': commands waiting, 'rate': messages received per second, 'lag': longest main loop pass in
+     seconds, 'dropped': messages dropped}
+
+A bridge stamps its heartbeats with the same synchronized clock as its reports.
+
+The router keeps a LivenessRegistry of the components it has heard from. It may be queried with the
+liveness RPC service, or listed with xils. When a bridge stops, or responds again after stopping, the router
+publishes a problem report for its board, which Scratch shows through xihb:
+
+    9-1 the bridge for the board is not responding
+    9-0 the bridge for the board is responding again
+"""
+
+import os
+import socket
+import threading
+import time
+
+import umsgpack
+import zmq
+
+from xideco.common import rpc
+from xideco.common.compression import unpack_message
+from xideco.data_files.port_map import port_map
+
+LIVENESS_TOPIC = b'L'
+
+HEARTBEAT_INTERVAL = 1.0
+LIVENESS_TIMEOUT = 3.0
+
+# problem codes published for a board when its bridge stops or starts responding
+NOT_RESPONDING = '9-1\n'
+RESPONDING = '9-0\n'
+
+
+class Heartbeat:
+    """
+    This class publishes the heartbeats of a component, with load statistics gathered by its main loop.
+
+    It does not run a thread. tick is called on every pass of the main loop, and message for every
+    message the loop receives.
+    """
+
+    def __init__(self, publisher, name, board=None, interval=HEARTBEAT_INTERVAL, queue_depth=None, clock=None):
+        """
+        :param publisher: A PUB socket or HubPublisher, used only from the main loop
+        :param name: Program name, e.g. xiab
+        :param board: Board number of a bridge
+        :param interval: Seconds between heartbeats
+        :param queue_depth: Optional function returning the number of commands waiting to be executed
+        :param clock: Clock that the component stamps its reports with, e.g. a bridge's SyncedClock, or None
+        :return:
+        """
+        self.publisher = publisher
+        self.interval = interval
+        self.queue_depth = queue_depth
+        self.clock = clock
+
+        # bridges are identified by their board, other components by where they run
+        if board is not None:
+            component = name + '/' + str(board)
+        else:
+            component = name + '/' + socket.gethostname() + '/' + str(os.getpid())
+        self.payload = {u"command": u"heartbeat", u"component": component, u"name": name, u"board": board,
+                        u"interval": interval}
+
+        self.sequence = 0
+        self.messages = 0
+        self.lag = 0
+        self.last_pass = None
+        self.last_heartbeat = time.monotonic()
+
+    def message(self):
+        """
+        Count a received message
+        :return:
+        """
+        self.messages += 1
+
+    def tick(self, dropped=0):
+        """
+        Measure the main loop, and publish a heartbeat when due. Call this on every pass of the loop.
+        :param dropped: Total number of messages the component has dropped
+        :return:
+        """
+        now = time.monotonic()
+        if self.last_pass is not None and now - self.last_pass > self.lag:
+            self.lag = now - self.last_pass
+        self.last_pass = now
+
+        elapsed = now - self.last_heartbeat
+        if elapsed < self.interval:
+            return
+
+        self.payload[u"sequence"] = self.sequence
+        self.payload[u"time"] = self.clock.now() if self.clock else time.time()
+        self.payload[u"rate"] = self.messages / elapsed
+        self.payload[u"lag"] = self.lag
+        self.payload[u"queue"] = self.queue_depth() if self.queue_depth else 0
+        self.payload[u"dropped"] = dropped
+        self.publisher.send_multipart([LIVENESS_TOPIC, umsgpack.packb(self.payload)])
+
+        self.sequence += 1
+        self.messages = 0
+        self.lag = 0
+        self.last_heartbeat = now
+
+
+class LivenessRegistry:
+    """
+    This class keeps the latest heartbeat of each component. It may be used by several threads.
+    """
+
+    def __init__(self, timeout=LIVENESS_TIMEOUT, forget_after=300.0):
+        """
+        :param timeout: Seconds without a heartbeat after which a component is not responding. A component
+                        with a longer heartbeat interval is allowed three of its intervals.
+        :param forget_after: Seconds after which a component that is not responding is removed
+        :return:
+        """
+        self.timeout = timeout
+        self.forget_after = forget_after
+        self.lock = threading.Lock()
+
+        # key = component, value = [latest heartbeat, time.monotonic() it arrived, alive]
+        self.components = {}
+
+        # components that have stopped and not yet returned, including those that have been removed
+        self.stopped = set()
+
+    def heartbeat(self, payload):
+        """
+        Record a heartbeat
+        :param payload: heartbeat message
+        :return: 'new' for the first heartbeat of a component, 'recovered' if the component was not
+                 responding, else None
+        """
+        component = payload['component']
+        with self.lock:
+            known = component in self.components
+            self.components[component] = [payload, time.monotonic(), True]
+            if component in self.stopped:
+                self.stopped.discard(component)
+                return 'recovered'
+            if not known:
+                return 'new'
+            return None
+
+    def expire(self):
+        """
+        Mark the components whose heartbeats have stopped as not responding
+        :return: A list of the latest heartbeats of the components that have stopped since the last call
+        """
+        stopped = []
+        now = time.monotonic()
+        with self.lock:
+            for component, entry in list(self.components.items()):
+                age = now - entry[1]
+                if entry[2] and age > max(self.timeout, 3 * entry[0].get('interval', 0)):
+                    entry[2] = False
+                    self.stopped.add(component)
+                    stopped.append(entry[0])
+                elif not entry[2] and age > self.forget_after:
+                    del self.components[component]
+        return stopped
+
+    def status(self):
+        """
+        :return: A list of the components, sorted by name. Each is its latest heartbeat with 'alive' and
+                 'age', the seconds since the heartbeat arrived.
+        """
+        now = time.monotonic()
+        with self.lock:
+            components = []
+            for component in sorted(self.components):
+                payload, received, alive = self.components[component]
+                status = dict(payload)
+                status[u"alive"] = alive
+                status[u"age"] = now - received
+                components.append(status)
+        return components
+
+    def rpc_request(self, request):
+        """
+        The liveness RPC service. Its command is status, which replies with the components, optionally
+        only those with the given name or board.
+        :param request: request message
+        :return: The reply
+        """
+        if request.get('command') != 'status':
+            return rpc.error_reply(rpc.UNKNOWN_COMMAND, str(request.get('command')))
+        components = self.status()
+        if request.get('name'):
+            components = [status for status in components if status['name'] == request['name']]
+        if request.get('board'):
+            components = [status for status in components if str(status['board']) == str(request['board'])]
+        return rpc.ok_reply(components=components)
+
+
+class LivenessMonitor(threading.Thread):
+    """
+    This class is run by the router. It collects the heartbeats into a registry and publishes a
+    problem report for a board when its bridge stops responding, and when it responds again. A bridge
+    that has just started has no problem to clear, so its first heartbeat is not reported.
+    """
+
+    def __init__(self, context, registry):
+        """
+        :param context: ZeroMQ context
+        :param registry: LivenessRegistry
+        :return:
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.registry = registry
+
+        self.subscriber = context.socket(zmq.SUB)
+        self.subscriber.setsockopt(zmq.LINGER, 0)
+        self.subscriber.connect('tcp://127.0.0.1:' + port_map.port_map['subscribe_to_router_port'])
+        self.subscriber.setsockopt(zmq.SUBSCRIBE, LIVENESS_TOPIC)
+
+        self.publisher = context.socket(zmq.PUB)
+        self.publisher.setsockopt(zmq.LINGER, 0)
+        self.publisher.connect('tcp://127.0.0.1:' + port_map.port_map['publish_to_router_port'])
+
+    def report(self, payload, problem):
+        """
+        Publish a problem report for the board of a bridge
+        :param payload: The bridge's heartbeat
+        :param problem: problem code
+        :return:
+        """
+        if payload.get('board') is None:
+            return
+        msg = {u"command": u"problem", u"board": payload['board'], u"problem": problem,
+               u"component": payload['component']}
+        self.publisher.send_multipart([("B" + str(payload['board'])).encode(), umsgpack.packb(msg)])
+
+    def run(self):
+        try:
+            while True:
+                if self.subscriber.poll(500):
+                    try:
+                        payload = unpack_message(self.subscriber.recv_multipart())
+                    except umsgpack.UnpackException:
+                        continue
+                    if isinstance(payload, dict) and payload.get('command') == 'heartbeat':
+                        change = self.registry.heartbeat(payload)
+                        if change == 'new':
+                            print(payload['component'] + ' is running')
+                        elif change == 'recovered':
+                            print(payload['component'] + ' is responding again')
+                            self.report(payload, RESPONDING)
+
+                for stopped in self.registry.expire():
+                    print(stopped['component'] + ' is not responding')
+                    self.report(stopped, NOT_RESPONDING)
+        except zmq.error.ContextTerminated:
+            self.subscriber.close()
+            self.publisher.close()
+
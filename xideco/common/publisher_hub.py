@@ -0,0 +1,194 @@
+"""
+Copyright (c) 2016 Alan Yorinks All right reserved.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public
+License as published by the Free Software Foundation; either
+version 3 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+import itertools
+import threading
+
+import zmq
+
+from xideco.data_files.port_map import port_map
+
+
+class PublisherHub(threading.Thread):
+    """
+    This class provides a single outbound publisher for all of the threads in a process.
+
+    ZeroMQ sockets may not be shared between threads. Rather than having each thread open its own
+    PUB socket and TCP connection to the router, threads send their messages over an inproc
+    PUSH socket to the hub. The hub thread forwards them to the router through one PUB socket.
+
+    Messages sent by a thread arrive at the router in the order that thread sent them.
+    All messages are subject to the same high water mark. When it is reached, new messages are
+    dropped, just as they would be by a PUB socket.
+
+    If a MessageCompressor is supplied, messages are compressed by the sending thread.
+
+    Messages are not queued for a router that is not connected; they are dropped.
+
+    Each message is forwarded with its own send; the hub saves only the thread switches and connections
+    that per-thread PUB sockets would need. stop() ends the hub thread, which closes the hub's sockets.
+    """
+
+    # inproc endpoint names must be unique within a context
+    hub_numbers = itertools.count()
+
+    def __init__(self, context, router_ip_address, high_water_mark=1000, drain_limit=100, compressor=None):
+        """
+        :param context: ZeroMQ context of the process
+        :param router_ip_address: IP address of xideco router
+        :param high_water_mark: Maximum number of messages queued for each sending thread and for the router
+        :param drain_limit: Maximum number of waiting messages forwarded before a change of router or a
+                            stop is checked for
+        :param compressor: Optional MessageCompressor
+        :return:
+        """
+        super().__init__()
+        self.daemon = True
+
+        self.context = context
+        self.high_water_mark = high_water_mark
+        self.drain_limit = drain_limit
+        self.compressor = compressor
+
+        self.address = 'inproc://publisher_hub_' + str(next(self.hub_numbers))
+
+        # for inproc transports, the endpoint must be bound before anyone connects to it
+        self.collector = self.context.socket(zmq.PULL)
+        self.collector.setsockopt(zmq.RCVHWM, self.high_water_mark)
+        self.collector.bind(self.address)
+
+        self.publisher = self.context.socket(zmq.PUB)
+        self.publisher.setsockopt(zmq.SNDHWM, self.high_water_mark)
+        self.publisher.setsockopt(zmq.IMMEDIATE, 1)
+        self.router_ip_address = router_ip_address
+        self.publisher.connect(self.connect_string(router_ip_address))
+
+        # set by reconnect, and applied by the hub thread, which owns the PUB socket
+        self.new_router_ip_address = None
+
+        # set by stop
+        self.stopping = False
+
+    @staticmethod
+    def connect_string(router_ip_address):
+        """
+        :param router_ip_address: router IP address
+        :return: The address of the router's publish port
+        """
+        return "tcp://" + router_ip_address + ':' + port_map.port_map['publish_to_router_port']
+
+    def reconnect(self, router_ip_address):
+        """
+        Move the hub to another router. This may be called from any thread.
+        :param router_ip_address: IP address of the new router
+        :return:
+        """
+        self.new_router_ip_address = router_ip_address
+
+    def _apply_reconnect(self):
+        """
+        Connect the PUB socket to the router set by reconnect. Called by the hub thread.
+        :return:
+        """
+        router_ip_address, self.new_router_ip_address = self.new_router_ip_address, None
+        self.publisher.disconnect(self.connect_string(self.router_ip_address))
+        self.publisher.connect(self.connect_string(router_ip_address))
+        self.router_ip_address = router_ip_address
+
+    def stop(self):
+        """
+        Stop the hub thread, which closes the hub's sockets. Messages not yet forwarded are dropped.
+        This may be called from any thread.
+        :return:
+        """
+        self.stopping = True
+        if self.is_alive():
+            self.join(1.0)
+
+    def create_publisher(self):
+        """
+        Create a publisher that forwards messages through this hub.
+        :return: A HubPublisher
+        """
+        return HubPublisher(self)
+
+    def run(self):
+        """
+        Forward messages to the router.
+
+        The hub waits for a message to arrive, and then forwards any other waiting messages, up to
+        drain_limit, one send each without blocking. A change of router or a stop is checked for in between.
+        :return:
+        """
+        try:
+            while not self.stopping:
+                if self.new_router_ip_address:
+                    self._apply_reconnect()
+                if not self.collector.poll(100):
+                    continue
+                self.publisher.send_multipart(self.collector.recv_multipart())
+                for x in range(self.drain_limit - 1):
+                    try:
+                        frames = self.collector.recv_multipart(zmq.NOBLOCK)
+                    except zmq.error.Again:
+                        break
+                    self.publisher.send_multipart(frames)
+        except zmq.error.ContextTerminated:
+            pass
+        self.collector.close()
+        self.publisher.close()
+
+
+class HubPublisher:
+    """
+    This class is used in place of a PUB socket by code that publishes through a PublisherHub.
+
+    A single HubPublisher may be used by several threads. Each thread is given its own inproc
+    PUSH socket the first time it sends a message.
+    """
+
+    def __init__(self, hub):
+        """
+        :param hub: The PublisherHub that messages are forwarded to
+        :return:
+        """
+        self.hub = hub
+        self.local = threading.local()
+
+        # number of messages discarded because the high water mark was reached
+        self.dropped = 0
+
+    def send_multipart(self, frames):
+        """
+        Publish a message. The message is dropped if the hub's high water mark has been reached.
+        :param frames: A list of message frames - [topic, payload]
+        :return:
+        """
+        if self.hub.compressor:
+            frames = self.hub.compressor.compress(frames)
+
+        socket = getattr(self.local, 'socket', None)
+        if socket is None:
+            socket = self.hub.context.socket(zmq.PUSH)
+            socket.setsockopt(zmq.SNDHWM, self.hub.high_water_mark)
+            socket.connect(self.hub.address)
+            self.local.socket = socket
+        try:
+            socket.send_multipart(frames, zmq.NOBLOCK)
+        except zmq.error.Again:
+            self.dropped += 1
@@ -0,0 +1,446 @@
+"""
+Copyright (c) 2016 Alan Yorinks All right reserved.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public
+License as published by the Free Software Foundation; either
+version 3 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+"""
+This file contains the request/reply (RPC) channel.
+
+Commands published on the backplane are not acknowledged. The RPC channel runs alongside it and
+gives each request a reply. The router runs an RpcBroker on the rpc_port. Services, such as the
+bridges, connect an RpcServer and register a service name - a bridge registers its command topic,
+e.g. A1. Clients connect an RpcClient and send requests to a service by name.
+
+A request carries a request id, and its reply carries the same id, so a client may have any number
+of requests outstanding and match each reply to its request with a dictionary lookup.
+
+Requests and replies are umsgpack encoded dictionaries. A request is a Xideco protocol command.
+A reply has a status of 'ok' or 'error'. An error reply has an error type and a message, and if
+the error was reported by a bridge, its problem code. The RpcClient raises an RpcError subclass
+for each error type.
+
+Frames, following the identity frame added by the ROUTER socket:
+    client to broker:  REQ, service, request id, request
+    broker to server:  REQ, client identity, request id, request
+    server to broker:  REP, client identity, request id, reply
+    broker to client:  REP, request id, reply
+    server to broker:  REG, service
+"""
+
+import itertools
+import threading
+import time
+
+import umsgpack
+import zmq
+
+from xideco.data_files.port_map import port_map
+
+REQUEST = b'REQ'
+REPLY = b'REP'
+REGISTER = b'REG'
+
+# error types
+BAD_REQUEST = 'bad_request'
+COMMAND_FAILED = 'command_failed'
+TIMEOUT = 'timeout'
+UNKNOWN_COMMAND = 'unknown_command'
+UNKNOWN_SERVICE = 'unknown_service'
+
+
+class RpcError(Exception):
+    """
+    A request failed. Subclasses identify the error type.
+    """
+
+    def __init__(self, error, message='', problem=None):
+        """
+        :param error: error type
+        :param message: description of the error
+        :param problem: Xideco problem code reported by the bridge, if any
+        :return:
+        """
+        if message:
+            super().__init__(error + ': ' + message)
+        else:
+            super().__init__(error)
+        self.error = error
+        self.message = message
+        self.problem = problem
+
+
+class BadRequest(RpcError):
+    pass
+
+
+class CommandFailed(RpcError):
+    pass
+
+
+class RpcTimeout(RpcError):
+    pass
+
+
+class UnknownCommand(RpcError):
+    pass
+
+
+class UnknownService(RpcError):
+    pass
+
+
+ERROR_TYPES = {BAD_REQUEST: BadRequest, COMMAND_FAILED: CommandFailed, TIMEOUT: RpcTimeout,
+               UNKNOWN_COMMAND: UnknownCommand, UNKNOWN_SERVICE: UnknownService}
+
+
+def ok_reply(**values):
+    """
+    :param values: values returned to the client
+    :return: A reply for a successful request
+    """
+    reply = {u'status': u'ok'}
+    reply.update(values)
+    return reply
+
+
+def error_reply(error, message='', problem=None):
+    """
+    :param error: error type
+    :param message: description of the error
+    :param problem: Xideco problem code, if any
+    :return: A reply for a failed request
+    """
+    reply = {u'status': u'error', u'error': error, u'message': message}
+    if problem:
+        reply[u'problem'] = problem
+    return reply
+
+
+def problem_reply(problem):
+    """
+    Build the reply for a bridge command from the problem code it set.
+
+    Problem codes are <command group>-<number>. Number 0 means that the command succeeded.
+    :param problem: problem string, e.g. '7-5\n', or '' if none was set
+    :return: reply
+    """
+    problem = (problem or '').strip()
+    if not problem or problem.endswith('-0'):
+        return ok_reply()
+    return error_reply(COMMAND_FAILED, 'problem ' + problem, problem)
+
+
+def check_reply(reply):
+    """
+    :param reply: reply payload
+    :return: The reply, if the request succeeded
+    :raises: The RpcError subclass for the error type, if the request failed
+    """
+    if reply.get('status') == 'error':
+        error = reply.get('error', '')
+        raise ERROR_TYPES.get(error, RpcError)(error, reply.get('message', ''), reply.get('problem'))
+    return reply
+
+
+def rpc_address(router_ip_address):
+    """
+    :param router_ip_address: router IP address
+    :return: The ZeroMQ address of the router's RPC port
+    """
+    return 'tcp://' + router_ip_address + ':' + port_map.port_map['rpc_port']
+
+
+class RpcBroker(threading.Thread):
+    """
+    This class routes requests from clients to services and replies from services to clients.
+    It is run by the router.
+
+    Services register, and re-register periodically, so the broker learns them again after a restart.
+    Local services are handled by the broker itself. The router service answers:
+        {'command': 'ping'}      - with the router's time
+        {'command': 'services'}  - with the names of the services available
+    """
+
+    def __init__(self, context):
+        """
+        :param context: ZeroMQ context
+        :return:
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.socket = context.socket(zmq.ROUTER)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        # report messages to servers that have gone away, rather than dropping them
+        self.socket.setsockopt(zmq.ROUTER_MANDATORY, 1)
+        self.socket.bind('tcp://*:' + port_map.port_map['rpc_port'])
+
+        # registered services - key = service name, value = identity of the server
+        self.services = {}
+
+        # services handled by the broker - key = service name, value = function(request) returning a reply
+        self.local_services = {b'router': self.router_service}
+
+    def add_local_service(self, name, handler):
+        """
+        Add a service handled by the broker
+        :param name: service name
+        :param handler: Function called with each request. It returns the reply.
+        :return:
+        """
+        self.local_services[name.encode()] = handler
+
+    def run(self):
+        try:
+            while True:
+                self.route(self.socket.recv_multipart())
+        except zmq.error.ContextTerminated:
+            self.socket.close()
+
+    def route(self, frames):
+        """
+        Route a message received from a client or a server
+        :param frames: message frames, starting with the sender's identity
+        :return:
+        """
+        identity, kind = frames[0], frames[1]
+
+        if kind == REGISTER and len(frames) == 3:
+            self.services[frames[2]] = identity
+
+        elif kind == REQUEST and len(frames) == 5:
+            service, request_id, request = frames[2:]
+            if service in self.local_services:
+                # noinspection PyBroadException
+                try:
+                    reply = self.local_services[service](umsgpack.unpackb(request))
+                except Exception as e:
+                    reply = error_reply(BAD_REQUEST, str(e))
+                self.send(identity, [REPLY, request_id, umsgpack.packb(reply)])
+                return
+
+            server = self.services.get(service)
+            if server is None or not self.send(server, [REQUEST, identity, request_id, request]):
+                self.services.pop(service, None)
+                reply = error_reply(UNKNOWN_SERVICE, service.decode())
+                self.send(identity, [REPLY, request_id, umsgpack.packb(reply)])
+
+        elif kind == REPLY and len(frames) == 5:
+            self.send(frames[2], [REPLY, frames[3], frames[4]])
+
+    def send(self, identity, frames):
+        """
+        Send a message to a client or a server. The broker never waits to send, so a receiver that is
+        not reading does not hold up the others.
+        :param identity: identity of the receiver
+        :param frames: message frames
+        :return: False if the receiver is no longer connected, or its queue is full
+        """
+        try:
+            self.socket.send_multipart([identity] + frames, zmq.NOBLOCK)
+            return True
+        except zmq.error.ContextTerminated:
+            raise
+        except zmq.error.ZMQError:
+            # Again if the receiver's queue is full, EHOSTUNREACH if it has gone
+            return False
+
+    def router_service(self, request):
+        """
+        Handle a request to the router service
+        :param request: request
+        :return: reply
+        """
+        command = request.get('command')
+        if command == 'ping':
+            return ok_reply(time=time.time())
+        if command == 'services':
+            names = set(self.services) | set(self.local_services)
+            return ok_reply(services=sorted(name.decode() for name in names))
+        return error_reply(UNKNOWN_COMMAND, str(command))
+
+
+class RpcServer:
+    """
+    This class receives requests for a service and sends the replies.
+
+    It does not run a thread. process_requests is called from the owner's main loop, so requests
+    are handled on the same thread as the owner's other commands.
+    """
+
+    def __init__(self, context, router_ip_address, service, handler, register_interval=5.0):
+        """
+        :param context: ZeroMQ context
+        :param router_ip_address: router IP address
+        :param service: service name
+        :param handler: Function called with each request. It returns the reply.
+        :param register_interval: Seconds between registrations with the broker
+        :return:
+        """
+        self.socket = context.socket(zmq.DEALER)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.router_ip_address = router_ip_address
+        self.socket.connect(rpc_address(router_ip_address))
+
+        self.service = service.encode()
+        self.handler = handler
+        self.register_interval = register_interval
+        self.next_registration = 0
+
+    def process_requests(self):
+        """
+        Handle the requests that are waiting, and register when due. This does not block.
+        :return:
+        """
+        now = time.monotonic()
+        if now >= self.next_registration:
+            self.socket.send_multipart([REGISTER, self.service])
+            self.next_registration = now + self.register_interval
+
+        while True:
+            try:
+                frames = self.socket.recv_multipart(zmq.NOBLOCK)
+            except zmq.error.Again:
+                return
+            if len(frames) != 4 or frames[0] != REQUEST:
+                continue
+
+            # noinspection PyBroadException
+            try:
+                reply = self.handler(umsgpack.unpackb(frames[3]))
+            except Exception as e:
+                reply = error_reply(BAD_REQUEST, repr(e))
+            self.socket.send_multipart([REPLY, frames[1], frames[2], umsgpack.packb(reply)])
+
+    def reconnect(self, router_ip_address):
+        """
+        Move the server to another router, and register with it at once
+        :param router_ip_address: IP address of the new router
+        :return:
+        """
+        self.socket.disconnect(rpc_address(self.router_ip_address))
+        self.socket.connect(rpc_address(router_ip_address))
+        self.router_ip_address = router_ip_address
+        self.next_registration = 0
+
+    def close(self):
+        self.socket.close()
+
+
+class RpcClient:
+    """
+    This class sends requests and collects their replies.
+
+    call sends a request and waits for its reply. To have several requests outstanding, send each
+    request and then collect each reply with result. An RpcClient must only be used by one thread.
+    """
+
+    def __init__(self, context, router_ip_address, timeout=1.0):
+        """
+        :param context: ZeroMQ context
+        :param router_ip_address: router IP address
+        :param timeout: Default time in seconds to wait for a reply
+        :return:
+        """
+        self.socket = context.socket(zmq.DEALER)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.router_ip_address = router_ip_address
+        self.socket.connect(rpc_address(router_ip_address))
+
+        self.timeout = timeout
+        self.request_ids = itertools.count(1)
+
+        # requests waiting for a reply - key = request id, value = deadline
+        self.pending = {}
+
+        # replies received and not yet collected - key = request id
+        self.replies = {}
+
+    def send(self, service, request, timeout=None):
+        """
+        Send a request
+        :param service: service name, e.g. A1 for the bridge of board 1
+        :param request: request dictionary
+        :param timeout: Time in seconds to wait for the reply. Defaults to the client's timeout.
+        :return: The request id, to be passed to result
+        """
+        request_id = next(self.request_ids)
+        self.pending[request_id] = time.monotonic() + (timeout or self.timeout)
+        self.socket.send_multipart([REQUEST, service.encode(), str(request_id).encode(), umsgpack.packb(request)])
+        return request_id
+
+    def receive(self, timeout=0):
+        """
+        Collect the replies that have arrived
+        :param timeout: Maximum time in seconds to wait for a reply
+        :return:
+        """
+        if not self.socket.poll(timeout * 1000):
+            return
+        while True:
+            try:
+                frames = self.socket.recv_multipart(zmq.NOBLOCK)
+            except zmq.error.Again:
+                return
+            if len(frames) != 3 or frames[0] != REPLY:
+                continue
+            request_id = int(frames[1])
+            # replies to requests that have timed out are dropped
+            if self.pending.pop(request_id, None) is not None:
+                self.replies[request_id] = umsgpack.unpackb(frames[2])
+
+    def result(self, request_id):
+        """
+        Wait for the reply to a request
+        :param request_id: request id returned by send
+        :return: The reply
+        :raises: RpcTimeout if the reply does not arrive in time, or the RpcError subclass for the
+                 error type if the request failed
+        """
+        while request_id not in self.replies:
+            deadline = self.pending.get(request_id)
+            if deadline is None:
+                raise RpcError(BAD_REQUEST, 'no request with id ' + str(request_id))
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                del self.pending[request_id]
+                raise RpcTimeout(TIMEOUT, 'no reply to request ' + str(request_id))
+            self.receive(remaining)
+        return check_reply(self.replies.pop(request_id))
+
+    def call(self, service, request, timeout=None):
+        """
+        Send a request and wait for its reply
+        :param service: service name
+        :param request: request dictionary
+        :param timeout: Time in seconds to wait for the reply. Defaults to the client's timeout.
+        :return: The reply
+        :raises: RpcTimeout or the RpcError subclass for the error type
+        """
+        return self.result(self.send(service, request, timeout))
+
+    def reconnect(self, router_ip_address):
+        """
+        Move the client to another router. Requests still waiting for a reply will time out.
+        :param router_ip_address: IP address of the new router
+        :return:
+        """
+        self.socket.disconnect(rpc_address(self.router_ip_address))
+        self.socket.connect(rpc_address(router_ip_address))
+        self.router_ip_address = router_ip_address
+
+    def close(self):
+        self.socket.close()
@@ -32,6 +32,20 @@ This file contains a dictionary specifying various IP port numbers used with Zer
 # the subscribe_to_router_port should be used by all entities that with to subscribe to messages. The
 # subscribers need to set a topic filter to receive the messages of interest.
 
+# The router answers discovery probes on the discovery_port (UDP). Components that are not given a router
+# address discover it, so the router_ip_address entry is only used if no router answers and no address
+# has been cached.
+
+# When started with the -c option, the router publishes a copy of all traffic on the capture_port.
+
+# Requests that need a reply are sent through the router's rpc_port - see xideco/common/rpc.py.
+
+# The router publishes heartbeats on the H topic. A second router may be run on another computer as a hot
+# standby (xirt -p <primary router address>), and components given its address with the -s option move to it
+# if the heartbeats stop - see xideco/common/failover.py.
+
 
 port_map = {"router_ip_address": "192.168.2.193",
-            "publish_to_router_port": "43124", "subscribe_to_router_port": "43125"}
+            "publish_to_router_port": "43124", "subscribe_to_router_port": "43125",
+            "discovery_port": "43126", "capture_port": "43127",
+            "rpc_port": "43128"}
@@ -0,0 +1,365 @@
+"""
+Copyright (c) 2016 Alan Yorinks All right reserved.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public
+License as published by the Free Software Foundation; either
+version 3 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+"""
+This file contains the historian's on-disk sample store.
+
+Samples are kept per series. A series is the reports of one command for one pin of one board,
+for example ('B1', 'analog_read', '2'), and is stored in its own directory:
+
+    <root>/B1/analog_read/2/
+
+Each directory holds chunk files named after the time of their first sample, in milliseconds.
+A chunk holds up to CHUNK_SAMPLES samples and never spans more than CHUNK_SPAN seconds.
+
+The times of a series never decrease. A sample older than the last sample of its series, for
+example after the clock was stepped back, is stored with the time of the last sample. So each new
+chunk starts after the previous one, the chunks of a series do not overlap, and a chunk file is
+never replaced by another chunk. After a restart, the newest chunk of a series is continued.
+
+A chunk file is a header followed by two columns:
+    header: magic b'XIHC', version (uint16), sample count (uint32), size of the time column (uint32),
+            first time in ms (int64), first value (int64), value scale (uint32) - little endian
+    time column: the differences between successive times in ms
+    value column: the differences between successive values, multiplied by the value scale
+
+Differences are zigzag encoded and written as varints, so a steadily sampled, slowly changing
+sensor needs about two bytes per sample.
+"""
+
+import mmap
+import os
+import struct
+import time
+
+HEADER_FORMAT = '<4sHIIqqI'
+
+MAGIC = b'XIHC'
+VERSION = 1
+
+# values are stored as integers - 4 decimal places are kept
+VALUE_SCALE = 10000
+
+CHUNK_SAMPLES = 4096
+CHUNK_SPAN = 3600
+
+HEADER = struct.Struct(HEADER_FORMAT)
+
+
+def encode_varints(values, out):
+    """
+    Append zigzag varint encodings of integers to a bytearray
+    :param values: integers
+    :param out: bytearray
+    :return:
+    """
+    for value in values:
+        value = (value << 1) ^ (value >> 63)
+        while value > 0x7f:
+            out.append((value & 0x7f) | 0x80)
+            value >>= 7
+        out.append(value)
+
+
+def decode_varints(data, start, end, first):
+    """
+    Decode zigzag varint encoded differences and accumulate them
+    :param data: buffer
+    :param start: offset of the first varint
+    :param end: offset after the last varint
+    :param first: value the differences are applied to
+    :return: list of values, starting with first
+    """
+    values = [first]
+    total = first
+    value = 0
+    shift = 0
+    for byte in data[start:end]:
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        total += (value >> 1) ^ -(value & 1)
+        values.append(total)
+        value = 0
+        shift = 0
+    return values
+
+
+def encode_chunk(times, values):
+    """
+    Encode a chunk
+    :param times: sample times in ms
+    :param values: scaled sample values
+    :return: the chunk file contents
+    """
+    time_column = bytearray()
+    encode_varints([b - a for a, b in zip(times, times[1:])], time_column)
+    value_column = bytearray()
+    encode_varints([b - a for a, b in zip(values, values[1:])], value_column)
+    header = HEADER.pack(MAGIC, VERSION, len(times), len(time_column), times[0], values[0], VALUE_SCALE)
+    return header + time_column + value_column
+
+
+def decode_chunk(data):
+    """
+    Decode a chunk
+    :param data: the chunk file contents, or a memory map of the file
+    :return: times in ms, scaled values and the value scale
+    """
+    magic, version, count, time_bytes, first_time, first_value, scale = HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('Not a historian chunk file')
+
+    start = HEADER.size
+    times = decode_varints(data, start, start + time_bytes, first_time)
+    values = decode_varints(data, start + time_bytes, len(data), first_value)
+    return times[:count], values[:count], scale
+
+
+class ChunkStore:
+    """
+    This class stores samples in chunk files and answers queries.
+
+    Samples are collected in memory and written when flush is called. The chunk being filled is
+    rewritten on each flush, through a temporary file, so a chunk file is always complete.
+    Completed chunk files are not changed again.
+
+    clamped counts the samples whose time was moved forward to keep their series in time order.
+    """
+
+    def __init__(self, root):
+        """
+        :param root: Directory that holds the series directories
+        :return:
+        """
+        self.root = root
+
+        # chunks being filled - key = series, value = [chunk start ms, times, scaled values, changed]
+        self.open_chunks = {}
+
+        self.clamped = 0
+
+    def series_path(self, series):
+        """
+        :param series: (topic, command, pin)
+        :return: the directory of the series
+        """
+        return os.path.join(self.root, *[str(part) for part in series])
+
+    def append(self, series, timestamp, value):
+        """
+        Add a sample
+        :param series: (topic, command, pin)
+        :param timestamp: sample time in seconds
+        :param value: sample value
+        :return:
+        """
+        ms = int(timestamp * 1000)
+        chunk = self.open_chunks.get(series)
+        if chunk is None:
+            chunk = self.reopen(series)
+
+        if chunk:
+            if ms < chunk[1][-1]:
+                ms = chunk[1][-1]
+                self.clamped += 1
+            # a new chunk must start after the current one, so that its file name is unique
+            if ms > chunk[0] and (len(chunk[1]) >= CHUNK_SAMPLES or ms - chunk[0] >= CHUNK_SPAN * 1000):
+                if chunk[3]:
+                    self.write_chunk(series, chunk)
+                chunk = None
+
+        if not chunk:
+            chunk = [ms, [], [], True]
+            self.open_chunks[series] = chunk
+
+        chunk[1].append(ms)
+        chunk[2].append(int(round(value * VALUE_SCALE)))
+        chunk[3] = True
+
+    def reopen(self, series):
+        """
+        Continue the newest chunk file of a series, so that new samples follow those already stored
+        :param series: (topic, command, pin)
+        :return: The open chunk entry, or None if the series has no readable chunk files
+        """
+        chunk_starts = self.chunk_starts(series)
+        if not chunk_starts:
+            return None
+        try:
+            times, values, scale = self.read_chunk_file(os.path.join(self.series_path(series),
+                                                                     str(chunk_starts[-1]) + '.chunk'))
+        except (ValueError, struct.error):
+            return None
+        if scale != VALUE_SCALE:
+            values = [int(round(value * VALUE_SCALE / scale)) for value in values]
+        chunk = [chunk_starts[-1], list(times), list(values), False]
+        self.open_chunks[series] = chunk
+        return chunk
+
+    def chunk_starts(self, series):
+        """
+        :param series: (topic, command, pin)
+        :return: The start times in ms of the chunk files of a series, in order
+        """
+        path = self.series_path(series)
+        if not os.path.isdir(path):
+            return []
+        return sorted(int(name[:-6]) for name in os.listdir(path) if name.endswith('.chunk'))
+
+    def write_chunk(self, series, chunk):
+        """
+        Write a chunk file
+        :param series: (topic, command, pin)
+        :param chunk: open chunk entry
+        :return:
+        """
+        path = self.series_path(series)
+        os.makedirs(path, exist_ok=True)
+        file_name = os.path.join(path, str(chunk[0]) + '.chunk')
+        with open(file_name + '.tmp', 'wb') as f:
+            f.write(encode_chunk(chunk[1], chunk[2]))
+        os.replace(file_name + '.tmp', file_name)
+        chunk[3] = False
+
+    def flush(self):
+        """
+        Write every chunk that has new samples
+        :return:
+        """
+        for series, chunk in self.open_chunks.items():
+            if chunk[3]:
+                self.write_chunk(series, chunk)
+
+    def series(self):
+        """
+        :return: A list of the stored series
+        """
+        found = set(self.open_chunks)
+        if os.path.isdir(self.root):
+            for topic in os.listdir(self.root):
+                for command in os.listdir(os.path.join(self.root, topic)):
+                    for pin in os.listdir(os.path.join(self.root, topic, command)):
+                        found.add((topic, command, pin))
+        return sorted(found)
+
+    def read_chunk_file(self, file_name):
+        """
+        Read a chunk file through a memory map
+        :param file_name: chunk file name
+        :return: times in ms, scaled values and the value scale
+        """
+        with open(file_name, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return decode_chunk(data)
+
+    def query(self, series, start=None, end=None):
+        """
+        Retrieve the samples of a series in a time range
+        :param series: (topic, command, pin)
+        :param start: Start time in seconds, or None for the first sample
+        :param end: End time in seconds, or None for the last sample
+        :return: A list of (time in seconds, value) tuples
+        """
+        start_ms = -2 ** 63 if start is None else int(start * 1000)
+        end_ms = 2 ** 63 if end is None else int(end * 1000)
+
+        path = self.series_path(series)
+        chunk_starts = self.chunk_starts(series)
+
+        # a chunk may hold samples in the range if it starts before the end of the range, and the
+        # next chunk does not start before the start of the range - a chunk may end with samples
+        # at the time the next one starts
+        samples = []
+        open_chunk = self.open_chunks.get(series)
+        for index, chunk_start in enumerate(chunk_starts):
+            if chunk_start > end_ms:
+                break
+            if index + 1 < len(chunk_starts) and chunk_starts[index + 1] < start_ms:
+                continue
+            if open_chunk and open_chunk[0] == chunk_start:
+                # the latest samples are in memory
+                continue
+            times, values, scale = self.read_chunk_file(os.path.join(path, str(chunk_start) + '.chunk'))
+            samples.extend((t / 1000, v / scale) for t, v in zip(times, values) if start_ms <= t <= end_ms)
+
+        if open_chunk:
+            samples.extend((t / 1000, v / VALUE_SCALE) for t, v in zip(open_chunk[1], open_chunk[2])
+                           if start_ms <= t <= end_ms)
+        return samples
+
+    def aggregate(self, series, start, end, interval):
+        """
+        Downsample the samples of a series in a time range
+        :param series: (topic, command, pin)
+        :param start: Start time in seconds
+        :param end: End time in seconds
+        :param interval: Bucket length in seconds
+        :return: A list of (bucket start time, minimum, maximum, mean, sample count) tuples for the buckets
+                 that contain samples
+        """
+        buckets = {}
+        for timestamp, value in self.query(series, start, end):
+            bucket = int((timestamp - start) // interval)
+            entry = buckets.get(bucket)
+            if entry:
+                entry[0] = min(entry[0], value)
+                entry[1] = max(entry[1], value)
+                entry[2] += value
+                entry[3] += 1
+            else:
+                buckets[bucket] = [value, value, value, 1]
+
+        return [(start + bucket * interval, entry[0], entry[1], entry[2] / entry[3], entry[3])
+                for bucket, entry in sorted(buckets.items())]
+
+
+def benchmark(samples=100000):
+    """
+    Measure the size and speed of the chunk format for a simulated analog input sampled every 50 ms
+    :param samples: number of samples
+    :return:
+    """
+    import math
+    import tempfile
+
+    store = ChunkStore(tempfile.mkdtemp())
+    series = ('B1', 'analog_read', '0')
+    now = time.time()
+
+    start = time.perf_counter()
+    for x in range(samples):
+        store.append(series, now + x * .05, round(.5 + .3 * math.sin(x / 500), 4))
+    store.flush()
+    elapsed = time.perf_counter() - start
+
+    path = store.series_path(series)
+    size = sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+    print('append: {0:.1f} us per sample, {1:.2f} bytes per sample on disk'.format(
+        elapsed / samples * 1e6, size / samples))
+
+    store = ChunkStore(store.root)
+    start = time.perf_counter()
+    result = store.query(series)
+    elapsed = time.perf_counter() - start
+    print(' query: {0:.2f} us per sample, {1} samples'.format(elapsed / len(result) * 1e6, len(result)))
+
+
+if __name__ == '__main__':
+    benchmark()
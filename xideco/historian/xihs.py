@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+Copyright (c) 2016 Alan Yorinks All right reserved.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public
+License as published by the Free Software Foundation; either
+version 3 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+"""
+This file contains the Xideco historian - xihs.
+
+The historian subscribes to board reports and stores every report that has a pin and a numeric value,
+for example analog_read and digital_read, in a ChunkStore. Stored samples may be retrieved with the
+query and aggregate methods, or by other components through the RPC channel, with requests to the
+historian service:
+    {'command': 'series'}
+    {'command': 'query', 'topic': 'B1', 'report': 'analog_read', 'pin': 2, 'start': t1, 'end': t2}
+    {'command': 'aggregate', 'topic': 'B1', 'report': 'analog_read', 'pin': 2, 'start': t1, 'end': t2,
+     'interval': 60}
+"""
+
+import argparse
+import os
+import signal
+import sys
+import time
+
+import zmq
+
+from xideco.common import rpc
+from xideco.historian.chunk_store import ChunkStore
+from xideco.xidekit.xidekit import XideKit
+
+
+class Historian(XideKit):
+    """
+    This class stores board reports
+    """
+
+    def __init__(self, directory, router_ip_address=None, topics=('B',), flush_interval=5.0,
+                 standby_router_ip_address=None):
+        """
+        :param directory: Directory that holds the stored samples
+        :param router_ip_address: Xideco Router IP Address - if not specified, the router is discovered
+        :param topics: Topic prefixes of the reports to store
+        :param flush_interval: Seconds between writes of the collected samples to disk
+        :param standby_router_ip_address: Router to use if the router stops responding
+        :return:
+        """
+        super().__init__(router_ip_address, standby_router_ip_address=standby_router_ip_address)
+
+        self.store = ChunkStore(directory)
+        self.flush_interval = flush_interval
+        self.samples = 0
+
+        for topic in topics:
+            self.set_subscriber_topic(topic)
+
+        self.rpc_server = rpc.RpcServer(self.context, self.router_ip_address, 'historian', self.rpc_request)
+        self.failover.add_callback(self.rpc_server.reconnect)
+
+        self.poller = zmq.Poller()
+        self.poller.register(self.subscriber, zmq.POLLIN)
+        self.poller.register(self.rpc_server.socket, zmq.POLLIN)
+
+    def incoming_message_processing(self, topic, payload):
+        """
+        Store a report
+        :param topic: Message Topic string
+        :param payload: Message Data
+        :return:
+        """
+        if 'pin' not in payload or 'value' not in payload:
+            return
+        try:
+            value = float(payload['value'])
+        except (TypeError, ValueError):
+            return
+
+        self.store.append((topic, payload.get('command', ''), str(payload['pin'])),
+                          payload.get('time', time.time()), value)
+        self.samples += 1
+
+    def query(self, topic, command, pin, start=None, end=None):
+        """
+        Retrieve stored samples
+        :param topic: Report topic, e.g. B1
+        :param command: Report command, e.g. analog_read
+        :param pin: Pin number
+        :param start: Start time in seconds, or None for the first sample
+        :param end: End time in seconds, or None for the last sample
+        :return: A list of (time in seconds, value) tuples
+        """
+        return self.store.query((topic, command, str(pin)), start, end)
+
+    def aggregate(self, topic, command, pin, start, end, interval):
+        """
+        Retrieve stored samples downsampled to an interval
+        :param topic: Report topic, e.g. B1
+        :param command: Report command, e.g. analog_read
+        :param pin: Pin number
+        :param start: Start time in seconds
+        :param end: End time in seconds
+        :param interval: Bucket length in seconds
+        :return: A list of (bucket start time, minimum, maximum, mean, sample count) tuples
+        """
+        return self.store.aggregate((topic, command, str(pin)), start, end, interval)
+
+    def rpc_request(self, request):
+        """
+        Answer a request received through the RPC channel
+        :param request: request
+        :return: reply
+        """
+        command = request.get('command')
+        if command == 'series':
+            return rpc.ok_reply(series=self.store.series())
+        if command == 'query':
+            return rpc.ok_reply(samples=self.query(request['topic'], request['report'], request['pin'],
+                                                   request.get('start'), request.get('end')))
+        if command == 'aggregate':
+            return rpc.ok_reply(buckets=self.aggregate(request['topic'], request['report'], request['pin'],
+                                                       request['start'], request['end'], request['interval']))
+        return rpc.error_reply(rpc.UNKNOWN_COMMAND, str(command))
+
+    def receive_loop(self):
+        """
+        Store reports as they arrive, and write them to disk every flush interval
+        :return:
+        """
+        next_flush = time.monotonic() + self.flush_interval
+        while True:
+            try:
+                events = dict(self.poller.poll(100))
+                if self.subscriber in events:
+                    # process every message that is waiting
+                    while True:
+                        try:
+                            data = self.subscriber.recv_multipart(zmq.NOBLOCK)
+                        except zmq.error.Again:
+                            break
+                        self.process_message(data)
+                self.check_router()
+                self.heartbeat.tick()
+
+                # this also registers the historian service when due
+                self.rpc_server.process_requests()
+
+                if time.monotonic() >= next_flush:
+                    self.store.flush()
+                    next_flush = time.monotonic() + self.flush_interval
+            except KeyboardInterrupt:
+                self.clean_up()
+
+    def clean_up(self):
+        """
+        Write the collected samples before exiting
+        :return:
+        """
+        self.store.flush()
+        print(str(self.samples) + ' samples stored')
+        if self.store.clamped:
+            print(str(self.store.clamped) + ' samples were older than their series and were stored at its last time')
+        self.rpc_server.close()
+        super().clean_up()
+
+
+def xihs():
+    # noinspection PyShadowingNames
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', dest='router_ip_address', default='None', help='Router IP Address')
+    parser.add_argument('-s', dest='standby_router_ip_address', default='None', help='Standby Router IP Address')
+    parser.add_argument('-d', dest='directory', default=os.path.join(os.path.expanduser('~'), 'xideco_history'),
+                        help='Directory for the stored samples')
+    parser.add_argument('-f', dest='flush_interval', default='5', help='Seconds between writes to disk')
+    parser.add_argument('-t', dest='topics', nargs='*', default=['B'], help='Topic prefixes to store - default is B')
+
+    args = parser.parse_args()
+
+    historian = Historian(args.directory, args.router_ip_address, args.topics, float(args.flush_interval),
+                          args.standby_router_ip_address)
+    print('Storing samples in ' + args.directory)
+
+    # signal handler function called when Control-C occurs
+    # noinspection PyShadowingNames,PyUnusedLocal,PyUnusedLocal
+    def signal_handler(signal, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, signal_handler)
+
+    historian.receive_loop()
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    xihs()
@@ -25,11 +25,16 @@ import configparser
 import os
 import signal
 import sys
-import umsgpack
+import time
 
 from aiohttp import web
 # noinspection PyPackageRequirements
 import zmq
+from xideco.common import discovery
+from xideco.common.compression import unpack_message
+from xideco.common.failover import HEARTBEAT_TOPIC, RouterFailover
+from xideco.common.instrumentation import Instrumentation
+from xideco.common.liveness import Heartbeat
 from xideco.data_files.port_map import port_map
 
 
@@ -39,9 +44,12 @@ class HttpBridge:
     This is an HTTP bridge that translates Scratch HTTP requests into xideco protocol messages
    """
 
-    def __init__(self, router_ip_address=None):
+    def __init__(self, router_ip_address=None, standby_router_ip_address=None, instrumentation_interval=0):
         """
         This is the constructor for the xideco HTTP bridge
+        :param router_ip_address: Router IP address - if not specified, the router is discovered
+        :param standby_router_ip_address: Router to use if the router stops responding
+        :param instrumentation_interval: Seconds between instrumentation stats reports - 0 = off
         :return:
         """
 
@@ -70,10 +78,13 @@ class HttpBridge:
             print('Cannot locate xideco configuration directory.')
             sys.exit(0)
 
-        if self.router_ip_address == 'None':
-            self.router_ip_address = port_map.port_map['router_ip_address']
-        else:
-            self.router_ip_address = router_ip_address
+        # if not specified, the router is discovered
+        self.router_ip_address = discovery.resolve_router_ip_address(router_ip_address)
+        self.standby_router_ip_address = standby_router_ip_address
+
+        # Scratch request and event loop timings - see instrumentation.py.
+        # The publisher is set when the sockets are created.
+        self.instrumentation = Instrumentation(None, 'xihb', None, None, instrumentation_interval)
 
         print('\n**************************************')
         print('Scratch HTTP Bridge - xihb')
@@ -119,7 +130,7 @@ class HttpBridge:
         :return: http server instance
         """
 
-        app = web.Application(loop=loop)
+        app = web.Application(loop=loop, middlewares=[self.instrumentation_middleware])
 
         app.router.add_route('GET', '/digital_pin_mode/{board}/{enable}/{pin}/{mode}', self.setup_digital_pin)
         app.router.add_route('GET', '/analog_pin_mode/{board}/{enable}/{pin}', self.setup_analog_pin)
@@ -149,11 +160,23 @@ class HttpBridge:
             self.subscriber.setsockopt(zmq.SUBSCRIBE, envelope)
 
         self.publisher = self.context.socket(zmq.PUB)
+        # commands are dropped, rather than queued, while the router is not connected
+        self.publisher.setsockopt(zmq.IMMEDIATE, 1)
         connect_string = "tcp://" + self.router_ip_address + ':' + port_map.port_map[
             'publish_to_router_port']
 
         self.publisher.connect(connect_string)
 
+        # if the router stops responding, the bridge moves to the standby router
+        self.failover = RouterFailover(self.router_ip_address, self.standby_router_ip_address)
+        self.failover.watch(self.subscriber)
+        self.failover.add_socket(self.publisher, 'publish_to_router_port')
+
+        # heartbeats tell the router that the bridge is running - see liveness.py. A bridge that
+        # stops responding is reported to Scratch as problem 9-1 for its board.
+        self.heartbeat = Heartbeat(self.publisher, 'xihb')
+        self.instrumentation.publisher = self.publisher
+
         app.router.add_route('GET', '/poll', self.poll)
         await self.keep_alive()
 
@@ -174,7 +197,8 @@ class HttpBridge:
         mode = request.match_info.get('mode')
 
         mode = await self.check_cmd_digital_mode(mode)
-        command_msg = umsgpack.packb({u"command": command, u"enable": enable, u"pin": pin, u"mode": mode})
+        command_msg = self.instrumentation.pack({u"command": command, u"enable": enable, u"pin": pin,
+                                                 u"mode": mode})
 
         await self.send_command_to_router(board, command_msg)
 
@@ -192,7 +216,7 @@ class HttpBridge:
         enable = await self.check_cmd_enable_disable(enable)
 
         pin = request.match_info.get('pin')
-        command_msg = umsgpack.packb({u"command": command, u"enable": enable, u"pin": pin})
+        command_msg = self.instrumentation.pack({u"command": command, u"enable": enable, u"pin": pin})
         # await self.send_command_to_router(board, command_msg)
 
         board = 'A' + board
@@ -211,7 +235,7 @@ class HttpBridge:
         board = request.match_info.get('board')
         pin = request.match_info.get('pin')
         value = request.match_info.get('value')
-        command_msg = umsgpack.packb({u"command": command, u"pin": pin, u"value": value})
+        command_msg = self.instrumentation.pack({u"command": command, u"pin": pin, u"value": value})
         await self.send_command_to_router(board, command_msg)
 
         return web.Response(body="ok".encode('utf-8'))
@@ -226,7 +250,7 @@ class HttpBridge:
         board = request.match_info.get('board')
         pin = request.match_info.get('pin')
         value = request.match_info.get('value')
-        command_msg = umsgpack.packb({u"command": command, u"pin": pin, u"value": value})
+        command_msg = self.instrumentation.pack({u"command": command, u"pin": pin, u"value": value})
         await self.send_command_to_router(board, command_msg)
 
         return web.Response(body="ok".encode('utf-8'))
@@ -242,7 +266,8 @@ class HttpBridge:
         pin = request.match_info.get('pin')
         freq = request.match_info.get('frequency')
         duration = request.match_info.get('duration')
-        command_msg = umsgpack.packb({u"command": command, u"pin": pin, u"frequency": freq, u"duration": duration})
+        command_msg = self.instrumentation.pack({u"command": command, u"pin": pin, u"frequency": freq,
+                                                 u"duration": duration})
         await self.send_command_to_router(board, command_msg)
 
         return web.Response(body="ok".encode('utf-8'))
@@ -257,7 +282,7 @@ class HttpBridge:
         board = request.match_info.get('board')
         pin = request.match_info.get('pin')
 
-        command_msg = umsgpack.packb({u"command": command, u"pin": pin})
+        command_msg = self.instrumentation.pack({u"command": command, u"pin": pin})
         await self.send_command_to_router(board, command_msg)
 
         return web.Response(body="ok".encode('utf-8'))
@@ -273,11 +298,28 @@ class HttpBridge:
         pin = request.match_info.get('pin')
         position = request.match_info.get('position')
 
-        command_msg = umsgpack.packb({u"command": command, u"pin": pin, u"position": position})
+        command_msg = self.instrumentation.pack({u"command": command, u"pin": pin, u"position": position})
         await self.send_command_to_router(board, command_msg)
 
         return web.Response(body="ok".encode('utf-8'))
 
+    async def instrumentation_middleware(self, app, handler):
+        """
+        This method wraps each request handler to time it when instrumentation is enabled.
+        Requests are timed by the first part of their path, e.g. digital_write.
+        :param app: aiohttp application
+        :param handler: request handler
+        :return: The wrapped handler
+        """
+        async def middleware(request):
+            if not self.instrumentation.enabled:
+                return await handler(request)
+            start = time.perf_counter()
+            response = await handler(request)
+            self.instrumentation.dispatched(request.path.split('/')[1], time.perf_counter() - start)
+            return response
+        return middleware
+
     # noinspection PyUnusedLocal
     async def poll(self, request):
         """
@@ -349,11 +391,24 @@ class HttpBridge:
         :return:
         """
         while True:
+            # move to the standby router if the router has stopped responding
+            self.failover.check()
+            # publish a heartbeat when due
+            self.heartbeat.tick()
+            self.instrumentation.loop_pass()
 
             # check for reporter messages
             try:
-                [address, contents] = self.subscriber.recv_multipart(zmq.NOBLOCK)
-                payload = umsgpack.unpackb(contents)
+                message = self.subscriber.recv_multipart(zmq.NOBLOCK)
+                self.heartbeat.message()
+                address = message[0]
+                payload = unpack_message(message)
+                if address == HEARTBEAT_TOPIC:
+                    report = self.failover.heartbeat(payload)
+                    if report:
+                        print('No router heartbeats for ' + str(round(report['duration'], 1)) +
+                              ' seconds - messages may have been lost')
+                    continue
                 # print("[%s] %s" % (address, payload))
                 board_num = address.decode()
                 board_num = board_num[1]
@@ -363,6 +418,9 @@ class HttpBridge:
                     continue
                 elif command == 'problem':
                     data_string = command + '/' + board_num + ' ' + payload['problem']
+                # only digital and analog reports have a Scratch reporter
+                elif command != 'digital_read' and command != 'analog_read':
+                    continue
                 else:
                     # noinspection PyPep8
                     if not 'pin' in payload:
@@ -417,12 +475,16 @@ def http_bridge():
     parser = argparse.ArgumentParser()
 
     parser.add_argument('-r', dest='router_ip_address', default='None', help='Router IP Address')
+    parser.add_argument('-s', dest='standby_router_ip_address', default='None', help='Standby Router IP Address')
+    parser.add_argument('-x', dest='instrumentation_interval', default='0',
+                        help='Publish instrumentation stats every this many seconds - 0 = off')
 
     args = parser.parse_args()
     router_ip_address = args.router_ip_address
 
     # noinspection PyShadowingNames
-    http_bridge = HttpBridge(router_ip_address)
+    http_bridge = HttpBridge(router_ip_address, args.standby_router_ip_address, float(args.instrumentation_interval))
+    http_bridge.instrumentation.install_signal_handlers()
     # noinspection PyShadowingNames
     loop = asyncio.get_event_loop()
 
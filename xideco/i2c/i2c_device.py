@@ -0,0 +1,102 @@
+"""
+Copyright (c) 2016 Alan Yorinks All right reserved.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public
+License as published by the Free Software Foundation; either
+version 3 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+import struct
+
+
+class I2CRead:
+    """
+    This class describes a read of an i2c device and how the data read is decoded.
+
+    The data may be decoded with a struct format string and a list of field names, for example
+    a device with three little endian signed 16 bit registers:
+
+        I2CRead(50, 6, fmt='<hhh', fields=['x', 'y', 'z'], scale=.004)
+
+    or, for devices that need more than that, by a decoder function that is passed the data and
+    returns a dictionary of values.
+    """
+
+    def __init__(self, register, num_bytes, fmt=None, fields=None, scale=1, decoder=None, cmd='read_block',
+                 **extra):
+        """
+        :param register: Starting register
+        :param num_bytes: Number of bytes to read
+        :param fmt: struct format string for the data
+        :param fields: A name for each value in fmt
+        :param scale: Factor applied to each value unpacked with fmt
+        :param decoder: Function to decode the data. Used in place of fmt and fields.
+        :param cmd: i2c_request cmd used for the read, e.g. read_block or read_fifo
+        :param extra: Additional i2c_request values, e.g. status_register and mask for read_fifo
+        :return:
+        """
+        if not decoder and not (fmt and fields):
+            raise ValueError('An I2CRead needs a decoder or a fmt and fields')
+
+        self.register = register
+        self.num_bytes = num_bytes
+        self.fmt = fmt
+        self.fields = fields
+        self.scale = scale
+        self.decoder = decoder
+        self.cmd = cmd
+        self.extra = extra
+
+    def request(self):
+        """
+        :return: The i2c_request message for the read, without the device address
+        """
+        request = {u"cmd": self.cmd, u"register": self.register, u"num_bytes": self.num_bytes}
+        request.update(self.extra)
+        return request
+
+    def decode(self, data):
+        """
+        Decode the data returned by the read
+        :param data: bytes, or a list of integers, returned by the bridge
+        :return: A dictionary of values
+        """
+        if self.decoder:
+            return self.decoder(data)
+
+        values = struct.unpack(self.fmt, bytes(data))
+        if self.scale != 1:
+            values = [value * self.scale for value in values]
+        return dict(zip(self.fields, values))
+
+
+class I2CDevice:
+    """
+    This class is a declarative description of an i2c device: its address, the requests that
+    initialize it and the reads that may be made from it. Descriptors contain no threading or
+    ZeroMQ code. They are run by an I2CEngine, which may run any number of devices.
+    """
+
+    def __init__(self, name, device_address, init=None, reads=None):
+        """
+        :param name: Device name, included in each report
+        :param device_address: i2c address of the device
+        :param init: List of i2c_request messages, without the device address, that initialize the device.
+                     The first is normally {"cmd": "init"}.
+        :param reads: Dictionary of read name to I2CRead
+        :return:
+        """
+        self.name = name
+        self.device_address = device_address
+        self.init = init or [{u"cmd": u"init"}]
+        self.reads = reads or {}
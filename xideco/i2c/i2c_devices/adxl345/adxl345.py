@@ -19,15 +19,19 @@ You should have received a copy of the GNU Lesser General Public
 License along with this library; if not, write to the Free Software
 Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 """
-import math
+import itertools
 import sys
 import threading
 import time
+import uuid
 
 import umsgpack
 # noinspection PyPackageRequirements
 import zmq
+from xideco.common import discovery
+from xideco.common.compression import DEFAULT_THRESHOLD, MessageCompressor, unpack_message
 from xideco.data_files.port_map import port_map
+from xideco.i2c.i2c_devices.adxl345.adxl345_decoder import decode_block, decode_sample
 
 
 # noinspection PyMethodMayBeStatic,PyUnresolvedReferences,PyUnresolvedReferences,PyUnresolvedReferences,PyShadowingNames
@@ -49,6 +53,9 @@ class ADXL345(threading.Thread):
             accelerometer values for x,y,z expressed in g's
             normalized value for x,y,z
             pitch and roll angles
+
+        In stream mode, the device samples into its 32 entry FIFO at up to 3200 Hz. Each read transaction
+        returns every sample waiting in the FIFO, and the samples are reported as a timestamped block.
         """
 
     # This is the pseudo board number indicating that the commands are broadcast to all connectedADXL345
@@ -58,11 +65,24 @@ class ADXL345(threading.Thread):
     # report data formats
     RAW = 0
 
-    def __init__(self, router_ip_address, board_number=BROADCAST, data_publish_envelope=None):
+    # registers used for stream mode
+    BW_RATE = 0x2c
+    FIFO_CTL = 0x38
+    FIFO_STATUS = 0x39
+
+    # FIFO_CTL mode bits
+    FIFO_BYPASS = 0x00
+    FIFO_STREAM = 0x80
+
+    # output data rate in Hz to BW_RATE rate code
+    RATE_CODES = {3200: 0x0f, 1600: 0x0e, 800: 0x0d, 400: 0x0c, 200: 0x0b, 100: 0x0a, 50: 0x09, 25: 0x08}
+
+    def __init__(self, router_ip_address, board_number=BROADCAST, data_publish_envelope=None, reply_timeout=1.0):
         """
         :param router_ip_address: IP Address of router
         :param board_number: Board number or BROADCAST to send to all boards
         :param: publish_envelope: Set this parameter to publish data using the user specified envelope
+        :param reply_timeout: Maximum time in seconds to wait for the device to reply to a read
         :return:
         """
         # call the parent class init and set the thread as a daemon thread
@@ -73,15 +93,15 @@ class ADXL345(threading.Thread):
         self.board_number = board_number
         self.data_publish_envelope = data_publish_envelope
         self.read_time = None
+        self.reply_timeout = reply_timeout
 
-        # A parameter is provided by the user to force the router ip address instead of reading from the
-        # configuration file.
+        # each read request carries an id that the bridge echoes in its reply. Replies are seen by every
+        # client subscribed to the board, so the ids start with a prefix unique to this client.
+        client_id = uuid.uuid4().hex[:12]
+        self.request_ids = (client_id + '-' + str(n) for n in itertools.count())
 
-        # if not specified, the router ip address is read from the configuration file
-        if router_ip_address == 'None':
-            self.router_ip_address = port_map.port_map['router_ip_address']
-        else:
-            self.router_ip_address = router_ip_address
+        # A parameter is provided by the user to force the router ip address instead of discovering it.
+        self.router_ip_address = discovery.resolve_router_ip_address(router_ip_address)
 
         print('\n************************************************************')
         print('ADXL345')
@@ -100,6 +120,10 @@ class ADXL345(threading.Thread):
         envelope = env_string.encode()
         self.subscriber.setsockopt(zmq.SUBSCRIBE, envelope)
 
+        # replies are waited for with a poller, so that a wait can time out without polling in a loop
+        self.poller = zmq.Poller()
+        self.poller.register(self.subscriber, zmq.POLLIN)
+
         # create the zeromq publisher socket
         self.publisher = self.context.socket(zmq.PUB)
         connect_string = 'tcp://' + self.router_ip_address + ':' + port_map.port_map['publish_to_router_port']
@@ -120,6 +144,17 @@ class ADXL345(threading.Thread):
         # a flag that the user can set via start_continuous and stop_continuous to affect continuous reading of data
         self.keep_reading = True
 
+        # the read thread waits on this event while reading is stopped
+        self.reading = threading.Event()
+
+        # stream mode settings - see start_stream
+        self.streaming = False
+        self.stream_rate = None
+        self.stream_interval = None
+
+        # published data is not compressed unless enable_compression is called
+        self.compressor = None
+
         # the last read is stored here and can be retrieved by a call to get_last_data
         self.last_data = {'board': 0, 'x_raw': 0, 'y_raw': 0, 'z_raw': 0,
                           'x_g': 0.0, 'y_g': 0.0, 'z_g': 0.0,
@@ -130,6 +165,7 @@ class ADXL345(threading.Thread):
 
         # initialization:
         #   Send and "init" instruction
+        #   (the initialization commands are sent to the bridge as a single batch request)
         #   Set the Power Control Register to 0
         #   Set the Power Control Register to 8 = Measure Bit enabled
         #   Set the Data Format Register to 8 for full resolution
@@ -169,6 +205,14 @@ class ADXL345(threading.Thread):
                         u"cmd": "read_block",
                         u"register": 50,
                         u"num_bytes": 6
+                    }],
+                    # read every entry in the FIFO - the entry count is in the low 6 bits of FIFO_STATUS
+                    "read_fifo": [{
+                        u"cmd": "read_fifo",
+                        u"register": 50,
+                        u"num_bytes": 6,
+                        u"status_register": 57,
+                        u"mask": 63
                     }]
                 }
             }
@@ -192,19 +236,21 @@ class ADXL345(threading.Thread):
         :return: Return the last set of values read
         """
         msg = self.i2c_device['adxl345']['commands']['read']
-        self._send_to_device(msg)
-        self._process_subscribed_message()
+        request_id = next(self.request_ids)
+        self._send_to_device(msg, request_id)
+        self._process_subscribed_message(request_id)
         return self.last_data
 
     def start_continuous(self, read_time=None):
         """
         Start a continuous read. Create the read thread if not already created.
-        If read time is None, time period between read is .001 seconds
+        If read time is None, the next read is requested as soon as the data for the last one is received.
         :param read_time: Amount of time to delay after receiving data back from device
         :return:
         """
         self.keep_reading = True
         self.read_time = read_time
+        self.reading.set()
 
         # start the thread if it is not running already
         if not self.is_alive():
@@ -216,6 +262,68 @@ class ADXL345(threading.Thread):
         :return:
         """
         self.keep_reading = False
+        self.reading.clear()
+
+    def start_stream(self, rate=3200, callback=None, interval=None):
+        """
+        Start FIFO stream mode. The device samples at the specified rate and each read returns all of
+        the samples in the FIFO. Each block of samples is passed to the callback, and published if a
+        data publish envelope was specified, with the time of each sample.
+
+        If interval is specified, the bridge is asked to read the FIFO at that interval without waiting
+        for a request for each read. This is supported by the Raspberry Pi bridge. Otherwise the next
+        read is requested when each block is received.
+
+        The FIFO holds 32 samples, so the FIFO must be read at least every 32 / rate seconds
+        (10 ms at 3200 Hz) for no samples to be lost.
+        :param rate: Output data rate in Hz - one of the keys of RATE_CODES
+        :param callback: Optional function called with each block. See _process_fifo_message.
+        :param interval: Optional time between bridge FIFO reads in milliseconds
+        :return:
+        """
+        if rate not in self.RATE_CODES:
+            raise ValueError('Unsupported ADXL345 data rate: ' + str(rate))
+
+        if callback:
+            self.callback = callback
+        self.stream_rate = rate
+        self.stream_interval = interval
+
+        self._send_to_device([{u"cmd": u"write_byte", u"register": self.BW_RATE, u"value": self.RATE_CODES[rate]},
+                              {u"cmd": u"write_byte", u"register": self.FIFO_CTL, u"value": self.FIFO_STREAM}])
+
+        self.streaming = True
+        self.start_continuous()
+
+    def stop_stream(self):
+        """
+        Stop FIFO stream mode and return the FIFO to bypass mode
+        :return:
+        """
+        self.streaming = False
+        self.stop_continuous()
+        if self.stream_interval:
+            self._send_to_device([{u"cmd": u"stop_read", u"register": 50}])
+        self._send_to_device([{u"cmd": u"write_byte", u"register": self.FIFO_CTL, u"value": self.FIFO_BYPASS}])
+
+    def enable_compression(self, threshold=DEFAULT_THRESHOLD):
+        """
+        Compress published data messages, such as stream blocks, of at least threshold bytes
+        :param threshold: Minimum payload size in bytes to compress
+        :return:
+        """
+        self.compressor = MessageCompressor([self.data_publish_envelope], threshold)
+
+    def _publish_data(self, payload):
+        """
+        Publish data with the data publish envelope
+        :param payload: message dictionary
+        :return:
+        """
+        frames = [self.data_publish_envelope.encode(), umsgpack.packb(payload)]
+        if self.compressor:
+            frames = self.compressor.compress(frames)
+        self.publisher.send_multipart(frames)
 
     def get_last_data(self):
         """
@@ -224,137 +332,119 @@ class ADXL345(threading.Thread):
         """
         return self.last_data
 
-    def _send_to_device(self, msg):
+    def _send_to_device(self, msg, request_id=None):
         """
-        Send a control messages to the device
+        Send control messages to the device. When there is more than one message, they are sent
+        as a single batch request, which the bridge performs in order.
         :param msg: A list of messages to be sent as specified by i2c_device
+        :param request_id: Optional id that the bridge includes in its reply
         :return:
         """
-        address = self.i2c_device['adxl345']['device_address']
+        if len(msg) > 1:
+            request = {u"cmd": u"batch", u"requests": msg}
+        else:
+            request = dict(msg[0])
+
+        request[u"command"] = u"i2c_request"
+        request[u"device_address"] = self.i2c_device['adxl345']['device_address']
+        if request_id is not None:
+            request[u"request_id"] = request_id
 
-        for i in msg:
-            i.update({u"command": u"i2c_request"})
-            i.update({u"device_address": address})
+        self.publisher.send_multipart([self.publish_envelope, umsgpack.packb(request)])
 
-            msg = umsgpack.packb(i)
-            time.sleep(.001)
-            self.publisher.send_multipart([self.publish_envelope, msg])
+    def _wait_for_reply(self, request_id, fifo=False):
+        """
+        Wait for the reply to a read request.
 
-    def _process_subscribed_message(self):
+        Replies for other requests are discarded. A reply without a request id, from a bridge that
+        does not support them, is accepted as the reply.
+        :param request_id: id of the request
+        :param fifo: True to wait for a read_fifo reply, False for a read_block reply
+        :return: board number and reply payload, or None, None if the wait timed out
+        """
+        deadline = time.monotonic() + self.reply_timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not self.poller.poll(remaining * 1000):
+                return None, None
+
+            msg = self.subscriber.recv_multipart()
+            payload = unpack_message(msg)
+            if payload.get('command') != 'i2c_reply' or ('frames' in payload) != fifo:
+                continue
+            if payload.get('request_id', request_id) != request_id:
+                continue
+
+            # extract board number from envelope
+            board = msg[0].decode()
+            return int(board[1:]), payload
+
+    def _process_subscribed_message(self, request_id):
         """
         Wait for data to be returned by the i2c device.
         It stores the data in last_data, and calls the callback if one was specified when the device was initialized.
-        :return:
+        :param request_id: id of the read request
+        :return: True if data was received, False if the read timed out
         """
-        # noinspection PyPep8Naming
-        EARTH_GRAVITY_MS2 = 9.80665
+        board, self.payload = self._wait_for_reply(request_id)
+        if not self.payload:
+            print('ADXL345: no reply from the device')
+            return False
 
-        while True:
-            if self.keep_reading:
-                # noinspection PyBroadException
-                try:
-                    msg = self.subscriber.recv_multipart(zmq.NOBLOCK)
-                    # extract board number from envelope
-                    board = msg[0].decode()
-                    board = int(board[1:])
-                    self.payload = umsgpack.unpackb(msg[1])
-
-                    if not 'data' in self.payload:
-                        continue
-                    raw = self.payload['data']
-
-                    # mask off bits not being used
-                    raw[1] &= 0x3
-                    raw[3] &= 0x3
-                    raw[5] &= 0x3
-
-                    # get raw value for x
-                    x = raw[0] | (raw[1] << 8)
-                    x = self._twos_comp(x, 10)
-                    x = round(x, 4)
-
-                    # express x in g forces
-                    xg = x * .004
-                    xg = round(xg, 4)
-
-                    # express x as a normalized acceleration
-                    xa = xg * EARTH_GRAVITY_MS2
-                    xa = round(xa, 4)
-
-                    # get raw value for y
-                    y = raw[2] | (raw[3] << 8)
-                    y = self._twos_comp(y, 10)
-                    y = round(y, 4)
-
-                    # express y in g forces
-                    yg = y * .004
-                    yg = round(yg, 4)
-
-                    # express y as a normalized acceleration
-                    ya = yg * EARTH_GRAVITY_MS2
-                    ya = round(ya, 4)
-
-                    # get raw value for z
-                    z = raw[4] | (raw[5] << 8)
-                    z = self._twos_comp(z, 10)
-                    z = round(z, 4)
-
-                    # express z in g forces
-                    zg = z * .004
-                    zg = round(zg, 4)
-
-                    # express z as a normalized acceleration
-                    za = zg * EARTH_GRAVITY_MS2
-                    za = round(za, 4)
-
-                    pitch = int(-(math.atan2(xa, math.sqrt(ya * ya + za * za)) * 180.0) / math.pi)
-
-                    roll = int((math.atan2(ya, za) * 180.0) / math.pi)
-
-                    self.last_data[u'x_raw'] = x
-                    self.last_data[u'y_raw'] = y
-                    self.last_data[u'z_raw'] = z
-
-                    self.last_data[u'x_g'] = xg
-                    self.last_data[u'y_g'] = yg
-                    self.last_data[u'z_g'] = zg
-
-                    self.last_data[u'x_a'] = xa
-                    self.last_data[u'y_a'] = ya
-                    self.last_data[u'z_a'] = za
-
-                    self.last_data[u'roll'] = roll
-                    self.last_data[u'pitch'] = pitch
-
-                    self.last_data[u'board'] = board
-
-                    # if there is a callback registered, call it
-                    if self.callback:
-                        self.callback(self.last_data)
-
-                    # if there is a publisher envelope, publish the data
-                    if self.data_publish_envelope:
-                        data_publish_envelope = (self.data_publish_envelope.encode())
-
-                        msg = umsgpack.packb(self.last_data)
-                        time.sleep(.001)
-                        self.publisher.send_multipart([data_publish_envelope, msg])
-                        time.sleep(.001)
-
-                    return
-                except KeyboardInterrupt:
-                    self.clean_up()
-                    sys.exit(0)
-                except zmq.error.Again:
-                    time.sleep(.001)
-            else:
-                time.sleep(.001)
-                pass
-
-    def _twos_comp(self, val, bits):
-        if (val & (1 << (bits - 1))) != 0:
-            val -= 1 << bits
-        return val
+        # data may be reported as a list of integers or as bytes
+        raw = self.payload['data']
+
+        self.last_data.update(decode_sample(raw))
+        self.last_data[u'board'] = board
+
+        # if there is a callback registered, call it
+        if self.callback:
+            self.callback(self.last_data)
+
+        # if there is a publisher envelope, publish the data
+        if self.data_publish_envelope:
+            self._publish_data(self.last_data)
+
+        return True
+
+    def _process_fifo_message(self, request_id):
+        """
+        Wait for a block of FIFO samples to be returned by the device.
+
+        The block passed to the callback is the dictionary returned by adxl345_decoder.decode_block,
+        with the board number and a 'time' list holding the time of each sample. The bridge reports the
+        time of the FIFO read, which is taken as the time of the newest sample. Earlier samples are spaced
+        at the output data rate.
+
+        The published block contains the raw frames as 'data', for decoding with decode_block, along
+        with the board number, the number of frames, the data rate and the time of the first sample.
+        :param request_id: id of the read_fifo request
+        :return:
+        """
+        board, self.payload = self._wait_for_reply(request_id, fifo=True)
+        if not self.payload:
+            print('ADXL345: no reply from the device')
+            return
+
+        frames = self.payload['frames']
+        if not frames:
+            # the FIFO was empty - allow a sample to arrive before it is read again
+            time.sleep(1.0 / self.stream_rate)
+            return
+
+        data = bytes(self.payload['data'])
+        period = 1.0 / self.stream_rate
+        first_time = self.payload['time'] - (frames - 1) * period
+
+        if self.callback:
+            block = decode_block(data)
+            block['board'] = board
+            block['time'] = [first_time + i * period for i in range(frames)]
+            self.callback(block)
+
+        if self.data_publish_envelope:
+            self._publish_data({u'board': board, u'frames': frames, u'rate': self.stream_rate,
+                                u'time': first_time, u'data': data})
 
     def clean_up(self):
         """
@@ -365,12 +455,37 @@ class ADXL345(threading.Thread):
         self.publisher.close()
         self.context.term()
 
+    def _stream(self):
+        """
+        Read and report FIFO blocks until stream mode is stopped
+        :return:
+        """
+        msg = self.i2c_device['adxl345']['commands']['read_fifo']
+        if self.stream_interval:
+            # the bridge repeats the read on its own, echoing the same request id
+            msg = [dict(msg[0], interval=self.stream_interval)]
+            request_id = next(self.request_ids)
+            self._send_to_device(msg, request_id)
+            while self.streaming and self.keep_reading:
+                self._process_fifo_message(request_id)
+        else:
+            while self.streaming and self.keep_reading:
+                request_id = next(self.request_ids)
+                self._send_to_device(msg, request_id)
+                self._process_fifo_message(request_id)
+
     def run(self):
         while True:
             try:
+                # wait here while reading is stopped
+                self.reading.wait()
+                if self.streaming:
+                    self._stream()
+                    continue
                 msg = self.i2c_device['adxl345']['commands']['read']
-                self._send_to_device(msg)
-                self._process_subscribed_message()
+                request_id = next(self.request_ids)
+                self._send_to_device(msg, request_id)
+                self._process_subscribed_message(request_id)
                 if self.read_time:
                     time.sleep(self.read_time)
             except KeyboardInterrupt:
@@ -0,0 +1,155 @@
+"""
+Copyright (c) 2016 Alan Yorinks All right reserved.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public
+License as published by the Free Software Foundation; either
+version 3 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+"""
+This file contains functions to decode ADXL345 data register frames.
+
+A frame is the 6 bytes read from the data registers: x, y and z, each as a little endian
+10 bit two's complement value. A block is any number of frames placed end to end, as returned
+by a FIFO burst read.
+"""
+
+import math
+import os
+import time
+
+# numpy is optional - it is only used to decode blocks of frames
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+EARTH_GRAVITY_MS2 = 9.80665
+
+# g per count at the 10 bit, 16 g range setting
+SCALE = .004
+
+FRAME_SIZE = 6
+
+
+def _twos_comp(val, bits):
+    if (val & (1 << (bits - 1))) != 0:
+        val -= 1 << bits
+    return val
+
+
+def decode_sample(raw):
+    """
+    Decode a single frame
+    :param raw: 6 bytes, or a list of 6 integers, from the data registers
+    :return: A dictionary containing the raw, g and acceleration values for each axis, and the pitch and roll
+    """
+    sample = {}
+    for axis, offset in (('x', 0), ('y', 2), ('z', 4)):
+        # get raw value for the axis - mask off bits not being used
+        value = raw[offset] | ((raw[offset + 1] & 0x3) << 8)
+        value = _twos_comp(value, 10)
+
+        # express the axis in g forces
+        g = round(value * SCALE, 4)
+
+        sample[axis + '_raw'] = value
+        sample[axis + '_g'] = g
+
+        # express the axis as a normalized acceleration
+        sample[axis + '_a'] = round(g * EARTH_GRAVITY_MS2, 4)
+
+    xa = sample['x_a']
+    ya = sample['y_a']
+    za = sample['z_a']
+    sample['pitch'] = int(-(math.atan2(xa, math.sqrt(ya * ya + za * za)) * 180.0) / math.pi)
+    sample['roll'] = int((math.atan2(ya, za) * 180.0) / math.pi)
+    return sample
+
+
+def decode_block(data):
+    """
+    Decode a block of frames in one pass.
+
+    The g and acceleration values are not rounded. Pitch and roll are truncated to whole degrees,
+    as they are by decode_sample.
+
+    If numpy is not installed, the frames are decoded one at a time and lists are returned in place
+    of arrays.
+    :param data: bytes containing one or more complete frames
+    :return: A dictionary containing:
+        raw: n x 3 array of int16 values
+        g: n x 3 array of g forces
+        accel: n x 3 array of accelerations in m/s^2
+        pitch: array of n pitch angles
+        roll: array of n roll angles
+    """
+    frames = len(data) // FRAME_SIZE
+
+    if not numpy:
+        samples = [decode_sample(data[i:i + FRAME_SIZE]) for i in range(0, frames * FRAME_SIZE, FRAME_SIZE)]
+        return {'raw': [[s['x_raw'], s['y_raw'], s['z_raw']] for s in samples],
+                'g': [[s['x_g'], s['y_g'], s['z_g']] for s in samples],
+                'accel': [[s['x_a'], s['y_a'], s['z_a']] for s in samples],
+                'pitch': [s['pitch'] for s in samples],
+                'roll': [s['roll'] for s in samples]}
+
+    words = numpy.frombuffer(bytes(data[:frames * FRAME_SIZE]), dtype='<u2').reshape(frames, 3)
+
+    # keep the low 10 bits and sign extend them
+    raw = (words & 0x3ff).astype(numpy.int16)
+    raw = (raw ^ 0x200) - 0x200
+
+    g = raw * SCALE
+    accel = g * EARTH_GRAVITY_MS2
+
+    xa = accel[:, 0]
+    ya = accel[:, 1]
+    za = accel[:, 2]
+    pitch = numpy.trunc(-numpy.degrees(numpy.arctan2(xa, numpy.sqrt(ya * ya + za * za)))).astype(int)
+    roll = numpy.trunc(numpy.degrees(numpy.arctan2(ya, za))).astype(int)
+
+    return {'raw': raw, 'g': g, 'accel': accel, 'pitch': pitch, 'roll': roll}
+
+
+def benchmark(frames=32, blocks=1000):
+    """
+    Compare decoding FIFO blocks frame by frame with decoding them in one numpy pass.
+    :param frames: Number of frames in each block - the ADXL345 FIFO holds 32
+    :param blocks: Number of blocks to decode
+    :return:
+    """
+    data = [os.urandom(frames * FRAME_SIZE) for x in range(blocks)]
+
+    start = time.perf_counter()
+    for block in data:
+        for i in range(0, len(block), FRAME_SIZE):
+            decode_sample(block[i:i + FRAME_SIZE])
+    scalar = time.perf_counter() - start
+    print('      scalar: {0:.1f} us per block, {1:.0f} samples per second'.format(
+        scalar / blocks * 1e6, frames * blocks / scalar))
+
+    if not numpy:
+        print('numpy is not installed')
+        return
+
+    start = time.perf_counter()
+    for block in data:
+        decode_block(block)
+    vectorised = time.perf_counter() - start
+    print('  vectorised: {0:.1f} us per block, {1:.0f} samples per second'.format(
+        vectorised / blocks * 1e6, frames * blocks / vectorised))
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,58 @@
+"""
+Copyright (c) 2016 Alan Yorinks All right reserved.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public
+License as published by the Free Software Foundation; either
+version 3 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+"""
+This file contains the ADXL345 descriptor for the I2CEngine.
+
+Run it directly to poll an ADXL345 on every board 10 times a second:
+
+    python3 adxl345_device.py <router ip address>
+"""
+
+import sys
+
+from xideco.i2c.i2c_device import I2CDevice, I2CRead
+from xideco.i2c.i2c_engine import I2CEngine
+from xideco.i2c.i2c_devices.adxl345.adxl345_decoder import decode_sample
+
+# initialization:
+#   Set the Power Control Register to 0
+#   Set the Power Control Register to 8 = Measure Bit enabled
+#   Set the Data Format Register to 8 for full resolution
+#   set the Data Format Resister to 3 - 10 bit resolution and 16 g range
+ADXL345_DEVICE = I2CDevice('adxl345', 83,
+                           init=[{u"cmd": u"init"},
+                                 {u"cmd": u"write_byte", u"register": 45, u"value": 0},
+                                 {u"cmd": u"write_byte", u"register": 45, u"value": 8},
+                                 {u"cmd": u"write_byte", u"register": 49, u"value": 8},
+                                 {u"cmd": u"write_byte", u"register": 49, u"value": 3}],
+                           reads={'acceleration': I2CRead(50, 6, decoder=decode_sample)})
+
+
+def data_callback(result):
+    values = result['values']
+    print('Board: {0}, Pitch: {1}, Roll: {2}.'.format(result['board'], values['pitch'], values['roll']))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        engine = I2CEngine(sys.argv[1])
+    else:
+        engine = I2CEngine()
+    engine.add_device(ADXL345_DEVICE, poll={'acceleration': 100}, callback=data_callback)
+    engine.receive_loop()
@@ -0,0 +1,250 @@
+"""
+Copyright (c) 2016 Alan Yorinks All right reserved.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public
+License as published by the Free Software Foundation; either
+version 3 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+import itertools
+import struct
+import time
+import uuid
+import zlib
+
+import umsgpack
+import zmq
+
+from xideco.common.action_scheduler import ActionScheduler
+from xideco.xidekit.xidekit import XideKit
+
+
+class I2CEngine(XideKit):
+    """
+    This class runs I2CDevice descriptors.
+
+    Any number of devices, on any number of boards, are run from a single receive loop over one
+    publisher and one subscriber. Requests are sent with the A + board number topic, or with the Q
+    topic to reach every board. Each read carries a request id, and replies are matched to the
+    device and read that requested them by that id. Replies are seen by every client subscribed to
+    the board, so the ids start with a prefix unique to this engine.
+
+    Each device may poll any of its reads at its own interval. A poll is skipped while the previous
+    read of the same kind is still waiting for a reply, so a slow device does not build up a backlog.
+
+    Results are passed to the device's callback and/or published with its publish topic as:
+        {'device': name, 'board': board number, 'read': read name, 'values': decoded values}
+    """
+
+    # pseudo board number indicating that requests are broadcast to all boards
+    BROADCAST = 5000
+
+    def __init__(self, router_ip_address=None, subscriber_port='43125', publisher_port='43124', reply_timeout=1.0,
+                 standby_router_ip_address=None):
+        """
+        :param router_ip_address: Xideco Router IP Address - if not specified, the router is discovered
+        :param subscriber_port: Xideco router subscriber port. This must match that of the Xideco router
+        :param publisher_port: Xideco router publisher port. This must match that of the Xideco router
+        :param reply_timeout: Time in seconds after which a read without a reply is abandoned
+        :param standby_router_ip_address: Router to use if the router stops responding
+        :return:
+        """
+        super().__init__(router_ip_address, subscriber_port, publisher_port, standby_router_ip_address)
+
+        # replies are published by the boards with B + board number
+        self.set_subscriber_topic('B')
+
+        self.reply_timeout = reply_timeout
+
+        self.scheduler = ActionScheduler()
+
+        self.poller = zmq.Poller()
+        self.poller.register(self.subscriber, zmq.POLLIN)
+
+        client_id = uuid.uuid4().hex[:12]
+        self.request_ids = (client_id + '-' + str(n) for n in itertools.count())
+
+        # requests waiting for a reply - request id: [attachment, read name, deadline]
+        self.pending = {}
+
+        # attached devices
+        self.attachments = []
+
+        # number of reads abandoned because no reply was received
+        self.timeouts = 0
+
+    def add_device(self, device, board=BROADCAST, poll=None, callback=None, publish_topic=None):
+        """
+        Attach a device and send its initialization requests.
+        :param device: I2CDevice descriptor
+        :param board: Board number or BROADCAST to use the device on all boards
+        :param poll: Optional dictionary of read name to polling interval in milliseconds
+        :param callback: Optional function called with each result
+        :param publish_topic: Optional topic used to publish each result
+        :return: The attachment. It may be passed to read and remove_device.
+        """
+        for read_name in poll or {}:
+            if read_name not in device.reads:
+                raise ValueError(device.name + ' has no read named ' + read_name)
+
+        if board < self.BROADCAST:
+            topic = 'A' + str(board)
+        else:
+            topic = 'Q'
+
+        attachment = {'device': device, 'board': board, 'topic': topic, 'callback': callback,
+                      'publish_topic': publish_topic, 'outstanding': {}}
+        self.attachments.append(attachment)
+
+        self._send(attachment, device.init)
+
+        for read_name, interval in (poll or {}).items():
+            self.scheduler.schedule(0, self._poll, attachment, read_name, interval / 1000,
+                                    key=('poll', id(attachment), read_name))
+        return attachment
+
+    def remove_device(self, attachment):
+        """
+        Stop polling a device and forget it
+        :param attachment: An attachment returned by add_device
+        :return:
+        """
+        for read_name in attachment['device'].reads:
+            self.scheduler.cancel_key(('poll', id(attachment), read_name))
+        for request_id in [k for k, v in self.pending.items() if v[0] is attachment]:
+            del self.pending[request_id]
+        self.attachments.remove(attachment)
+
+    def read(self, attachment, read_name):
+        """
+        Request a read. The result is reported when the reply arrives.
+        :param attachment: An attachment returned by add_device
+        :param read_name: Name of the read in the device descriptor
+        :return:
+        """
+        request_id = next(self.request_ids)
+        self.pending[request_id] = [attachment, read_name, time.monotonic() + self.reply_timeout]
+        # the request id of the latest read of each kind
+        attachment['outstanding'][read_name] = request_id
+        self._send(attachment, [attachment['device'].reads[read_name].request()], request_id)
+
+    def _send(self, attachment, requests, request_id=None):
+        """
+        Send i2c requests to a device. More than one request is sent as a single batch.
+        :param attachment: device attachment
+        :param requests: list of i2c_request messages without the device address
+        :param request_id: Optional request id
+        :return:
+        """
+        if len(requests) > 1:
+            request = {u"cmd": u"batch", u"requests": requests}
+        else:
+            request = dict(requests[0])
+
+        request[u"command"] = u"i2c_request"
+        request[u"device_address"] = attachment['device'].device_address
+        if request_id is not None:
+            request[u"request_id"] = request_id
+        self.publish_payload(request, attachment['topic'])
+
+    def _poll(self, attachment, read_name, interval):
+        """
+        Perform a polled read and schedule the next one
+        :param attachment: device attachment
+        :param read_name: read name
+        :param interval: polling interval in seconds
+        :return:
+        """
+        if read_name not in attachment['outstanding']:
+            self.read(attachment, read_name)
+        self.scheduler.schedule(interval, self._poll, attachment, read_name, interval,
+                                key=('poll', id(attachment), read_name))
+
+    def _expire_requests(self):
+        """
+        Abandon reads whose replies have not arrived in time.
+
+        Broadcast reads may be answered by several boards, so they are only removed here.
+        :return:
+        """
+        now = time.monotonic()
+        for request_id in [k for k, v in self.pending.items() if v[2] < now]:
+            attachment, read_name, deadline = self.pending.pop(request_id)
+            if attachment['outstanding'].get(read_name) == request_id:
+                del attachment['outstanding'][read_name]
+                self.timeouts += 1
+
+    def incoming_message_processing(self, topic, payload):
+        """
+        Decode and report i2c replies
+        :param topic: Message Topic string
+        :param payload: Message Data
+        :return:
+        """
+        if payload.get('command') != 'i2c_reply':
+            return
+
+        request_id = payload.get('request_id')
+        entry = self.pending.get(request_id)
+        if not entry:
+            return
+
+        attachment, read_name = entry[0], entry[1]
+        if attachment['outstanding'].get(read_name) == request_id:
+            del attachment['outstanding'][read_name]
+        if attachment['board'] < self.BROADCAST:
+            del self.pending[request_id]
+
+        device = attachment['device']
+        try:
+            values = device.reads[read_name].decode(payload['data'])
+        except (KeyError, TypeError, ValueError, struct.error) as e:
+            # a short reply, e.g. from a failed bus transaction
+            print(device.name + ' ' + read_name + ': reply could not be decoded - ' + str(e))
+            return
+        result = {u'device': device.name, u'board': int(topic[1:]), u'read': read_name, u'values': values}
+
+        if attachment['callback']:
+            attachment['callback'](result)
+        if attachment['publish_topic']:
+            self.publish_payload(result, attachment['publish_topic'])
+
+    def receive_loop(self):
+        """
+        Process replies and run polls. Replies are waited for with a poller until the next poll is due.
+        :return:
+        """
+        while True:
+            try:
+                timeout = self.scheduler.next_due()
+                if timeout is None or timeout > .1:
+                    timeout = .1
+
+                if self.poller.poll(timeout * 1000):
+                    # process every message that is waiting
+                    while True:
+                        try:
+                            data = self.subscriber.recv_multipart(zmq.NOBLOCK)
+                        except zmq.error.Again:
+                            break
+                        try:
+                            self.process_message(data)
+                        except (IndexError, umsgpack.UnpackException, zlib.error):
+                            print('Discarding a message that could not be unpacked')
+                self.check_router()
+                self.heartbeat.tick()
+
+                self.scheduler.run_pending()
+                self._expire_requests()
+            except KeyboardInterrupt:
+                self.clean_up()
@@ -21,6 +21,8 @@ Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 """
 
 import argparse
+import array
+import collections
 import time
 
 import pigpio
@@ -28,12 +30,26 @@ import umsgpack
 
 # noinspection PyPackageRequirements
 import zmq
+from xideco.common.action_scheduler import ActionScheduler
+from xideco.common.clock_sync import ClockSync, SyncedClock, TickMapper
+from xideco.common.command_coalescer import CommandCoalescer
+from xideco.common.compression import MessageCompressor, unpack_message
+from xideco.common.failover import HEARTBEAT_TOPIC, RouterFailover
+from xideco.common.instrumentation import Instrumentation
+from xideco.common.liveness import Heartbeat
+from xideco.common.publisher_hub import PublisherHub
+from xideco.common import discovery
+from xideco.common import rpc
 from xideco.data_files.port_map import port_map
 
+import queue
 import signal
 import sys
 import threading
 
+# edge ticks are published as unsigned 32 bit integers - use an array type code of that size
+TICK_TYPECODE = 'I' if array.array('I').itemsize == 4 else 'L'
+
 
 # noinspection PyMethodMayBeStatic,PyUnresolvedReferences,PyUnresolvedReferences,PyUnresolvedReferences
 class RaspberryPiBridge:
@@ -43,10 +59,15 @@ class RaspberryPiBridge:
 
     """
 
-    def __init__(self, pi, board_num, router_ip_address):
+    def __init__(self, pi, board_num, router_ip_address, max_actuation_rate=50, compression_threshold=0,
+                 standby_router_ip_address=None, instrumentation_interval=0):
         """
         :param pigpio: pigpio instance
         :param board_num: System Board Number (1-10)
+        :param max_actuation_rate: Maximum servo/PWM updates per second for each pin
+        :param compression_threshold: Reports of at least this many bytes are compressed - 0 = no compression
+        :param standby_router_ip_address: Router to use if the router stops responding
+        :param instrumentation_interval: Seconds between instrumentation stats reports - 0 = off
         :return:
         """
         self.pi = pi
@@ -109,10 +130,8 @@ class RaspberryPiBridge:
         pigpio_ver = self.pi.get_pigpio_version()
         print('PIGPIO REV: ' + str(pigpio_ver))
 
-        if self.router_ip_address == 'None':
-            self.router_ip_address = port_map.port_map['router_ip_address']
-        else:
-            self.router_ip_address = router_ip_address
+        # if not specified, the router is discovered
+        self.router_ip_address = discovery.resolve_router_ip_address(router_ip_address)
 
         print('Xideco Raspberry Pi Bridge - xirp')
         print('\n**************************************')
@@ -134,10 +153,24 @@ class RaspberryPiBridge:
         # subscribe to broadcast i2c message - i2c messages can also be board specific with A + board number
         self.subscriber.setsockopt(zmq.SUBSCRIBE, 'Q'.encode())
 
-        self.publisher = self.context.socket(zmq.PUB)
-        connect_string = "tcp://" + self.router_ip_address + ':' + port_map.port_map['publish_to_router_port']
+        # large reports may be compressed
+        if compression_threshold:
+            compressor = MessageCompressor(['B' + self.board_num], compression_threshold)
+        else:
+            compressor = None
+
+        # all threads of the bridge publish through a single connection to the router
+        self.publisher_hub = PublisherHub(self.context, self.router_ip_address, compressor=compressor)
+        self.publisher_hub.start()
+        self.publisher = self.publisher_hub.create_publisher()
 
-        self.publisher.connect(connect_string)
+        # reports are stamped with a clock synchronised to the router
+        self.clock = SyncedClock()
+        self.clock_sync = ClockSync(self.context, self.router_ip_address, self.clock, self.publisher, self.board_num)
+        self.clock_sync.start()
+
+        # pigpio ticks are converted to clock times
+        self.tick_mapper = TickMapper(self.clock, self.pi.get_current_tick)
 
         # The Xideco protocol message received
         self.payload = None
@@ -145,18 +178,78 @@ class RaspberryPiBridge:
         self.command_dict = {'digital_pin_mode': self.setup_digital_pin, 'digital_write': self.digital_write,
                              'analog_pin_mode': self.setup_analog_pin, 'analog_write': self.analog_write,
                              'set_servo_position': self.set_servo_position, 'play_tone': self.play_tone,
-                             'tone_off': self.tone_off, 'i2c_request': self.i2c_request}
+                             'tone_off': self.tone_off, 'i2c_request': self.i2c_request,
+                             'edge_capture': self.edge_capture}
 
         self.last_problem = ''
 
         self.sonar = None
         self.a_to_d = None
 
-        self.i2c_handle_dict = {}
+        # i2c requests are processed by a separate bus worker thread
+        self.i2c_worker = None
+
+        # edge capture - pins in capture mode. key = pin, value = True if edges are only counted
+        self.edge_capture_pins = {}
+        # the pigpio callback to cbf for each pin - one per pin, shared by digital inputs and edge capture
+        self.edge_callbacks = {}
+        # pins set to digital Input, which keep their callback when edge capture is disabled
+        self.input_pins = set()
+        # edge counts for pins in count mode
+        self.edge_counts = {}
+
+        # captured edges - gpio and level as unsigned bytes, tick as unsigned 32 bit integers
+        self.edge_gpios = array.array('B')
+        self.edge_levels = array.array('B')
+        self.edge_ticks = array.array(TICK_TYPECODE)
+
+        # the pigpio callback thread fills the buffers and the command loop empties them
+        self.edge_lock = threading.Lock()
+
+        self.edge_batch_size = 64
+        self.edge_flush_time = .02
+        self.edge_last_flush = time.monotonic()
+
+        # servo and PWM commands are coalesced so that only the latest value for a pin is actuated
+        self.coalescer = CommandCoalescer(max_actuation_rate)
+
+        # commands that need a reply are received through the RPC channel
+        self.rpc_server = rpc.RpcServer(self.context, self.router_ip_address, 'A' + self.board_num, self.rpc_request)
+
+        # if the router stops responding, the bridge moves to the standby router
+        self.failover = RouterFailover(self.router_ip_address, standby_router_ip_address)
+        self.failover.watch(self.subscriber)
+        self.failover.add_callback(self.publisher_hub.reconnect)
+        self.failover.add_callback(self.clock_sync.reconnect)
+        self.failover.add_callback(self.rpc_server.reconnect)
+
+        # heartbeats tell the router that the bridge is running, and how busy it is - see liveness.py
+        self.heartbeat = Heartbeat(self.publisher, 'xirb', self.board_num, queue_depth=self.queue_depth,
+                                   clock=self.clock)
+
+        # command, report and main loop timings - see instrumentation.py
+        self.instrumentation = Instrumentation(self.publisher, 'xirb', self.board_num, self.clock,
+                                               instrumentation_interval)
+
+        # timed actions, such as turning off a tone, are run from the command loop by the scheduler
+        self.scheduler = ActionScheduler()
+
+        # tones currently playing - key = pin, value = frequency
+        self.active_tones = {}
+
+        # approximate length in microseconds of the wave used when several tones play at once
+        self.tone_wave_length = 20000
+
+        # time to allow a servo to move before its pulses are stopped
+        self.servo_move_time = .6
 
     def setup_analog_pin(self):
         """
         This method validates and configures a pin for analog input
+
+        Optional payload values apply to all A/D channels:
+            period: time between samples in milliseconds
+            report_changes_only: if True, a channel is only reported when its value changes
         :return: None
         """
         # clear out any residual problem strings
@@ -165,9 +258,14 @@ class RaspberryPiBridge:
         self.last_problem = '2-0\n'
 
         if not self.a_to_d:
-            self.a_to_d = AtoD(self.pi, 1, 0x48, self.board_num)
+            self.a_to_d = AtoD(self.pi, 1, 0x48, self.board_num, self.publisher, self.clock)
             self.a_to_d.start()
 
+        if 'period' in self.payload:
+            self.a_to_d.period = float(self.payload['period']) / 1000
+        if 'report_changes_only' in self.payload:
+            self.a_to_d.report_changes_only = bool(self.payload['report_changes_only'])
+
         # test pin range 0-3
 
         pin = int(self.payload['pin'])
@@ -216,7 +314,7 @@ class RaspberryPiBridge:
             if enable == 'Enable':
                 self.enable_sonar(trigger_pin, echo_pin)
             else:
-                self.disable_sonar()
+                self.disable_sonar(trigger_pin)
 
         else:
 
@@ -236,7 +334,8 @@ class RaspberryPiBridge:
                     # update the pin table
                     pin_entry = {'mode': pigpio.INPUT, 'enabled': True}
                     self.pins[pin] = pin_entry
-                    self.pi.callback(pin, pigpio.EITHER_EDGE, self.cbf)
+                    self.input_pins.add(pin)
+                    self.watch_edges(pin)
                 elif mode == 'Output':
                     self.pi.set_mode(pin, pigpio.OUTPUT)
 
@@ -272,6 +371,65 @@ class RaspberryPiBridge:
                 pin_entry['enabled'] = False
                 self.pins[pin] = self.pin_entry
 
+    def edge_capture(self):
+        """
+        This method enables or disables edge capture for an input pin.
+
+        Instead of publishing one digital_read message per edge, captured edges are buffered as
+        (gpio, level, tick) triples and published together in an edge_batch message when
+        batch_size edges have been captured or flush_time milliseconds have passed.
+
+        Optional payload values:
+            batch_size: number of edges per batch (default 64)
+            flush_time: maximum time in milliseconds an edge is held before being sent (default 20)
+            glitch: pigpio glitch filter steady time in microseconds (default 0 = off)
+            count: if True, edges are only counted and an edge_count message containing the count
+                   and frequency is published every flush_time milliseconds. Both edges of each cycle
+                   are counted, so the frequency is half the edge rate.
+        :return:
+        """
+        self.last_problem = '8-0\n'
+
+        pin = self.validate_pin()
+        if pin == 99:
+            self.last_problem = '8-1\n'
+            return
+
+        if self.payload['enable'] != 'Enable':
+            # a digital input keeps its callback, for digital_read reports
+            if pin in self.edge_callbacks and pin not in self.input_pins:
+                self.edge_callbacks.pop(pin).cancel()
+            with self.edge_lock:
+                self.edge_capture_pins.pop(pin, None)
+                self.edge_counts.pop(pin, None)
+            self.pi.set_glitch_filter(pin, 0)
+            # send anything that is still buffered
+            self.flush_edges(True)
+            return
+
+        self.edge_batch_size = int(self.payload.get('batch_size', self.edge_batch_size))
+        self.edge_flush_time = float(self.payload.get('flush_time', self.edge_flush_time * 1000)) / 1000
+
+        self.pi.set_mode(pin, pigpio.INPUT)
+        self.pins[pin] = {'mode': pigpio.INPUT, 'enabled': True}
+        self.pi.set_glitch_filter(pin, int(self.payload.get('glitch', 0)))
+
+        with self.edge_lock:
+            self.edge_capture_pins[pin] = bool(self.payload.get('count', False))
+            if self.edge_capture_pins[pin]:
+                self.edge_counts[pin] = 0
+
+        self.watch_edges(pin)
+
+    def watch_edges(self, pin):
+        """
+        Have the edges of a pin passed to cbf. A pin is given only one callback, so each edge is seen once.
+        :param pin: GPIO pin
+        :return:
+        """
+        if pin not in self.edge_callbacks:
+            self.edge_callbacks[pin] = self.pi.callback(pin, pigpio.EITHER_EDGE, self.cbf)
+
     def analog_write(self):
         """
         Set a PWM configured pin to the requested value
@@ -335,6 +493,7 @@ class RaspberryPiBridge:
     def play_tone(self):
         """
         This method will play a tone using a wave.
+        The tone is turned off by the action scheduler, so the command loop is not blocked while it plays.
         :return: None
         """
         # clear out any residual problem strings
@@ -350,25 +509,18 @@ class RaspberryPiBridge:
         if pin_state['mode'] != pigpio.OUTPUT:
             self.last_problem = '5-2\n'
             return
-        frequency = int((1000 / int(self.payload['frequency'])) * 1000)
+        frequency = int(self.payload['frequency'])
         duration = int(self.payload['duration'])
 
-        tone = [pigpio.pulse(1 << pin, 0, frequency), pigpio.pulse(0, 1 << pin, frequency)]  # flash every 100 ms
-
-        self.pi.wave_clear()
-
-        self.pi.wave_add_generic(tone)  # 100 ms flashes
-        tone_wave = self.pi.wave_create()  # create and save id
-        self.pi.wave_send_repeat(tone_wave)
+        self.active_tones[pin] = frequency
+        self.build_tone_wave()
 
         if duration == 0:
+            # play until a tone_off is received - cancel any pending "tone off" for this pin
+            self.scheduler.cancel_key(('tone', pin))
             return
 
-        sleep_time = duration * .001
-        time.sleep(sleep_time)
-        self.pi.wave_tx_stop()  # stop waveform
-
-        self.pi.wave_clear()  # clear all waveforms
+        self.scheduler.schedule(duration * .001, self.stop_tone, pin, key=('tone', pin))
 
     def tone_off(self):
         self.last_problem = '6-0\n'
@@ -378,19 +530,55 @@ class RaspberryPiBridge:
             self.last_problem = '6-1\n'
             return
 
-        self.pi.wave_tx_stop()  # stop waveform
+        self.scheduler.cancel_key(('tone', pin))
+        self.stop_tone(pin)
+
+    def stop_tone(self, pin):
+        """
+        Stop the tone playing on a pin. Tones on other pins continue to play.
+        :param pin: GPIO pin
+        :return:
+        """
+        if self.active_tones.pop(pin, None) is not None:
+            self.build_tone_wave()
+
+    def build_tone_wave(self):
+        """
+        Create and transmit a single repeating wave containing all of the active tones.
 
+        pigpio can only transmit one wave at a time, so the pulse trains for each pin are merged
+        into one wave. When more than one tone is active, each pin's pulse train is extended to
+        approximately tone_wave_length microseconds so that the trains line up when the wave repeats.
+        :return:
+        """
+        self.pi.wave_tx_stop()  # stop waveform
         self.pi.wave_clear()  # clear all waveforms
 
+        if not self.active_tones:
+            return
+
+        for pin, frequency in self.active_tones.items():
+            # time in microseconds for each half of the cycle
+            half_period = max(1, int(500000 / frequency))
+
+            if len(self.active_tones) == 1:
+                cycles = 1
+            else:
+                cycles = max(1, int(round(self.tone_wave_length / (2 * half_period))))
+
+            tone = [pigpio.pulse(1 << pin, 0, half_period), pigpio.pulse(0, 1 << pin, half_period)] * cycles
+
+            # pulses added for each pin are merged in time with those already in the wave
+            self.pi.wave_add_generic(tone)
+
+        tone_wave = self.pi.wave_create()  # create and save id
+        self.pi.wave_send_repeat(tone_wave)
+
     def set_servo_position(self):
         """
         Set a servo position
        :return:
         """
-
-        # time to allow servo to move
-        delay = .6
-
         self.last_problem = '7-0\n'
 
         pin = self.validate_pin()
@@ -412,43 +600,23 @@ class RaspberryPiBridge:
         position = (position * 11) + 500
 
         self.pi.set_servo_pulsewidth(pin, position)  # 0 degree
-        time.sleep(delay)
-        self.pi.set_servo_pulsewidth(pin, 0)
 
-    def i2c_request(self):
-        cmd = self.payload['cmd']
-        addr = self.payload['device_address']
+        # allow time for the servo to move, then stop the pulses.
+        # A new position for this pin restarts the timer.
+        self.scheduler.schedule(self.servo_move_time, self.pi.set_servo_pulsewidth, pin, 0, key=('servo', pin))
 
-        if cmd == 'init':
-            handle = self.pi.i2c_open(1, addr)
-            self.i2c_handle_dict.update({addr: handle})
-        elif cmd == 'write_byte':
-            # get handle
-            value = self.payload['value']
-            handle = self.i2c_handle_dict[addr]
-            register = self.payload['register']
-            self.pi.i2c_write_byte_data(handle, register, value)
-        elif cmd == 'read_block':
-            num_bytes = self.payload['num_bytes']
-            handle = self.i2c_handle_dict[addr]
-            register = self.payload['register']
-            data = self.pi.i2c_read_i2c_block_data(handle, register, num_bytes)
-            self.report_i2c_data(data)
-        else:
-            print('unknown cmd')
-
-    def report_i2c_data(self, data):
-        # create a topic specific to the board number of this board
-        envelope = ("B" + self.board_num).encode()
-
-        # extract bytes from returned byte array and place in a list
-        rdata = []
-        for x in data[1]:
-            rdata.append(x)
-
-        msg = umsgpack.packb({u"command": "i2c_reply", u"board": self.board_num, u"data": rdata})
+    def i2c_request(self):
+        """
+        Hand an i2c request to the i2c bus worker thread so that bus transactions do not
+        stall GPIO command handling.
+        :return:
+        """
+        if not self.i2c_worker:
+            self.i2c_worker = I2CBusWorker(self.pi, self.publisher, self.board_num, self.clock)
+            self.i2c_worker.start()
 
-        self.publisher.send_multipart([envelope, msg])
+        # the payload is replaced with each received message, so the worker gets its own copy
+        self.i2c_worker.requests.put(dict(self.payload))
 
     def run_raspberry_bridge(self):
         # self.pi.set_mode(11, pigpio.INPUT)
@@ -460,27 +628,121 @@ class RaspberryPiBridge:
             try:
                 z = self.subscriber.recv_multipart(zmq.NOBLOCK)
 
-                self.payload = umsgpack.unpackb(z[1])
+                payload = unpack_message(z)
+                self.heartbeat.message()
 
-                command = self.payload['command']
-                if command in self.command_dict:
-                    self.command_dict[command]()
+                if z[0] == HEARTBEAT_TOPIC:
+                    self.router_heartbeat(payload)
                 else:
-                    print("can't execute unknown command'")
-                    # time.sleep(.001)
+                    for payload in self.coalescer.submit(z[0], payload):
+                        self.dispatch_command(payload)
+                        # time.sleep(.001)
             except KeyboardInterrupt:
                 self.cleanup()
                 sys.exit(0)
             except zmq.error.Again:
                 time.sleep(.001)
+            # move to the standby router if the router has stopped responding
+            self.failover.check()
+            # publish a heartbeat when due
+            self.heartbeat.tick(self.coalescer.dropped + self.publisher.dropped)
+            self.instrumentation.loop_pass()
+            # execute commands received through the RPC channel
+            self.rpc_server.process_requests()
+            # actuate any coalesced commands whose rate limit has expired
+            for payload in self.coalescer.due():
+                self.dispatch_command(payload)
+            # run any timed actions that are due
+            self.scheduler.run_pending()
+            # publish captured edges
+            self.flush_edges()
+            # keep the tick to clock time conversion up to date
+            self.tick_mapper.refresh_if_due()
+
+    def dispatch_command(self, payload):
+        """
+        Execute a single Xideco protocol command
+        :param payload: The unpacked command message
+        :return:
+        """
+        self.payload = payload
+        command = self.payload['command']
+        if command in self.command_dict:
+            self.instrumentation.dispatch(command, self.command_dict[command])
+        else:
+            print("can't execute unknown command'")
+
+    def queue_depth(self):
+        """
+        :return: The number of commands waiting to be executed, including i2c requests
+        """
+        if self.i2c_worker:
+            return len(self.coalescer.pending) + self.i2c_worker.requests.qsize()
+        return len(self.coalescer.pending)
+
+    def router_heartbeat(self, payload):
+        """
+        Process a router heartbeat, and report any gap in the heartbeats
+        :param payload: The heartbeat message
+        :return:
+        """
+        report = self.failover.heartbeat(payload)
+        if report:
+            report[u"board"] = self.board_num
+            print('No router heartbeats for ' + str(round(report['duration'], 1)) +
+                  ' seconds - messages may have been lost')
+            self.publisher.send_multipart([("B" + self.board_num).encode(), umsgpack.packb(report)])
+
+    def rpc_request(self, payload):
+        """
+        Execute a command received through the RPC channel, and reply with its outcome
+        :param payload: The unpacked command message
+        :return: reply
+        """
+        if payload.get('command') == 'instrumentation':
+            return self.instrumentation.rpc_request(payload)
+        if payload.get('command') not in self.command_dict:
+            return rpc.error_reply(rpc.UNKNOWN_COMMAND, str(payload.get('command')))
+
+        # acknowledged commands are not rate limited, but are executed after the commands waiting for their pin
+        commands = self.coalescer.immediate(self.rpc_server.service, payload)
+        for command in commands[:-1]:
+            self.dispatch_command(command)
+        if self.last_problem:
+            self.report_problem()
+
+        self.dispatch_command(payload)
+        return rpc.problem_reply(self.last_problem)
 
     def enable_sonar(self, trigger, echo):
-        self.sonar = Sonar(self.pi, trigger, echo, self.board_num)
-        self.sonar.start()
+        """
+        Add a trigger/echo pair to the sonar service. Several pairs may be enabled.
+
+        Optional payload values, in milliseconds, apply to all rangers:
+            ping_interval: time between successive triggers
+            report_interval: time between distance reports
+        :param trigger: trigger gpio
+        :param echo: echo gpio
+        :return:
+        """
+        if not self.sonar:
+            self.sonar = SonarService(self.pi, self.scheduler, self.publisher, self.board_num, self.clock)
 
-    def disable_sonar(self):
+        if 'ping_interval' in self.payload:
+            self.sonar.ping_interval = float(self.payload['ping_interval']) / 1000
+        if 'report_interval' in self.payload:
+            self.sonar.report_interval = float(self.payload['report_interval']) / 1000
+
+        self.sonar.add(trigger, echo)
+
+    def disable_sonar(self, trigger):
+        """
+        Remove a trigger/echo pair from the sonar service
+        :param trigger: trigger gpio
+        :return:
+        """
         if self.sonar:
-            self.sonar.cancel()
+            self.sonar.remove(trigger)
 
     def report_problem(self):
         """
@@ -505,16 +767,86 @@ class RaspberryPiBridge:
         :return:
         """
 
+        # pins in edge capture mode are buffered and sent by flush_edges
+        if gpio in self.edge_capture_pins:
+            with self.edge_lock:
+                count_only = self.edge_capture_pins.get(gpio)
+                if count_only:
+                    self.edge_counts[gpio] += 1
+                elif count_only is not None:
+                    self.edge_gpios.append(gpio)
+                    self.edge_levels.append(level)
+                    self.edge_ticks.append(tick)
+            return
+
         # if the pin has reports disabled, just ignore
         pin_state = self.pins[gpio]
 
         # if user changes modes suppress output from being sent upstream
         if pin_state['mode'] == pigpio.OUTPUT:
             return
-        digital_reply_msg = umsgpack.packb({u"command": "digital_read", u"pin": str(gpio), u"value": str(level)})
+        # the latency measured is from the edge to the publishing of its report
+        edge_time = self.tick_mapper.time_of(tick)
+        digital_reply_msg = self.instrumentation.pack({u"command": "digital_read", u"pin": str(gpio),
+                                                       u"value": str(level), u"time": edge_time})
 
         envelope = ("B" + self.board_num).encode()
         self.publisher.send_multipart([envelope, digital_reply_msg])
+        self.instrumentation.published(edge_time)
+
+    def flush_edges(self, force=False):
+        """
+        Publish captured edges and edge counts. This is called on every pass of the command loop.
+
+        An edge_batch message contains the gpio numbers and levels as byte strings and the ticks
+        as a byte string of little endian unsigned 32 bit integers. Entry n of each belongs to edge n.
+        The time of the first edge is included. The time of edge n is time + tickDiff(ticks[0], ticks[n]) / 1e6.
+        :param force: Publish whatever is buffered without checking the batch size and flush time
+        :return:
+        """
+        if not self.edge_capture_pins and not force:
+            return
+
+        now = time.monotonic()
+        elapsed = now - self.edge_last_flush
+
+        if not force and len(self.edge_ticks) < self.edge_batch_size and elapsed < self.edge_flush_time:
+            return
+
+        # swap out the buffers while holding the lock, and pack them after releasing it
+        with self.edge_lock:
+            gpios, self.edge_gpios = self.edge_gpios, array.array('B')
+            levels, self.edge_levels = self.edge_levels, array.array('B')
+            ticks, self.edge_ticks = self.edge_ticks, array.array(TICK_TYPECODE)
+
+            counts = []
+            if elapsed >= self.edge_flush_time or force:
+                self.edge_last_flush = now
+                for pin in self.edge_counts:
+                    counts.append((pin, self.edge_counts[pin]))
+                    self.edge_counts[pin] = 0
+
+        envelope = ("B" + self.board_num).encode()
+
+        if ticks:
+            first_time = self.tick_mapper.time_of(ticks[0])
+            if sys.byteorder != 'little':
+                ticks.byteswap()
+            msg = self.instrumentation.pack({u"command": "edge_batch", u"board": self.board_num,
+                                             u"gpios": gpios.tobytes(), u"levels": levels.tobytes(),
+                                             u"ticks": ticks.tobytes(), u"time": first_time})
+            self.publisher.send_multipart([envelope, msg])
+            self.instrumentation.published(first_time)
+
+        for pin, count in counts:
+            if elapsed:
+                # rising and falling edges are both counted - two per cycle
+                frequency = round(count / 2 / elapsed, 2)
+            else:
+                frequency = 0
+            msg = umsgpack.packb({u"command": "edge_count", u"board": self.board_num, u"pin": str(pin),
+                                  u"count": count, u"frequency": frequency, u"time": self.clock.now()})
+            self.publisher.send_multipart([envelope, msg])
 
     def cleanup(self):
         print('\nExiting...')
@@ -543,9 +875,225 @@ class RaspberryPiBridge:
         return pin
 
 
-class Sonar(threading.Thread):
+class I2CBusWorker(threading.Thread):
+    """
+    This class performs i2c transactions for the Raspberry Pi bridge on its own thread.
+
+    Requests are placed on a queue by the bridge. Device handles are pooled by (bus, address),
+    so devices on any i2c bus may be used. A read_block or read_fifo request containing an 'interval'
+    value (in milliseconds) is repeated at that interval until a 'stop_read' request is received.
+
+    Read data is published as a single bytes object rather than as a list of integers. If a request
+    contains a 'request_id', it is included in the reply. A 'batch' request contains a list of
+    requests that are performed in order.
+
+    A failed i2c transaction is reported as problem 10-1, and a periodic read carries on at its
+    next interval.
+    """
+
+    def __init__(self, rpi, publisher, board_num, clock):
+        """
+        :param rpi: pigpio instance
+        :param publisher: The bridge's HubPublisher
+        :param board_num: System Board Number (1-10)
+        :param clock: The bridge's SyncedClock, used to stamp replies
+        :return:
+        """
+        super().__init__()
+        self.daemon = True
+
+        self.pi = rpi
+        self.board_num = board_num
+
+        # requests placed here by the bridge
+        self.requests = queue.Queue()
+
+        # i2c handles - key = (bus, device address)
+        self.handles = {}
+
+        # periodic reads are run from this thread's own scheduler
+        self.scheduler = ActionScheduler()
+
+        self.publisher = publisher
+        self.clock = clock
+
+        self.envelope = ("B" + self.board_num).encode()
+
+    def get_handle(self, bus, address):
+        """
+        Retrieve the handle for a device, opening it if necessary
+        :param bus: i2c bus number
+        :param address: i2c device address
+        :return: pigpio i2c handle
+        """
+        key = (bus, address)
+        handle = self.handles.get(key)
+        if handle is None:
+            handle = self.pi.i2c_open(bus, address)
+            self.handles[key] = handle
+        return handle
+
+    def process_request(self, request):
+        """
+        Perform a single i2c request
+        :param request: i2c_request payload
+        :return:
+        """
+        cmd = request['cmd']
+        addr = request['device_address']
+        bus = request.get('bus', 1)
+
+        request_id = request.get('request_id')
+
+        if cmd == 'batch':
+            for item in request['requests']:
+                item = dict(item)
+                item.setdefault('device_address', addr)
+                item.setdefault('bus', bus)
+                if request_id is not None:
+                    item.setdefault('request_id', request_id)
+                self.process_request(item)
+        elif cmd == 'init':
+            self.get_handle(bus, addr)
+        elif cmd == 'write_byte':
+            handle = self.get_handle(bus, addr)
+            self.pi.i2c_write_byte_data(handle, request['register'], request['value'])
+        elif cmd == 'read_block' or cmd == 'read_fifo':
+            if cmd == 'read_block':
+                read = self.read_block
+                args = (bus, addr, request['register'], request['num_bytes'], request_id)
+            else:
+                read = self.read_fifo
+                args = (bus, addr, request['register'], request['num_bytes'], request['status_register'],
+                        request.get('mask', 0x3f), request_id)
+
+            interval = request.get('interval', 0)
+            if interval:
+                self.periodic_read(interval * .001, read, *args)
+            else:
+                read(*args)
+        elif cmd == 'stop_read':
+            if 'register' in request:
+                self.scheduler.cancel_key(('read', bus, addr, request['register']))
+            else:
+                for key in [k for k in self.scheduler.keyed if k[1:3] == (bus, addr)]:
+                    self.scheduler.cancel_key(key)
+        else:
+            print('unknown cmd')
+
+    def report_problem(self, problem, error):
+        """
+        Publish a problem report for a failed i2c transaction
+        :param problem: problem code
+        :param error: the exception raised
+        :return:
+        """
+        print('i2c request failed: ' + str(error))
+        msg = umsgpack.packb({u"command": "problem", u"board": self.board_num, u"problem": problem})
+        self.publisher.send_multipart([self.envelope, msg])
+
+    def publish_reply(self, reply, request_id):
+        """
+        Publish an i2c_reply message, stamping it with the synced time unless it already carries one
+        :param reply: reply message
+        :param request_id: id of the request being replied to, or None
+        :return:
+        """
+        if request_id is not None:
+            reply[u"request_id"] = request_id
+        reply.setdefault(u"time", self.clock.now())
+        self.publisher.send_multipart([self.envelope, umsgpack.packb(reply)])
+
+    def read_block(self, bus, address, register, num_bytes, request_id=None):
+        """
+        Read a block of data and publish it
+        :param bus: i2c bus number
+        :param address: i2c device address
+        :param register: starting register
+        :param num_bytes: number of bytes to read
+        :param request_id: id of the request, or None
+        :return:
+        """
+        handle = self.get_handle(bus, address)
+        count, data = self.pi.i2c_read_i2c_block_data(handle, register, num_bytes)
+        if count < 0:
+            return
+
+        self.publish_reply({u"command": "i2c_reply", u"board": self.board_num, u"data": bytes(data)}, request_id)
+
+    def read_fifo(self, bus, address, register, num_bytes, status_register, mask, request_id=None):
+        """
+        Read all of the entries waiting in a device's FIFO and publish them as one reply.
+
+        The number of entries is read from the status register, and each entry is then read
+        with a block read of num_bytes. The reply contains the entries end to end, the number
+        of entries and the time at which the status register was read, which is the time of the
+        newest entry.
+        :param bus: i2c bus number
+        :param address: i2c device address
+        :param register: starting register of a FIFO entry
+        :param num_bytes: number of bytes in a FIFO entry
+        :param status_register: register containing the number of entries
+        :param mask: mask applied to the status register value
+        :param request_id: id of the request, or None
+        :return:
+        """
+        handle = self.get_handle(bus, address)
+        entries = self.pi.i2c_read_byte_data(handle, status_register) & mask
+        # the newest entry is the one that arrived before the status was read
+        read_time = self.clock.now()
+
+        data = bytearray()
+        for x in range(entries):
+            count, entry = self.pi.i2c_read_i2c_block_data(handle, register, num_bytes)
+            if count < 0:
+                break
+            data.extend(entry)
+
+        self.publish_reply({u"command": "i2c_reply", u"board": self.board_num, u"data": bytes(data),
+                            u"frames": len(data) // num_bytes, u"time": read_time}, request_id)
+
+    def periodic_read(self, interval, read, bus, address, register, *args):
+        """
+        Perform a read and schedule the next one
+        :param interval: time between reads in seconds
+        :param read: read_block or read_fifo
+        :param bus: i2c bus number
+        :param address: i2c device address
+        :param register: starting register
+        :param args: remaining arguments for the read
+        :return:
+        """
+        try:
+            read(bus, address, register, *args)
+        except pigpio.error as e:
+            self.report_problem('10-1\n', e)
+        self.scheduler.schedule(interval, self.periodic_read, interval, read, bus, address, register, *args,
+                                key=('read', bus, address, register))
+
+    def run(self):
+        """
+        Process i2c requests and periodic reads
+        :return:
+        """
+        while True:
+            timeout = self.scheduler.next_due()
+            if timeout is None:
+                timeout = .1
+            try:
+                request = self.requests.get(timeout=timeout)
+                try:
+                    self.process_request(request)
+                except (pigpio.error, KeyError) as e:
+                    self.report_problem('10-1\n', e)
+            except queue.Empty:
+                pass
+            self.scheduler.run_pending()
+
+
+class SonarService:
     """
-    This class encapsulates a type of acoustic ranger.  In particular
+    This class encapsulates a set of acoustic rangers.  In particular
     the type of ranger with separate trigger and echo pins.
 
     A pulse on the trigger initiates the sonar ping and shortly
@@ -553,163 +1101,208 @@ class Sonar(threading.Thread):
     goes high.  The echo pins stays high until a sonar echo is
     received (or the response times-out).  The time between
     the high and low edges indicates the sonar round trip time.
+
+    The round trip time is calculated entirely from pigpio edge callbacks - no thread waits for the echo.
+    Triggering and reporting are run by the bridge's action scheduler. The rangers are triggered one
+    at a time, ping_interval seconds apart, so that one sensor does not hear another sensor's ping.
+    Each ranger's distance is reported as the median of its last filter_size readings.
     """
 
-    def __init__(self, rpi, trigger, echo, board_num):
+    def __init__(self, rpi, scheduler, publisher, board_num, clock, ping_interval=.06, report_interval=.1,
+                 filter_size=5):
         """
-        The class is instantiated with the Pi to use and the
-        gpios connected to the trigger and echo pins.
+        :param rpi: pigpio instance
+        :param scheduler: The bridge's action scheduler
+        :param publisher: The bridge's publisher socket
+        :param board_num: System Board Number (1-10)
+        :param clock: The bridge's SyncedClock, used to stamp reports
+        :param ping_interval: Time in seconds between successive triggers
+        :param report_interval: Time in seconds between distance reports
+        :param filter_size: Number of readings used for the median filter
+        :return:
         """
-        super().__init__()
         self.pi = rpi
-        self._trig = trigger
-        # self._trig = 22
-        self._echo = echo
-        # self._echo = 9
-
+        self.scheduler = scheduler
+        self.publisher = publisher
         self.board_num = board_num
+        self.clock = clock
 
-        self._ping = False
-        self._high = None
-        self._time = None
+        self.ping_interval = ping_interval
+        self.report_interval = report_interval
+        self.filter_size = filter_size
 
-        self._triggered = False
+        # active rangers - key = trigger pin
+        self.rangers = collections.OrderedDict()
 
-        self._trig_mode = self.pi.get_mode(self._trig)
-        self._echo_mode = self.pi.get_mode(self._echo)
+        # echo pin to trigger pin map for the callback
+        self.echo_pins = {}
 
-        self.pi.set_mode(self._trig, pigpio.OUTPUT)
-        self.pi.set_mode(self._echo, pigpio.INPUT)
+        # position in the trigger rotation
+        self.next_ranger = 0
 
-        self._cb = self.pi.callback(self._trig, pigpio.EITHER_EDGE, self._cbf)
-        self._cb = self.pi.callback(self._echo, pigpio.EITHER_EDGE, self._cbf)
+        self.envelope = ("B" + self.board_num).encode()
 
-        self.context = zmq.Context()
+    def add(self, trigger, echo):
+        """
+        Add a ranger and start triggering it
+        :param trigger: trigger gpio
+        :param echo: echo gpio
+        :return:
+        """
+        if trigger in self.rangers:
+            self.remove(trigger)
 
-        self.publisher = self.context.socket(zmq.PUB)
-        connect_string = "tcp://" + port_map.port_map['router_ip_address'] + ':' + port_map.port_map[
-            'reporter_publisher_port']
+        ranger = {'echo': echo, 'trig_mode': self.pi.get_mode(trigger), 'echo_mode': self.pi.get_mode(echo),
+                  'triggered': False, 'high': None,
+                  'readings': collections.deque(maxlen=self.filter_size), 'last_report': None}
 
-        self.publisher.connect(connect_string)
+        self.pi.set_mode(trigger, pigpio.OUTPUT)
+        self.pi.set_mode(echo, pigpio.INPUT)
 
-        self._inited = True
+        self.echo_pins[echo] = trigger
+        ranger['cb'] = self.pi.callback(echo, pigpio.EITHER_EDGE, self._cbf)
+        self.rangers[trigger] = ranger
 
-    def _cbf(self, gpio, level, tick):
+        # start the trigger rotation and reports when the first ranger is added
+        if len(self.rangers) == 1:
+            self.scheduler.schedule(0, self.trigger_next, key=('sonar', 'trigger'))
+            self.scheduler.schedule(self.report_interval, self.report, key=('sonar', 'report'))
+
+    def remove(self, trigger=None):
         """
-        Callback from sonar data changes
-        :param gpio: pin
-        :param level: value
-        :param tick: timestamp
+        Cancel a ranger and return its gpios to their original mode.
+        :param trigger: trigger gpio. If None, all rangers are removed.
         :return:
         """
-        if gpio == self._trig:
-            if level == 0:  # trigger sent
-                self._triggered = True
-                self._high = None
+        if trigger is None:
+            triggers = list(self.rangers)
         else:
-            if self._triggered:
-                if level == 1:
-                    self._high = tick
-                else:
-                    if self._high is not None:
-                        self._time = tick - self._high
-                        self._high = None
-                        self._ping = True
+            triggers = [trigger]
 
-    def read(self):
-        """
-        Triggers a reading.  The returned reading is the number
-        of microseconds for the sonar round-trip.
+        for trig in triggers:
+            ranger = self.rangers.pop(trig, None)
+            if ranger:
+                ranger['cb'].cancel()
+                self.echo_pins.pop(ranger['echo'], None)
+                self.pi.set_mode(trig, ranger['trig_mode'])
+                self.pi.set_mode(ranger['echo'], ranger['echo_mode'])
 
-        round trip cms = round trip time / 1000000.0 * 34030
-        """
-        if self._inited:
-            try:
-                self._ping = False
-                self.pi.gpio_trigger(self._trig)
-                start = time.time()
-                while not self._ping:
-                    if (time.time() - start) > 5.0:
-                        return 20000
-                    time.sleep(0.001)
-                return self._time
-            except AttributeError:
-                sys.exit(0)
-        else:
-            return None
+        if not self.rangers:
+            self.scheduler.cancel_key(('sonar', 'trigger'))
+            self.scheduler.cancel_key(('sonar', 'report'))
 
-    def cancel(self):
+    def _cbf(self, gpio, level, tick):
         """
-        Cancels the ranger and returns the gpios to their
-        original mode.
+        Callback for echo pin changes
+        :param gpio: pin
+        :param level: value
+        :param tick: timestamp
+        :return:
         """
-        if self._inited:
-            self._inited = False
-            self._cb.cancel()
-            self.pi.set_mode(self._trig, self._trig_mode)
-            self.pi.set_mode(self._echo, self._echo_mode)
+        ranger = self.rangers.get(self.echo_pins.get(gpio))
+        if not ranger or not ranger['triggered']:
+            return
 
-    def run(self):
+        if level == 1:
+            ranger['high'] = tick
+        elif ranger['high'] is not None:
+            round_trip = pigpio.tickDiff(ranger['high'], tick)
+            ranger['high'] = None
+            ranger['triggered'] = False
+
+            # round trip cms = round trip time / 1000000.0 * 34030, the distance is half of that
+            ranger['readings'].append(round_trip / 1000000.0 * 34030.0 / 2)
+
+    def trigger_next(self):
         """
-        Retrieve sonar data and send report
+        Trigger the next ranger in the rotation and schedule the following trigger
         :return:
         """
+        if not self.rangers:
+            return
 
-        if not self._inited:
-            self.cancel()
+        triggers = list(self.rangers)
+        self.next_ranger %= len(triggers)
+        trigger = triggers[self.next_ranger]
+        self.next_ranger += 1
 
-        end = time.time() + 600.0
+        ranger = self.rangers[trigger]
+        ranger['high'] = None
+        ranger['triggered'] = True
+        self.pi.gpio_trigger(trigger, 10, 1)
 
-        while time.time() < end:
-            x = self.read()
-            if x:
-                # calculate round trip time
-                x = x / 1000000.0 * 34030.0
+        self.scheduler.schedule(self.ping_interval, self.trigger_next, key=('sonar', 'trigger'))
 
-                # calculate distance and round it off
-                x /= 2
-                x = round(x, 2)
+    def report(self):
+        """
+        Publish the median distance for each ranger that has readings and schedule the next report
+        :return:
+        """
+        for trigger, ranger in self.rangers.items():
+            readings = sorted(ranger['readings'])
+            if not readings:
+                continue
+            distance = round(readings[len(readings) // 2], 2)
 
-                # publish the data
+            # only send a report when the distance changes
+            if distance == ranger['last_report']:
+                continue
+            ranger['last_report'] = distance
 
-                digital_reply_msg = umsgpack.packb({u"command": "digital_read", u"pin": str(self._trig),
-                                                    u"value": str(x)})
+            digital_reply_msg = umsgpack.packb({u"command": "digital_read", u"pin": str(trigger),
+                                                u"value": str(distance), u"time": self.clock.now()})
+            self.publisher.send_multipart([self.envelope, digital_reply_msg])
 
-                envelope = ("B" + self.board_num).encode()
-                self.publisher.send_multipart([envelope, digital_reply_msg])
-                time.sleep(0.03)
+        self.scheduler.schedule(self.report_interval, self.report, key=('sonar', 'report'))
 
 
 class AtoD(threading.Thread):
     """
     This class handles the pcf8591 YL 40 Module analog to digital conversion module
+
+    The channels are read using the pcf8591 auto-increment mode. A single control byte write
+    selects the lowest enabled channel, and a single block read returns that channel and all
+    channels above it, up to the highest enabled channel.
     """
 
-    def __init__(self, rpi, bus, address, board_num):
+    # control byte bits
+    ANALOG_OUTPUT_ENABLE = 0x40
+    AUTO_INCREMENT = 0x04
+
+    def __init__(self, rpi, bus, address, board_num, publisher, clock, period=.04):
         """
 
         :param rpi: pigpio instance
         :param bus: i2c bus
         :param address: i2c address
+        :param board_num: System Board Number (1-10)
+        :param publisher: The bridge's HubPublisher
+        :param clock: The bridge's SyncedClock, used to stamp reports
+        :param period: Time between samples in seconds
         :return: nothing is returned
         """
         super().__init__()
+        self.daemon = True
         self.pi = rpi
         self.bus = bus
         self.address = address
         self.board_num = board_num
 
         self.handle = self.pi.i2c_open(self.bus, self.address)
-        self.context = zmq.Context()
+        self.publisher = publisher
+        self.clock = clock
+        self.envelope = ("B" + self.board_num).encode()
 
-        self.publisher = self.context.socket(zmq.PUB)
-        connect_string = "tcp://" + port_map.port_map['router_ip_address'] + ':' + port_map.port_map[
-            'reporter_publisher_port']
+        self.period = period
 
-        self.publisher.connect(connect_string)
+        # when True, a channel is only reported when its value changes
+        self.report_changes_only = False
 
         self.reports = [False, False, False, False]
 
+        # last value reported for each channel
+        self.last_values = [None, None, None, None]
+
     def set_report(self, index, value):
         """
         Set report table to send or deny reports
@@ -719,23 +1312,61 @@ class AtoD(threading.Thread):
         """
         self.reports[index] = value
 
+        # make sure that the first reading after enabling is reported
+        self.last_values[index] = None
+
+    def read_channels(self, first, last, a_out):
+        """
+        Read a range of channels with one block read
+        :param first: lowest channel to read
+        :param last: highest channel to read
+        :param a_out: value for the analog output
+        :return: list of values for channels first through last, or None if the read failed
+        """
+        self.pi.i2c_write_byte_data(self.handle, self.ANALOG_OUTPUT_ENABLE | self.AUTO_INCREMENT | first,
+                                    a_out & 0xFF)
+
+        # the first byte returned is the result of the previous conversion and is discarded
+        count, data = self.pi.i2c_read_device(self.handle, last - first + 2)
+        if count != last - first + 2:
+            return None
+        return list(data[1:])
+
     def run(self):
         """
         Continuously monitor the A/D
         :return:
         """
         a_out = 0
+        next_sample = time.monotonic()
         while True:
-            for a in range(0, 4):
-                if self.reports[a]:
-                    a_out += 1
-                    self.pi.i2c_write_byte_data(self.handle, 0x40 | ((a + 1) & 0x03), a_out & 0xFF)
-                    v = self.pi.i2c_read_byte(self.handle)
-                    digital_reply_msg = umsgpack.packb({u"command": "analog_read", u"pin": str(a),
-                                                        u"value": str(v)})
-                    envelope = ("B" + self.board_num).encode()
-                    self.publisher.send_multipart([envelope, digital_reply_msg])
-            time.sleep(0.04)
+            enabled = [a for a in range(0, 4) if self.reports[a]]
+            if enabled:
+                a_out += 1
+                try:
+                    values = self.read_channels(enabled[0], enabled[-1], a_out)
+                except pigpio.error as e:
+                    print('A/D read failed: ' + str(e))
+                    values = None
+
+                if values:
+                    sample_time = self.clock.now()
+                    for a in enabled:
+                        v = values[a - enabled[0]]
+                        if self.report_changes_only and v == self.last_values[a]:
+                            continue
+                        self.last_values[a] = v
+                        digital_reply_msg = umsgpack.packb({u"command": "analog_read", u"pin": str(a),
+                                                            u"value": str(v), u"time": sample_time})
+                        self.publisher.send_multipart([self.envelope, digital_reply_msg])
+
+            # keep a steady sample rate regardless of how long the read took
+            next_sample += self.period
+            delay = next_sample - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_sample = time.monotonic()
 
 
 def raspberrypi_bridge():
@@ -748,6 +1379,13 @@ def raspberrypi_bridge():
     parser = argparse.ArgumentParser()
     parser.add_argument("-b", dest="board_number", default="1", help="Board Number - 1 through 10")
     parser.add_argument('-r', dest='router_ip_address', default='None', help='Router IP Address')
+    parser.add_argument('-s', dest='standby_router_ip_address', default='None', help='Standby Router IP Address')
+    parser.add_argument('-x', dest='instrumentation_interval', default='0',
+                        help='Publish instrumentation stats every this many seconds - 0 = off')
+    parser.add_argument('-m', dest='max_actuation_rate', default='50',
+                        help='Maximum servo/PWM updates per second for each pin - 0 = no limit')
+    parser.add_argument('-z', dest='compression_threshold', default='0',
+                        help='Compress reports of at least this many bytes - 0 = no compression')
 
     args = parser.parse_args()
 
@@ -755,7 +1393,11 @@ def raspberrypi_bridge():
 
     board_num = args.board_number
     router_ip_address = args.router_ip_address
-    rpi_bridge = RaspberryPiBridge(pi, board_num, router_ip_address)
+    max_actuation_rate = float(args.max_actuation_rate)
+    rpi_bridge = RaspberryPiBridge(pi, board_num, router_ip_address, max_actuation_rate,
+                                   int(args.compression_threshold), args.standby_router_ip_address,
+                                   float(args.instrumentation_interval))
+    rpi_bridge.instrumentation.install_signal_handlers()
     try:
         rpi_bridge.run_raspberry_bridge()
     except KeyboardInterrupt:
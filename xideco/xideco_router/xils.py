@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Copyright (c) 2016 Alan Yorinks All right reserved.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public
+License as published by the Free Software Foundation; either
+version 3 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+"""
+This file lists the Xideco components known to the router, whether they are responding, and their
+load - xils.
+
+    xils            list the components once
+    xils -w 2       list the components every 2 seconds
+    xils -b 3       list only the components of board 3
+"""
+
+import argparse
+import signal
+import sys
+import time
+
+import zmq
+
+from xideco.common import discovery
+from xideco.common import rpc
+
+
+def list_components(client, name=None, board=None):
+    """
+    Print the components known to the router
+    :param client: RpcClient
+    :param name: Optional program name to list
+    :param board: Optional board number to list
+    :return: The number of components that are not responding, or None if the router did not answer
+    """
+    try:
+        components = client.call('liveness', {u"command": u"status", u"name": name, u"board": board})['components']
+    except rpc.RpcError as e:
+        print('The router did not answer: ' + str(e))
+        return None
+
+    print('{0:36}{1:>12}{2:>8}{3:>8}{4:>10}{5:>10}{6:>10}'.format('component', 'status', 'age', 'queue',
+                                                                  'msgs/s', 'lag ms', 'dropped'))
+    stopped = 0
+    for status in components:
+        if not status['alive']:
+            stopped += 1
+        print('{0:36}{1:>12}{2:>8.1f}{3:>8}{4:>10.1f}{5:>10.1f}{6:>10}'.format(
+            status['component'], 'running' if status['alive'] else 'NOT RUNNING', status['age'],
+            status.get('queue', 0), status.get('rate', 0), status.get('lag', 0) * 1000, status.get('dropped', 0)))
+    return stopped
+
+
+def xils():
+    # noinspection PyShadowingNames
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', dest='router_ip_address', default='None', help='Router IP Address')
+    parser.add_argument('-n', dest='name', default=None, help='Only list the components with this program name')
+    parser.add_argument('-b', dest='board', default=None, help='Only list the components of this board')
+    parser.add_argument('-w', dest='watch', default='0', help='List the components every this many seconds')
+
+    args = parser.parse_args()
+
+    router_ip_address = discovery.resolve_router_ip_address(args.router_ip_address)
+
+    # signal handler function called when Control-C occurs
+    # noinspection PyShadowingNames,PyUnusedLocal,PyUnusedLocal
+    def signal_handler(signal, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, signal_handler)
+
+    context = zmq.Context()
+    client = rpc.RpcClient(context, router_ip_address)
+    stopped = None
+    try:
+        while True:
+            stopped = list_components(client, args.name, args.board)
+            if not float(args.watch):
+                break
+            time.sleep(float(args.watch))
+            print()
+    except KeyboardInterrupt:
+        pass
+    client.close()
+    context.term()
+
+    # the exit status is non zero if the router did not answer or a component is not responding
+    sys.exit(0 if stopped == 0 else 1)
+
+
+if __name__ == '__main__':
+    xils()
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+"""
+Copyright (c) 2016 Alan Yorinks All right reserved.
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public
+License as published by the Free Software Foundation; either
+version 3 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+"""
+
+"""
+This file contains the Xideco traffic recorder and replayer - xirec.
+
+Recording:  xirec record session.xrec
+    Records the router's capture port. The router must be started with the -c option.
+
+Replaying:  xirec replay session.xrec -s 10
+    Publishes the recorded messages to the router at 10 times the recorded speed.
+    -s 0 replays as fast as possible.
+    Recorded router heartbeats are never replayed. Recorded liveness and stats messages are only replayed
+    with -a, as they would make the recorded bridges look alive to the live router's registry.
+
+A log is two files. The log file holds the records end to end. Each record is:
+    time (float64), number of frames (uint16), and for each frame its length (uint32) and its bytes.
+The index file, log file name + '.idx', holds a (time, log file offset) pair (float64, uint64) for the
+first record of each second of the recording, so that a replay may start part way into the log.
+All values are little endian.
+"""
+
+import argparse
+import bisect
+import signal
+import struct
+import sys
+import time
+
+import zmq
+
+from xideco.common import discovery
+from xideco.common.failover import HEARTBEAT_TOPIC
+from xideco.common.instrumentation import STATS_TOPIC
+from xideco.common.liveness import LIVENESS_TOPIC
+from xideco.data_files.port_map import port_map
+
+RECORD_HEADER = struct.Struct('<dH')
+FRAME_LENGTH = struct.Struct('<I')
+INDEX_ENTRY = struct.Struct('<dQ')
+
+
+class LogWriter:
+    """
+    This class appends records to a log and its index
+    """
+
+    def __init__(self, file_name, index_interval=1.0):
+        """
+        :param file_name: log file name
+        :param index_interval: Seconds of recording between index entries
+        :return:
+        """
+        self.log = open(file_name, 'ab')
+        self.index = open(file_name + '.idx', 'ab')
+        self.index_interval = index_interval
+        self.next_index_time = 0
+        self.records = 0
+
+    def write(self, timestamp, frames):
+        """
+        Append a record
+        :param timestamp: time the message was received
+        :param frames: list of message frames
+        :return:
+        """
+        if timestamp >= self.next_index_time:
+            self.index.write(INDEX_ENTRY.pack(timestamp, self.log.tell()))
+            self.next_index_time = timestamp + self.index_interval
+
+        record = [RECORD_HEADER.pack(timestamp, len(frames))]
+        for frame in frames:
+            record.append(FRAME_LENGTH.pack(len(frame)))
+            record.append(frame)
+        self.log.write(b''.join(record))
+        self.records += 1
+
+    def close(self):
+        self.log.close()
+        self.index.close()
+
+
+class LogReader:
+    """
+    This class reads the records of a log
+    """
+
+    def __init__(self, file_name):
+        """
+        :param file_name: log file name
+        :return:
+        """
+        self.log = open(file_name, 'rb')
+
+        # load the index
+        self.index_times = []
+        self.index_offsets = []
+        try:
+            with open(file_name + '.idx', 'rb') as f:
+                data = f.read()
+            for timestamp, offset in INDEX_ENTRY.iter_unpack(data[:len(data) - len(data) % INDEX_ENTRY.size]):
+                self.index_times.append(timestamp)
+                self.index_offsets.append(offset)
+        except FileNotFoundError:
+            pass
+
+    def start_time(self):
+        """
+        :return: Time of the first record, or None if the log is empty
+        """
+        if self.index_times:
+            return self.index_times[0]
+        for timestamp, frames in self.records():
+            return timestamp
+        return None
+
+    def seek(self, timestamp):
+        """
+        Position the log at the indexed record at or before a time
+        :param timestamp: time to seek to
+        :return:
+        """
+        position = bisect.bisect_right(self.index_times, timestamp) - 1
+        if position < 0:
+            self.log.seek(0)
+        else:
+            self.log.seek(self.index_offsets[position])
+
+    def records(self):
+        """
+        Read records from the current position
+        :return: A generator of (time, frames) tuples
+        """
+        while True:
+            header = self.log.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            timestamp, count = RECORD_HEADER.unpack(header)
+            frames = []
+            for x in range(count):
+                length_bytes = self.log.read(FRAME_LENGTH.size)
+                if len(length_bytes) < FRAME_LENGTH.size:
+                    # the recording was cut off in the middle of a record
+                    return
+                length = FRAME_LENGTH.unpack(length_bytes)[0]
+                frames.append(self.log.read(length))
+            yield timestamp, frames
+
+    def close(self):
+        self.log.close()
+
+
+def record(file_name, router_ip_address, duration=None):
+    """
+    Record the router's capture port
+    :param file_name: log file name
+    :param router_ip_address: router IP address
+    :param duration: Optional recording time in seconds
+    :return: number of records written
+    """
+    context = zmq.Context()
+    capture = context.socket(zmq.SUB)
+    capture.connect('tcp://' + router_ip_address + ':' + port_map.port_map['capture_port'])
+    capture.setsockopt(zmq.SUBSCRIBE, b'')
+
+    writer = LogWriter(file_name)
+    print('Recording to ' + file_name + ' - Control-C to stop')
+
+    end_time = None
+    if duration:
+        end_time = time.time() + duration
+    try:
+        while True:
+            if end_time:
+                remaining = end_time - time.time()
+                if remaining <= 0:
+                    break
+                if not capture.poll(remaining * 1000):
+                    continue
+            writer.write(time.time(), capture.recv_multipart())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        writer.close()
+        capture.close()
+        context.term()
+
+    print('\n' + str(writer.records) + ' messages recorded')
+    return writer.records
+
+
+def replay(file_name, router_ip_address, speed=1.0, start=0.0, topics=None, include_status=False):
+    """
+    Publish the messages of a log to the router
+    :param file_name: log file name
+    :param router_ip_address: router IP address
+    :param speed: Replay speed - 1 for the recorded speed, N for N times faster, 0 for as fast as possible
+    :param start: Number of seconds into the recording to start at
+    :param topics: Optional list of topic prefixes to replay
+    :param include_status: Also replay recorded liveness and stats messages
+    :return: number of messages published
+    """
+    reader = LogReader(file_name)
+    first_time = reader.start_time()
+    if first_time is None:
+        print('The log is empty')
+        return 0
+
+    context = zmq.Context()
+    publisher = context.socket(zmq.PUB)
+    publisher.connect('tcp://' + router_ip_address + ':' + port_map.port_map['publish_to_router_port'])
+
+    # give the connection time to be established before publishing
+    time.sleep(.5)
+
+    if topics:
+        topics = tuple(topic.encode() for topic in topics)
+
+    start_time = first_time + start
+    reader.seek(start_time)
+
+    count = 0
+    replay_start = None
+    try:
+        for timestamp, frames in reader.records():
+            if timestamp < start_time:
+                continue
+            if topics and not frames[0].startswith(topics):
+                continue
+            # the live router sends its own heartbeats, and the live bridges their own liveness and stats
+            if frames[0] == HEARTBEAT_TOPIC:
+                continue
+            if not include_status and frames[0] in (LIVENESS_TOPIC, STATS_TOPIC):
+                continue
+
+            if replay_start is None:
+                replay_start = time.monotonic()
+            if speed:
+                delay = replay_start + (timestamp - start_time) / speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+            publisher.send_multipart(frames)
+            count += 1
+    except KeyboardInterrupt:
+        pass
+    finally:
+        reader.close()
+        publisher.close(linger=1000)
+        context.term()
+
+    if replay_start is not None:
+        elapsed = time.monotonic() - replay_start
+        print(str(count) + ' messages replayed in ' + str(round(elapsed, 3)) + ' seconds')
+    return count
+
+
+def xirec():
+    # noinspection PyShadowingNames
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('action', choices=['record', 'replay'], help='record or replay')
+    parser.add_argument('file_name', help='Log file name')
+    parser.add_argument('-r', dest='router_ip_address', default='None', help='Router IP Address')
+    parser.add_argument('-d', dest='duration', default='0', help='Recording time in seconds - 0 = until Control-C')
+    parser.add_argument('-s', dest='speed', default='1',
+                        help='Replay speed: 1 = recorded speed, N = N times faster, 0 = as fast as possible')
+    parser.add_argument('-o', dest='start', default='0', help='Seconds into the recording to start the replay')
+    parser.add_argument('-t', dest='topics', nargs='*', help='Topic prefixes to replay - default is all')
+    parser.add_argument('-a', dest='include_status', action='store_true',
+                        help='Also replay recorded liveness and stats messages')
+
+    args = parser.parse_args()
+
+    router_ip_address = discovery.resolve_router_ip_address(args.router_ip_address)
+
+    # signal handler function called when Control-C occurs
+    # noinspection PyShadowingNames,PyUnusedLocal,PyUnusedLocal
+    def signal_handler(signal, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, signal_handler)
+
+    if args.action == 'record':
+        record(args.file_name, router_ip_address, float(args.duration))
+    else:
+        replay(args.file_name, router_ip_address, float(args.speed), float(args.start), args.topics,
+               args.include_status)
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    xirec()
@@ -19,14 +19,21 @@ You should have received a copy of the GNU Lesser General Public
 License along with this library; if not, write to the Free Software
 Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 """
+import argparse
 import os
 import signal
-import socket
 import sys
-import time
+import zlib
 
+import umsgpack
 import zmq
 
+from xideco.common import discovery
+from xideco.common import rpc
+from xideco.common.compression import unpack_message
+from xideco.common.failover import PeerMonitor, RouterHeartbeat
+from xideco.common.liveness import LIVENESS_TIMEOUT, LivenessMonitor, LivenessRegistry
+from xideco.common.rpc import RpcBroker
 from xideco.data_files.port_map import port_map
 
 
@@ -38,17 +45,23 @@ class XidecoRouter:
     for board data changes.
     """
 
-    def __init__(self):
+    # report commands kept by the last value cache
+    CACHED_COMMANDS = ('digital_read', 'analog_read')
+
+    def __init__(self, last_value_cache=False, cached_topics=('B',), capture=False, primary_ip_address=None,
+                 liveness_timeout=LIVENESS_TIMEOUT):
         """
         This is the constructor for the XidecoRouter class.
-        :param: use_port_map: If true, use the ip address in the port map, if false, use discovered ip address
+        :param last_value_cache: If true, keep the latest report for each board, command and pin, and
+                                 send the cached reports to each new subscriber
+        :param cached_topics: Topic prefixes of the messages kept by the last value cache
+        :param capture: If true, publish a copy of every routed message on the capture port for recording
+        :param primary_ip_address: If set, this router is a hot standby for the router at this address
+        :param liveness_timeout: Seconds without a heartbeat after which a component is not responding
         :return: None
         """
         # figure out the IP address of the router
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        # use the google dns
-        s.connect(('8.8.8.8', 0))
-        self.ip_addr = s.getsockname()[0]
+        self.ip_addr = discovery.local_ip_address()
 
         # identify the router ip address for the user on the console
         print('\nXideco Router - xirt')
@@ -86,9 +99,10 @@ class XidecoRouter:
         print('NOTE: The path to port_map.py may be different')
         print('for each Operating System/Computer.')
 
-        print('\nSet the router_ip_address entry in port_map.py ')
-        print('to the address printed above for each ')
-        print('computer running Xideco, or optionally ')
+        print('\nXideco modules discover the router automatically.')
+        print('If discovery is blocked on your network, set the')
+        print('router_ip_address entry in port_map.py to the address')
+        print('printed above for each computer running Xideco, or')
         print('set the address manually for each Xideco module')
         print('using the command line options.\n')
 
@@ -97,42 +111,188 @@ class XidecoRouter:
 
         # subscribe to any message that any entity publishes
         self.publish_to_router = self.router.socket(zmq.SUB)
-        bind_string = 'tcp://' + self.ip_addr + ':' + port_map.port_map[
-            'publish_to_router_port']
+        # bind to all interfaces, so that the router can also be reached on the loopback address
+        bind_string = 'tcp://*:' + port_map.port_map['publish_to_router_port']
         self.publish_to_router.bind(bind_string)
         # Don't filter any incoming messages, just pass them through
         self.publish_to_router.setsockopt_string(zmq.SUBSCRIBE, '')
 
         # publish these messages
-        self.subscribe_to_router = self.router.socket(zmq.PUB)
-        bind_string = 'tcp://' + self.ip_addr + ':' + port_map.port_map[
-            'subscribe_to_router_port']
+        if last_value_cache:
+            # an XPUB socket reports every subscription, so the cache can be sent to each new subscriber
+            self.subscribe_to_router = self.router.socket(zmq.XPUB)
+            self.subscribe_to_router.setsockopt(zmq.XPUB_VERBOSE, 1)
+            print('Last value cache enabled\n')
+        else:
+            self.subscribe_to_router = self.router.socket(zmq.PUB)
+        bind_string = 'tcp://*:' + port_map.port_map['subscribe_to_router_port']
         self.subscribe_to_router.bind(bind_string)
 
-        zmq.device(zmq.FORWARDER, self.publish_to_router, self.subscribe_to_router)
+        # the last value cache - key = (topic, command, pin), value = message
+        if last_value_cache:
+            self.last_values = {}
+        else:
+            self.last_values = None
+        self.cached_topics = tuple(topic.encode() for topic in cached_topics)
+
+        # a copy of every message routed is published here - see xirec
+        if capture:
+            self.capture = self.router.socket(zmq.PUB)
+            self.capture.bind('tcp://*:' + port_map.port_map['capture_port'])
+            print('Capture enabled on port ' + port_map.port_map['capture_port'] + '\n')
+        else:
+            self.capture = None
+
+        # requests that need a reply are routed by the RPC broker
+        self.rpc_broker = RpcBroker(self.router)
+        self.rpc_broker.start()
+
+        # heartbeats tell the other Xideco modules that the router is running - see failover.py
+        if primary_ip_address:
+            self.heartbeat = RouterHeartbeat(self.router, self.ip_addr, 'standby')
+        else:
+            self.heartbeat = RouterHeartbeat(self.router, self.ip_addr, 'primary')
+        self.heartbeat.start()
+
+        # a standby router watches the primary, and copies its last value cache
+        if primary_ip_address:
+            print('Standby for the primary router at ' + primary_ip_address + '\n')
+            if self.last_values is None:
+                self.peer_monitor = PeerMonitor(self.router, primary_ip_address, self.heartbeat)
+            else:
+                self.peer_monitor = PeerMonitor(self.router, primary_ip_address, self.heartbeat,
+                                                self.cached_topics, self.cache_message)
+            self.peer_monitor.start()
+
+        # answer discovery probes - a standby answers only while the primary is not responding
+        if primary_ip_address:
+            self.discovery_responder = discovery.DiscoveryResponder(
+                answering=lambda: self.heartbeat.peer_alive is False)
+        else:
+            self.discovery_responder = discovery.DiscoveryResponder()
+        self.discovery_responder.start()
+
+        # the components' heartbeats are collected, and may be queried with the liveness service - see liveness.py
+        self.liveness = LivenessRegistry(liveness_timeout)
+        self.rpc_broker.add_local_service('liveness', self.liveness.rpc_request)
+
+        # a client may ask for its own copy of the last value cache
+        if self.last_values is not None:
+            self.rpc_broker.add_local_service('last_values', self.last_values_request)
+        self.liveness_monitor = LivenessMonitor(self.router, self.liveness)
+        self.liveness_monitor.start()
 
-    # noinspection PyMethodMayBeStatic
     def route(self):
         """
         This method runs in a forever loop.
         :return:
         """
+        if self.last_values is None:
+            if self.capture:
+                zmq.proxy(self.publish_to_router, self.subscribe_to_router, self.capture)
+            else:
+                zmq.device(zmq.FORWARDER, self.publish_to_router, self.subscribe_to_router)
+        else:
+            self.route_with_cache()
+
+    def route_with_cache(self):
+        """
+        Forward messages, keeping the latest report for each board, command and pin.
+
+        When a subscription arrives, the cached messages that match it are published. A message
+        published this way goes to every subscriber of its topic, so existing subscribers may see a
+        report again. Reports are the latest values, so receiving one again is harmless. A client that
+        must not see reports again uses the last_values RPC service instead, which replies to it alone.
+        :return:
+        """
+        poller = zmq.Poller()
+        poller.register(self.publish_to_router, zmq.POLLIN)
+        poller.register(self.subscribe_to_router, zmq.POLLIN)
+
         while True:
             try:
-                time.sleep(.001)
+                events = dict(poller.poll())
+                if self.publish_to_router in events:
+                    msg = self.publish_to_router.recv_multipart()
+                    self.subscribe_to_router.send_multipart(msg)
+                    if self.capture:
+                        self.capture.send_multipart(msg)
+                    self.cache_message(msg)
+
+                if self.subscribe_to_router in events:
+                    # subscription messages are a 1 byte (subscribe) followed by the topic
+                    event = self.subscribe_to_router.recv()
+                    if event and event[0] == 1:
+                        self.replay_cache(event[1:])
             except KeyboardInterrupt:
                 sys.exit(0)
 
+    def cache_message(self, msg):
+        """
+        Keep the message if it is a cached report
+        :param msg: [topic, payload]
+        :return:
+        """
+        if len(msg) < 2 or not msg[0].startswith(self.cached_topics):
+            return
+        try:
+            payload = unpack_message(msg)
+        except (umsgpack.UnpackException, zlib.error):
+            return
+        if isinstance(payload, dict) and payload.get('command') in self.CACHED_COMMANDS:
+            self.last_values[(msg[0], payload['command'], payload.get('pin'))] = msg
+
+    def replay_cache(self, topic):
+        """
+        Publish the cached messages that match a subscription. A subscription to everything, such as
+        that of a monitor or recorder, would send the whole cache to every subscriber, so it is not replayed.
+        :param topic: subscribed topic prefix
+        :return:
+        """
+        if not topic:
+            return
+        for msg in list(self.last_values.values()):
+            if msg[0].startswith(topic):
+                self.subscribe_to_router.send_multipart(msg)
+
+    def last_values_request(self, request):
+        """
+        The last_values RPC service. Its command is snapshot, which replies with the cached messages that
+        match an optional topic prefix, each as a list of frames.
+        :param request: request message
+        :return: The reply
+        """
+        if request.get('command') != 'snapshot':
+            return rpc.error_reply(rpc.UNKNOWN_COMMAND, str(request.get('command')))
+        topic = request.get('topic', '').encode()
+        return rpc.ok_reply(messages=[msg for msg in list(self.last_values.values()) if msg[0].startswith(topic)])
+
     def clean_up(self):
         self.publish_to_router.close()
         self.subscribe_to_router.close()
+        if self.capture:
+            self.capture.close()
         self.router.term()
 
 
 def xideco_router():
     # noinspection PyShadowingNames
 
-    xideco_router = XidecoRouter()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-l', dest='last_value_cache', action='store_true',
+                        help='Send the latest board reports to each new subscriber')
+    parser.add_argument('-c', dest='capture', action='store_true',
+                        help='Publish a copy of all traffic on the capture port for xirec')
+    parser.add_argument('-p', dest='primary_ip_address', default=None,
+                        help='Run as a hot standby for the primary router at this IP address')
+    parser.add_argument('-t', dest='liveness_timeout', default=str(LIVENESS_TIMEOUT),
+                        help='Seconds without a heartbeat after which a component is reported as not responding')
+
+    args = parser.parse_args()
+
+    xideco_router = XidecoRouter(args.last_value_cache, capture=args.capture,
+                                 primary_ip_address=args.primary_ip_address,
+                                 liveness_timeout=float(args.liveness_timeout))
     xideco_router.route()
 
     # signal handler function called when Control-C occurs
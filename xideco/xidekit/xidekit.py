@@ -16,13 +16,18 @@ License along with this library; if not, write to the Free Software
 Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 """
 
-import socket
 import sys
 import time
 
 import umsgpack
 import zmq
 
+from xideco.common import discovery
+from xideco.common.compression import DEFAULT_THRESHOLD, MessageCompressor, unpack_message
+from xideco.common.failover import HEARTBEAT_TOPIC, RouterFailover
+from xideco.common.liveness import Heartbeat
+from xideco.common.rpc import RpcClient, RpcError
+
 
 # noinspection PyUnresolvedReferences
 class XideKit:
@@ -37,24 +42,20 @@ class XideKit:
     Methods that may be overwritten:  the __init__ method, the receive_loop and incoming_message_processing
     """
 
-    def __init__(self, router_ip_address=None, subscriber_port='43125', publisher_port='43124'):
+    def __init__(self, router_ip_address=None, subscriber_port='43125', publisher_port='43124',
+                 standby_router_ip_address=None):
         """
         The __init__ method sets up all the ZeroMQ "plumbing"
 
-        :param router_ip_address: Xideco Router IP Address - if not specified, it will be set to the local computer
+        :param router_ip_address: Xideco Router IP Address - if not specified, the router is discovered
         :param subscriber_port: Xideco router subscriber port. This must match that of the Xideco router
         :param publisher_port: Xideco router publisher port. This must match that of the Xideco router
+        :param standby_router_ip_address: Router to use if the router stops responding
         :return:
         """
 
-        # If no router address was specified, determine the IP address of the local machine
-        if router_ip_address:
-            self.router_ip_address = router_ip_address
-        else:
-            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            # use the google dns
-            s.connect(('8.8.8.8', 0))
-            self.router_ip_address = s.getsockname()[0]
+        # If no router address was specified, discover the router
+        self.router_ip_address = discovery.resolve_router_ip_address(router_ip_address)
 
         print('\n**************************************')
         print('Using router IP address: ' + self.router_ip_address)
@@ -70,9 +71,29 @@ class XideKit:
         self.subscriber.connect(connect_string)
 
         self.publisher = self.context.socket(zmq.PUB)
+        # messages are dropped, rather than queued, while the router is not connected
+        self.publisher.setsockopt(zmq.IMMEDIATE, 1)
         connect_string = "tcp://" + self.router_ip_address + ':' + self.publisher_port
         self.publisher.connect(connect_string)
 
+        # requests that need a reply are sent through the router's RPC channel
+        self.rpc = RpcClient(self.context, self.router_ip_address)
+
+        # if a standby router is given, the router's heartbeats are watched, and the connections are
+        # moved to the standby router if they stop. A receive_loop that is overwritten should pass
+        # received messages to process_message and call check_router periodically.
+        self.failover = RouterFailover(self.router_ip_address, standby_router_ip_address)
+        if len(self.failover.routers) > 1:
+            self.subscriber.setsockopt(zmq.SUBSCRIBE, HEARTBEAT_TOPIC)
+            self.failover.add_callback(self.reconnect)
+
+        # heartbeats tell the router that the application is running - see xideco.common.liveness.
+        # A receive_loop that is overwritten should call self.heartbeat.tick periodically.
+        self.heartbeat = Heartbeat(self.publisher, type(self).__name__)
+
+        # published messages are not compressed unless enable_compression is called
+        self.compressor = None
+
     def set_subscriber_topic(self, topic):
         """
         This method sets the subscriber topic.
@@ -87,6 +108,17 @@ class XideKit:
 
         self.subscriber.setsockopt(zmq.SUBSCRIBE, topic.encode())
 
+    def enable_compression(self, topics=('',), threshold=DEFAULT_THRESHOLD):
+        """
+        This method enables compression of large published messages.
+
+        Receivers must unpack messages with xideco.common.compression.unpack_message, as XideKit does.
+        :param topics: A list of topic prefixes to compress. The default compresses all topics.
+        :param threshold: Minimum payload size in bytes to compress
+        :return:
+        """
+        self.compressor = MessageCompressor(topics, threshold)
+
     def publish_payload(self, payload, topic=''):
         """
         This method will publish a payload with the specified topic.
@@ -105,7 +137,92 @@ class XideKit:
         message = umsgpack.packb(payload)
 
         pub_envelope = topic.encode()
-        self.publisher.send_multipart([pub_envelope, message])
+        frames = [pub_envelope, message]
+        if self.compressor:
+            frames = self.compressor.compress(frames)
+        self.publisher.send_multipart(frames)
+
+    def call(self, service, request, timeout=None):
+        """
+        This method sends a request through the RPC channel and waits for its reply.
+
+        To have several requests outstanding, use self.rpc.send for each request and then
+        self.rpc.result to collect each reply.
+
+        :param service: Service name, e.g. 'A1' to send a command to the bridge of board 1
+        :param request: A dictionary of items, e.g. a Xideco protocol command
+        :param timeout: Maximum time in seconds to wait for the reply
+        :return: The reply dictionary
+        :raises: An xideco.common.rpc.RpcError subclass if the request failed or timed out
+        """
+        return self.rpc.call(service, request, timeout)
+
+    def request_last_values(self, topic=''):
+        """
+        This method asks a router with a last value cache (xirt -l) for the latest reports that match
+        a topic prefix, and passes each to incoming_message_processing. Only this application receives them.
+
+        :param topic: A topic prefix string, e.g. 'B1'
+        :return: The number of reports received - 0 if the router does not keep a cache
+        """
+        try:
+            reply = self.call('last_values', {u'command': u'snapshot', u'topic': topic})
+        except RpcError:
+            return 0
+        for frames in reply['messages']:
+            self.incoming_message_processing(frames[0].decode(), unpack_message(frames))
+        return len(reply['messages'])
+
+    def reconnect(self, router_ip_address):
+        """
+        This method moves all connections to another router.
+
+        :param router_ip_address: IP address of the new router
+        :return:
+        """
+        self.subscriber.disconnect("tcp://" + self.router_ip_address + ':' + self.subscriber_port)
+        self.subscriber.connect("tcp://" + router_ip_address + ':' + self.subscriber_port)
+        self.publisher.disconnect("tcp://" + self.router_ip_address + ':' + self.publisher_port)
+        self.publisher.connect("tcp://" + router_ip_address + ':' + self.publisher_port)
+        self.rpc.reconnect(router_ip_address)
+        self.router_ip_address = router_ip_address
+
+    def check_router(self):
+        """
+        This method moves the connections to the standby router if the router has stopped responding.
+        Call it periodically from the receive loop.
+
+        :return:
+        """
+        self.failover.check()
+
+    def process_message(self, data):
+        """
+        This method passes a received message to incoming_message_processing. Router heartbeats are
+        processed by the failover instead.
+
+        :param data: The received message frames
+        :return:
+        """
+        self.heartbeat.message()
+        if data[0] == HEARTBEAT_TOPIC:
+            report = self.failover.heartbeat(unpack_message(data))
+            if report:
+                self.router_gap(report)
+        else:
+            self.incoming_message_processing(data[0].decode(), unpack_message(data))
+
+    # noinspection PyMethodMayBeStatic
+    def router_gap(self, report):
+        """
+        This method is called when the router's heartbeats resume after a gap, during which
+        messages may have been lost. Override it to handle the gap.
+
+        :param report: A router_gap message - see xideco.common.failover
+        :return:
+        """
+        print('No router heartbeats for ' + str(round(report['duration'], 1)) +
+              ' seconds - messages may have been lost')
 
     def receive_loop(self):
         """
@@ -118,12 +235,14 @@ class XideKit:
         while True:
             try:
                 data = self.subscriber.recv_multipart(zmq.NOBLOCK)
-                self.incoming_message_processing(data[0].decode(), umsgpack.unpackb(data[1]))
+                self.process_message(data)
                 time.sleep(.001)
             except zmq.error.Again:
                 time.sleep(.001)
             except KeyboardInterrupt:
                 self.clean_up()
+            self.check_router()
+            self.heartbeat.tick()
 
     # noinspection PyMethodMayBeStatic
     def incoming_message_processing(self, topic, payload):
@@ -144,6 +263,7 @@ class XideKit:
         """
         self.publisher.close()
         self.subscriber.close()
+        self.rpc.close()
         self.context.term()
         sys.exit(0)
 